@@ -64,6 +64,9 @@ setup(
             "plone.app.contenttypes",
             "plone.app.robotframework[debug]",
         ],
+        "zstd": [
+            "zstandard",
+        ],
     },
     entry_points="""
     [z3c.autoinclude.plugin]
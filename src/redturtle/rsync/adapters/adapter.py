@@ -1,29 +1,68 @@
+from BTrees.OOBTree import OOBTree
 from datetime import datetime
 from email.message import EmailMessage
 from email.utils import formataddr
 from pathlib import Path
+from persistent.mapping import PersistentMapping
 from plone import api
+from plone.namedfile.file import NamedBlobFile
+from plone.namedfile.file import NamedBlobImage
 from plone.registry.interfaces import IRegistry
 from Products.CMFPlone.interfaces.controlpanel import IMailSchema
 from redturtle.rsync import _
+from redturtle.rsync.adapters.assets import Asset
+from redturtle.rsync.adapters.assets import AssetCache
+from redturtle.rsync.adapters.blobs import bytes_digest
+from redturtle.rsync.adapters.blobs import spool
+from redturtle.rsync.adapters.convert import convert_rows
+from redturtle.rsync.adapters.dead_letter import DeadLetter
+from redturtle.rsync.adapters.dead_letter import is_dead_letter
+from redturtle.rsync.adapters.fingerprint import row_fingerprint
+from redturtle.rsync.adapters.http_cache import SourceCache
+from redturtle.rsync.adapters.log import autolink
+from redturtle.rsync.adapters.log import LogRenderer
+from redturtle.rsync.adapters.log import LogStorage
+from redturtle.rsync.adapters.log import make_record
+from redturtle.rsync.adapters.lookup import LookupIndex
+from redturtle.rsync.adapters.orphans import exceeds_max_delete
+from redturtle.rsync.adapters.orphans import group_by_parent
+from redturtle.rsync.adapters.orphans import linked_orphans
+from redturtle.rsync.adapters.paged import PagedSource
+from redturtle.rsync.adapters.plan import Plan
+from redturtle.rsync.adapters.reindex import ReindexQueue
+from redturtle.rsync.adapters.schema import compile_schema
+from redturtle.rsync.adapters.schema import InvalidRow
+from redturtle.rsync.adapters.sources import guess_format
+from redturtle.rsync.adapters.sources import iter_rows
+from redturtle.rsync.adapters.sources import open_source_stream
 from redturtle.rsync.interfaces import IRedturtleRsyncAdapter
+from redturtle.rsync.scripts.checkpoint import SyncUids
+from redturtle.rsync.scripts.metrics import Metrics
 from redturtle.rsync.scripts.rsync import logger
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+from urllib.parse import urlparse
+from zope.annotation.interfaces import IAnnotations
 from zope.component import adapter
 from zope.component import getUtility
 from zope.interface import implementer
 from zope.interface import Interface
 
+import gzip
+import io
+import itertools
 import json
-import re
+import os
 import requests
+import tempfile
 import uuid
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+_marker = object()
+
 
 class TimeoutHTTPAdapter(HTTPAdapter):
     def __init__(self, *args, **kwargs):
@@ -49,19 +88,78 @@ class RsyncAdapterBase:
     Default methods works with some data in restapi-like format.
     """
 
+    # name of the catalog index with the external key of the synced items,
+    # used to build the lookup index (see get_row_key)
+    lookup_key_index = None
+    # portal type of the synced items, to restrict the default lookup query
+    portal_type = None
+    # annotation key where the fingerprints of the synced rows are stored
+    # (namespaced by adapter, see get_annotation_key)
+    fingerprints_key = "redturtle.rsync.fingerprints"
+    fingerprint_version = ""
+    # annotation key where the digests of the synced blob fields are stored
+    blob_digests_key = "redturtle.rsync.blob_digests"
+    # schema of the converted rows (see adapters/schema.py): invalid rows
+    # are rejected before they are handled
+    row_schema = None
+    # with get_delete_query, keep the orphans that are linked from other items
+    delete_check_linkintegrity = True
+    # log records kept in memory: the others are spilled to a temporary file
+    log_memory_records = 10000
+    # errors and warnings shown in the report when the log has been spilled
+    log_inline_records = 1000
+
     def __init__(self, context, request):
         self.context = context
         self.request = request
         self.options = None
-        self.logdata = []
+        self.logdata = LogStorage(threshold=self.log_memory_records)
         self.n_updated = 0
         self.n_created = 0
+        self.n_unchanged = 0
         self.n_items = 0
         self.n_todelete = 0
-        self.sync_uids = set()
+        self.n_invalid = 0
+        self.n_blobs_written = 0
+        self.n_blobs_skipped = 0
+        self.blob_bytes_written = 0
+        self.blob_bytes_skipped = 0
+        # uids of the created, updated and unchanged items
+        self.sync_uids = SyncUids()
+        # number of rows in the source, if known in advance (streaming mode)
+        self.source_total = None
+        self.lookup = None
+        self.fingerprints = None
+        # uid -> exists, for the stored fingerprints of the current batch
+        self.existing_uids = {}
+        self.assets = None
+        self.row_validator = None
+        # actions planned with --plan
+        self.plan = None
+        # keys of the rows removed from the source, set by --snapshot: only
+        # their items are deleted
+        self.removed_keys = None
+        # keys of the rows that could not be synced
+        self.failed_keys = set()
+        # file where the failed rows are appended (--dead-letter)
+        self.dead_letter = None
+        # set when the source is a dead-letter file: only its rows are synced
+        self.dead_letter_source = False
+        # set when the source can't be read completely
+        self.source_error = False
+        # version of the source URL (ETag or Last-Modified), set when it's read
+        self.source_version = None
+        # set when the sync is skipped with --skip-not-modified
+        self.source_not_modified = False
+        self.reindex_queue = ReindexQueue()
+        self.metrics = Metrics()
+        self.log_renderer = LogRenderer(
+            translate=api.portal.translate, autolink=self.autolink
+        )
         self.start = datetime.now()
         self.end = None
         self.send_log_template = None
+        self.log_details_url = ""
 
     def requests_retry_session(
         self,
@@ -70,6 +168,7 @@ class RsyncAdapterBase:
         status_forcelist=(500, 501, 502, 503, 504),
         timeout=5.0,
         session=None,
+        pool_maxsize=10,
     ):
         """
         https://dev.to/ssbozy/python-requests-with-retries-4p03
@@ -83,7 +182,9 @@ class RsyncAdapterBase:
             status_forcelist=status_forcelist,
         )
         # adapter = HTTPAdapter(max_retries=retry)
-        http_adapter = TimeoutHTTPAdapter(max_retries=retry, timeout=timeout)
+        http_adapter = TimeoutHTTPAdapter(
+            max_retries=retry, timeout=timeout, pool_maxsize=pool_maxsize
+        )
         session.mount("http://", http_adapter)
         session.mount("https://", http_adapter)
         return session
@@ -98,12 +199,7 @@ class RsyncAdapterBase:
         """
         Fix links in the text.
         """
-        return re.sub(
-            r"(https?://\S+|/\S+)",
-            r'<a href="\1">\1</a>',
-            text,
-            re.MULTILINE | re.DOTALL,
-        )
+        return autolink(text)
 
     def get_frontend_url(self, item):
         frontend_domain = api.portal.get_registry_record(
@@ -120,26 +216,70 @@ class RsyncAdapterBase:
     def log_info(self, msg, type="info", force_sys_log=False):
         """
         append a message to the logdata list and print it.
-
+        msg can be an i18n Message: it is translated only when the log is
+        rendered (or printed).
         """
-        style = ""
-        if type == "error":
-            style = "padding:2px;background-color:red;color:#fff"
-        if type == "warning":
-            style = "padding:2px;background-color:#ff9d00;color:#fff"
-        # msg = f"[{datetime.now().strftime('%d-%m-%Y %H:%M:%S')}] {msg}"
-        self.logdata.append(
-            f'<p><span style="{style}">[{datetime.now().strftime("%d-%m-%Y %H:%M:%S")}]</span>&nbsp;{self.autolink(msg)}</p>'
-        )
+        self.logdata.append(make_record(msg=msg, type=type))
 
         # print the message on standard output
         if type == "error":
-            logger.error(msg)
+            logger.error(self.log_renderer.translate(msg))
         elif type == "warning":
-            logger.warning(msg)
+            logger.warning(self.log_renderer.translate(msg))
         else:
             if self.options.verbose or force_sys_log:
-                logger.info(msg)
+                logger.info(self.log_renderer.translate(msg))
+
+    def render_log(self, details_url=""):
+        """
+        Return the log records rendered as HTML paragraphs.
+        Long logs (spilled to disk) are rendered only with their errors and
+        warnings, and a reference to the full log.
+        """
+        if not self.logdata.spilled:
+            return self.log_renderer.render_html(self.logdata)
+        alerts = itertools.islice(self.logdata.alerts(), self.log_inline_records)
+        html = self.log_renderer.render_html(alerts)
+        msg = _(
+            "log_details_msg",
+            default="${count} log messages: only errors and warnings are shown, the full log is in ${url}",
+            mapping={"count": len(self.logdata), "url": details_url or "-"},
+        )
+        html.append(self.log_renderer.html(make_record(msg=msg)))
+        return html
+
+    def write_log_details(self, logcontainer, title):
+        """
+        Store the full log in a File with gzipped NDJSON records.
+        """
+        return self.write_log_file(
+            logcontainer=logcontainer,
+            title=f"{title} - details",
+            lines=(self.log_renderer.json(record) + "\n" for record in self.logdata),
+        )
+
+    def write_log_file(self, logcontainer, title, lines):
+        """
+        Store the NDJSON lines in a gzipped File.
+        """
+        filename = f"{title}.ndjson.gz"
+        with tempfile.NamedTemporaryFile(suffix=".ndjson.gz", delete=False) as f:
+            with gzip.open(f, "wt", encoding="utf-8") as details:
+                details.writelines(lines)
+        try:
+            with open(f.name, "rb") as data:
+                return api.content.create(
+                    logcontainer,
+                    "File",
+                    title=title,
+                    file=NamedBlobFile(
+                        data=data, filename=filename, contentType="application/gzip"
+                    ),
+                )
+        finally:
+            # the blob consumes the file
+            if os.path.exists(f.name):
+                os.unlink(f.name)
 
     def get_log_container(self):
         logpath = getattr(self.options, "logpath", None)
@@ -161,17 +301,38 @@ class RsyncAdapterBase:
         logcontainer = self.get_log_container()
         if not logcontainer:
             return
-        description = f"{self.n_items} elementi trovati, {self.n_created} creati, {self.n_updated} aggiornati, {self.n_todelete} da eliminare"
+        description = f"{self.n_items} elementi trovati, {self.n_created} creati, {self.n_updated} aggiornati, {self.n_unchanged} invariati, {self.n_todelete} da eliminare"
+        if self.n_invalid:
+            description += f", {self.n_invalid} non validi"
+        if self.n_blobs_written or self.n_blobs_skipped:
+            description += f", {self.n_blobs_written} file scritti ({self.blob_bytes_written} byte), {self.n_blobs_skipped} file invariati ({self.blob_bytes_skipped} byte)"
+        title = self.log_item_title(start=self.start)
+        if self.plan is not None:
+            title = f"[PLAN] {title}"
+            diff = self.write_log_file(
+                logcontainer=logcontainer, title=f"{title} - diff", lines=self.plan
+            )
+            msg = _(
+                "plan_diff_msg",
+                default="Sync plan: the actions of each row are in ${url}",
+                mapping={"url": diff.absolute_url()},
+            )
+            self.log_info(msg=msg)
+        if self.logdata.spilled:
+            details = self.write_log_details(logcontainer=logcontainer, title=title)
+            self.log_details_url = details.absolute_url()
         blockid = str(uuid.uuid4())
         api.content.create(
             logcontainer,
             "Document",
-            title=self.log_item_title(start=self.start),
+            title=title,
             description=description,
             blocks={
                 blockid: {
                     "@type": "html",
-                    "html": "\n".join(self.logdata),
+                    "html": "\n".join(
+                        self.render_log(details_url=self.log_details_url)
+                    ),
                 }
             },
             blocks_layout={
@@ -198,7 +359,7 @@ class RsyncAdapterBase:
         body_view = api.content.get_view(
             name=self.send_log_template, context=self.context, request=self.request
         )
-        body = body_view(logs=self.logdata)
+        body = body_view(logs=self.render_log(details_url=self.log_details_url))
         encoding = api.portal.get_registry_record(
             "plone.email_charset", default="utf-8"
         )
@@ -237,52 +398,740 @@ class RsyncAdapterBase:
         """ """
         return
 
+    def get_row_key(self, row):
+        """
+        Return the external key of the given row, that is the value stored
+        in the lookup_key_index catalog index of the synced item.
+        Needed to use the lookup index.
+        """
+        raise NotImplementedError()
+
+    def has_row_key(self):
+        """
+        Return True if the adapter implements get_row_key.
+        """
+        return type(self).get_row_key is not RsyncAdapterBase.get_row_key
+
+    def get_lookup_query(self):
+        """
+        Catalog query that returns all the items handled by this adapter.
+        By default the items of get_delete_query, or the items of
+        portal_type in the adapter context.
+        """
+        query = self.get_delete_query()
+        if query is not None:
+            return query
+        query = {"path": "/".join(self.context.getPhysicalPath())}
+        if self.portal_type:
+            query["portal_type"] = self.portal_type
+        return query
+
+    def setup_lookup(self):
+        """
+        Create the lookup index if enabled with --lookup-index.
+        In "preload" mode all the keys are loaded with a single catalog
+        query, in "window" mode they are loaded in batches by prepare_batch.
+        """
+        mode = getattr(self.options, "lookup_index", None)
+        if not mode:
+            return
+        if not self.lookup_key_index:
+            logger.warning("No lookup_key_index defined, lookup index disabled.")
+            return
+        self.lookup = LookupIndex(mode=mode)
+        if mode == "preload":
+            self.load_lookup()
+            self.log_info(
+                msg=f"Lookup index loaded with {len(self.lookup)} keys.",
+                force_sys_log=True,
+            )
+
+    def load_lookup(self, keys=None):
+        """
+        Load into the lookup index the items with the given keys (or all the
+        items returned by get_lookup_query if keys is None).
+        Keys are read from the catalog index data, so the objects are never
+        woken up.
+        """
+        catalog = api.portal.get_tool(name="portal_catalog")
+        index = catalog.Indexes[self.lookup_key_index]
+        query = dict(self.get_lookup_query())
+        if keys is not None:
+            query[self.lookup_key_index] = list(keys)
+        for brain in catalog.unrestrictedSearchResults(**query):
+            key = index.getEntryForObject(brain.getRID())
+            if isinstance(key, (list, tuple)):
+                if keys is not None:
+                    key = [k for k in key if k in keys]
+                for k in key:
+                    self.lookup.add(k, uid=brain.UID, path=brain.getPath())
+            else:
+                self.lookup.add(key, uid=brain.UID, path=brain.getPath())
+
+    def prepare_batch(self, rows):
+        """
+        Called by the runner before handling each batch of rows
+        (see --batch-size).
+        """
+        if self.lookup is not None and self.lookup.mode == "window":
+            keys = self.get_batch_keys(rows)
+            self.lookup.clear()
+            if keys:
+                self.load_lookup(keys=keys)
+        if self.fingerprints is not None and self.lookup is None:
+            self.check_fingerprint_uids(keys=self.get_batch_keys(rows))
+
+    def get_batch_keys(self, rows):
+        keys = set()
+        for row in rows:
+            try:
+                key = self.get_row_key(row)
+            except Exception as e:
+                logger.exception(e)
+                continue
+            if key is not None:
+                keys.add(key)
+        return keys
+
+    def check_fingerprint_uids(self, keys):
+        """
+        Check with a single catalog query which items of the stored
+        fingerprints of the batch still exist (see uid_exists).
+        """
+        uids = set()
+        for key in keys:
+            stored = self.fingerprints.get(key)
+            if stored:
+                uids.add(stored[1])
+        self.existing_uids = dict.fromkeys(uids, False)
+        if not uids:
+            return
+        catalog = api.portal.get_tool(name="portal_catalog")
+        for brain in catalog.unrestrictedSearchResults(UID=list(uids)):
+            self.existing_uids[brain.UID] = True
+
+    def get_row_assets(self, row):
+        """
+        Return the URLs of the assets (images, attachments) referenced by the
+        row, to be downloaded before the row is handled. Then the adapter can
+        get them with get_asset.
+        """
+        return []
+
+    def setup_assets(self):
+        """
+        Create the asset cache in --asset-cache, or in a temporary directory
+        removed at the end of the sync.
+        """
+        workers = getattr(self.options, "asset_workers", 8)
+        self.assets = AssetCache(
+            directory=getattr(self.options, "asset_cache", None),
+            session=self.requests_retry_session(
+                retries=3, timeout=30.0, pool_maxsize=max(workers, 10)
+            ),
+            workers=workers,
+        )
+
+    def prefetch_assets(self, rows):
+        """
+        Called by the runner with the rows of the next batch: their assets
+        are downloaded in background while the current batch is handled.
+        """
+        urls = []
+        for row in rows:
+            try:
+                urls.extend(self.get_row_assets(row))
+            except Exception as e:
+                logger.exception(e)
+        if not urls:
+            return
+        if self.assets is None:
+            self.setup_assets()
+        self.assets.prefetch(urls)
+
+    def get_asset(self, url):
+        """
+        Return the downloaded Asset of the url (see get_row_assets):
+        asset.open() returns a file handle of its content.
+        """
+        if self.assets is None:
+            self.setup_assets()
+        return self.assets.get(url)
+
+    def close_assets(self):
+        if self.assets is None:
+            return
+        self.assets.close()
+        self.log_info(
+            msg=f"Assets: {self.assets.n_downloaded} downloaded ({self.assets.downloaded_bytes} bytes), {self.assets.n_cached} from cache.",
+            force_sys_log=True,
+        )
+        self.assets = None
+
+    def set_blob_field(
+        self, item, name, data, filename=None, content_type=None, image=False
+    ):
+        """
+        Set the blob field name of the item to a NamedBlobFile (or a
+        NamedBlobImage, with image) with data: bytes, a binary file or an
+        Asset (see get_asset).
+        The blob is written only if the digest of data differs from the one
+        stored on the last sync: unchanged blobs are kept, with their scales.
+        Return True if the blob has been written.
+        """
+        path = None
+        if isinstance(data, Asset):
+            digest, size = data.sha256, data.size
+            filename = filename or data.filename
+            content_type = content_type or data.content_type
+        elif isinstance(data, bytes):
+            digest, size = bytes_digest(data)
+        else:
+            path, digest, size = spool(data)
+        try:
+            current = getattr(item, name, None)
+            annotations = IAnnotations(item)
+            digests = annotations.get(self.blob_digests_key)
+            stored = digests.get(name) if digests is not None else None
+            if (
+                current is not None
+                and stored == (digest, size)
+                and current.getSize() == size
+            ):
+                # metadata can be fixed without writing the blob
+                if filename and current.filename != filename:
+                    current.filename = filename
+                if content_type and current.contentType != content_type:
+                    current.contentType = content_type
+                self.n_blobs_skipped += 1
+                self.blob_bytes_skipped += size
+                return False
+            if isinstance(data, Asset):
+                with data.open() as fp:
+                    path = spool(fp)[0]
+            factory = image and NamedBlobImage or NamedBlobFile
+            kwargs = {"filename": filename}
+            if content_type:
+                kwargs["contentType"] = content_type
+            if path is None:
+                blob = factory(data=data, **kwargs)
+            else:
+                # the spool file is consumed by the blob
+                with open(path, "rb") as fp:
+                    blob = factory(data=fp, **kwargs)
+            setattr(item, name, blob)
+            if digests is None:
+                digests = annotations[self.blob_digests_key] = PersistentMapping()
+            digests[name] = (digest, size)
+            self.n_blobs_written += 1
+            self.blob_bytes_written += size
+            return True
+        finally:
+            if path is not None and os.path.exists(path):
+                os.unlink(path)
+
+    def find_item_from_lookup(self, row):
+        """
+        Find the item using the lookup index.
+        Return _marker if the index can't be used for this row.
+        """
+        key = self.get_row_key(row)
+        if key is None:
+            return _marker
+        value = self.lookup.get(key)
+        if value is None:
+            return None
+        item = self.context.unrestrictedTraverse(value[1], None)
+        if item is None:
+            # the index is stale: fallback to the adapter lookup
+            return _marker
+        return item
+
+    def add_to_lookup(self, row, item):
+        """
+        Keep the lookup index updated with the new created items.
+        """
+        if self.lookup is None:
+            return
+        try:
+            key = self.get_row_key(row)
+        except Exception as e:
+            logger.exception(e)
+            return
+        self.lookup.add(key, uid=item.UID(), path="/".join(item.getPhysicalPath()))
+
+    def reindex_item(self, item, idxs=None):
+        """
+        Reindex the item, or queue it with --deferred-reindex.
+        Adapters should call this instead of item.reindexObject().
+        """
+        if not getattr(self.options, "deferred_reindex", None):
+            item.reindexObject(idxs=idxs or [])
+            return
+        self.reindex_queue.add(item=item, idxs=idxs)
+
+    def flush_reindex(self):
+        """
+        Reindex the items queued with --deferred-reindex.
+        """
+        if not len(self.reindex_queue):
+            return
+        with self.metrics.timer("reindex"):
+            self.reindex_queue.flush(context=self.context)
+
+    def get_state(self):
+        """
+        Return the state of the counters and the log, to restore it if a
+        transaction is aborted and its rows are replayed.
+        """
+        state = {
+            "n_created": self.n_created,
+            "n_updated": self.n_updated,
+            "n_unchanged": self.n_unchanged,
+            "n_todelete": self.n_todelete,
+            "n_invalid": self.n_invalid,
+            "n_blobs_written": self.n_blobs_written,
+            "n_blobs_skipped": self.n_blobs_skipped,
+            "blob_bytes_written": self.blob_bytes_written,
+            "blob_bytes_skipped": self.blob_bytes_skipped,
+            "logdata": len(self.logdata),
+        }
+        if self.dead_letter is not None:
+            state["dead_letter"] = (self.dead_letter.tell(), self.dead_letter.n_rows)
+        return state
+
+    def reset(self):
+        """
+        Reset the state of the sync, to run it again.
+        """
+        options = self.options
+        self.__init__(self.context, self.request)
+        self.options = options
+
+    def restore_state(self, state):
+        for name, value in state.items():
+            if name == "logdata":
+                self.logdata.truncate(value)
+            elif name == "dead_letter":
+                self.dead_letter.truncate(value[0])
+                self.dead_letter.n_rows = value[1]
+            else:
+                setattr(self, name, value)
+
+    def get_source_identity(self):
+        """
+        Return a string that identifies the source data, used to resume a
+        sync only on the same source.
+        Source URLs are identified by their ETag or Last-Modified header,
+        known after the source has been read: without them (or before)
+        return None, as the content could change between the runs.
+        """
+        if getattr(self.options, "source_path", None):
+            file_path = Path(self.options.source_path)
+            if file_path.exists():
+                stat = file_path.stat()
+                return f"{file_path.resolve()}:{stat.st_size}:{int(stat.st_mtime)}"
+            return str(file_path)
+        url = getattr(self.options, "source_url", None)
+        if not url:
+            return ""
+        if not self.source_version:
+            return None
+        return f"{url}:{self.source_version}"
+
+    def set_source_version(self, headers):
+        self.source_version = headers.get("ETag") or headers.get("Last-Modified")
+
     def get_data(self):
         """ """
+        if getattr(self.options, "stream", False):
+            return self.get_data_stream()
         try:
             data = self.do_get_data()
         except Exception as e:
             logger.exception(e)
+            self.source_error = True
             msg = f"Error in data generation: {e}"
             self.log_info(msg=msg, type="error")
             return []
         if not data:
-            msg = "No data to sync."
-            self.log_info(msg=msg, type="info", force_sys_log=True)
+            if not self.source_not_modified:
+                msg = "No data to sync."
+                self.log_info(msg=msg, type="info", force_sys_log=True)
             return []
         return data
 
+    def get_data_stream(self):
+        """
+        Return an iterator over the source rows, read lazily from the source.
+        """
+        try:
+            rows = iter(self.do_iter_data())
+            first = next(rows, _marker)
+        except Exception as e:
+            logger.exception(e)
+            self.source_error = True
+            msg = f"Error in data generation: {e}"
+            self.log_info(msg=msg, type="error")
+            return []
+        if first is _marker:
+            if not self.source_not_modified:
+                msg = "No data to sync."
+                self.log_info(msg=msg, type="info", force_sys_log=True)
+            return []
+        rows = itertools.chain([first], rows)
+        if is_dead_letter(first):
+            data = self.read_dead_letter(records=rows)
+        else:
+            data = self.iter_data(rows=rows)
+        if getattr(self.options, "pipeline", False):
+            # the rows are read in a background thread, that must not log:
+            # errors are handled by the consumer (see guard_source)
+            return data
+        return self.guard_source(data)
+
+    def iter_data(self, rows):
+        """
+        Convert the rows while they are consumed.
+        """
+        return convert_rows(
+            adapter=self,
+            rows=rows,
+            batch_size=getattr(self.options, "batch_size", 100) or 100,
+            workers=getattr(self.options, "convert_workers", 0) or 0,
+        )
+
+    def guard_source(self, data):
+        """
+        Errors raised reading the source stop the iteration and are logged.
+        """
+        try:
+            yield from data
+        except Exception as e:
+            logger.exception(e)
+            self.source_error = True
+            msg = f"Error in data generation: {e}"
+            self.log_info(msg=msg, type="error")
+
+    def get_data_total(self, data):
+        """
+        Return the number of rows to sync, or None if it is not known.
+        """
+        if hasattr(data, "__len__"):
+            return len(data)
+        return self.source_total
+
     def convert_source_data(self, data):
         """
         If needed, convert the source data to a format that can be used by the rsync command.
         """
         return data, None
 
+    def convert_source_row(self, row):
+        """
+        If needed, convert a single source row (streaming mode).
+        """
+        return row
+
+    def convert_rows(self, batch):
+        """
+        Convert a batch of source rows (streaming mode), returning the
+        converted rows in the same order.
+        With --convert-workers it runs in other processes, on an adapter
+        created without context and request: it must not access the site,
+        and rows and results must be picklable.
+        """
+        return [self.convert_source_row(row) for row in batch]
+
+    def read_dead_letter(self, records):
+        """
+        Return the rows of a dead-letter file used as source: they are
+        stored as they were converted, so they are not converted again.
+        """
+        self.dead_letter_source = True
+        self.log_info(
+            msg="The source is a dead-letter file: only its rows are synced and the delete phase is skipped.",
+            force_sys_log=True,
+        )
+        return (record["row"] for record in records)
+
+    def get_row_validator(self):
+        """
+        Return the row_schema compiled into a function that returns the
+        errors of a row, or None if there is no schema.
+        """
+        if self.row_validator is None and self.row_schema:
+            self.row_validator = compile_schema(self.row_schema)
+        return self.row_validator
+
+    def validate_rows(self, batch):
+        """
+        Validate a batch of converted rows: the invalid ones are replaced by
+        an InvalidRow with their errors.
+        With --convert-workers it runs in the worker processes (see
+        convert_rows).
+        """
+        validator = self.get_row_validator()
+        if validator is None:
+            return batch
+        rows = []
+        for row in batch:
+            try:
+                errors = validator(row)
+            except Exception as e:
+                errors = [str(e)]
+            rows.append(InvalidRow(row=row, errors=errors) if errors else row)
+        return rows
+
+    def validate_batch(self, batch):
+        """
+        Validation stage, called by the runner for each batch of rows before
+        they are handled.
+        """
+        if self.get_row_validator() is None:
+            return batch
+        if getattr(self.options, "convert_workers", 0) and not self.dead_letter_source:
+            # already validated by the workers
+            return batch
+        with self.metrics.timer("validate"):
+            return self.validate_rows(batch)
+
+    def reject_row(self, invalid):
+        """
+        Log an invalid row, that is not synced: its item, if any, is kept by
+        the delete phase.
+        """
+        self.n_invalid += 1
+        msg = _(
+            "reject_row_msg",
+            default="[INVALID] ${row}: ${errors}",
+            mapping={"row": invalid.row, "errors": "; ".join(invalid.errors)},
+        )
+        self.log_info(msg=msg, type="error")
+        self.mark_failed(row=invalid.row, phase="validate", error=invalid.errors)
+        # the row is still in the source: its item must not be deleted
+        try:
+            key = self.get_row_key(invalid.row)
+        except Exception:
+            return
+        if key is None:
+            return
+        if self.lookup is not None:
+            value = self.lookup.get(key)
+            if value is not None:
+                self.sync_uids.add(value[0])
+        elif self.lookup_key_index:
+            catalog = api.portal.get_tool(name="portal_catalog")
+            query = dict(self.get_lookup_query())
+            query[self.lookup_key_index] = key
+            for brain in catalog.unrestrictedSearchResults(**query):
+                self.sync_uids.add(brain.UID)
+
     def find_item_from_row(self, row):
         """
         Find the item in the context from the given row of data.
         This method should be implemented by subclasses to find the specific type of content item.
         """
         try:
+            if self.lookup is not None:
+                item = self.find_item_from_lookup(row=row)
+                if item is not _marker:
+                    return item
             return self.do_find_item_from_row(row=row)
         except Exception as e:
             logger.exception(e)
-            msg = api.portal.translate(
-                _(
-                    "find_item_error_msg",
-                    default="[ERROR] Unable to find item from row ${row}: ${e}",
-                    mapping={"row": row, "e": str(e)},
-                )
+            msg = _(
+                "find_item_error_msg",
+                default="[ERROR] Unable to find item from row ${row}: ${e}",
+                mapping={"row": row, "e": str(e)},
             )
             self.log_info(msg=msg, type="error")
             return None
 
     def create_or_update_item(self, row):
-        item = self.find_item_from_row(row=row)
+        fingerprint = None
+        if self.fingerprints is not None:
+            fingerprint = self.get_row_fingerprint(row=row)
+            if self.is_row_unchanged(row=row, fingerprint=fingerprint):
+                self.n_unchanged += 1
+                return
+        with self.metrics.timer("lookup"):
+            item = self.find_item_from_row(row=row)
         if not item:
-            self.create_item(row=row)
+            with self.metrics.timer("create_item"):
+                res = self.create_item(row=row)
+        else:
+            with self.metrics.timer("update_item"):
+                res = self.update_item(item=item, row=row)
+        if getattr(self.options, "deferred_reindex", None):
+            # also the items indexed by api.content.create or by events
+            self.reindex_queue.take_catalog_queue()
+        if fingerprint and res:
+            self.store_fingerprint(row=row, item=res, fingerprint=fingerprint)
+
+    def get_annotation_key(self, key):
+        """
+        Return the portal annotation key namespaced by adapter, so the
+        adapters of the same site don't share their fingerprints, checkpoints
+        and shard results.
+        """
+        cls = type(self)
+        return f"{key}.{cls.__module__}.{cls.__qualname__}"
+
+    def setup_fingerprints(self):
+        """
+        Load the fingerprints of the synced rows if enabled with --fingerprints.
+        Fingerprints are stored in a BTree in the portal annotations, keyed by
+        row key (see get_row_key), so they can be checked without loading the
+        items.
+        """
+        annotations = IAnnotations(api.portal.get())
+        key = self.get_annotation_key(self.fingerprints_key)
+        if self.plan is not None:
+            # read only: rows are unchanged if they have been already synced
+            self.fingerprints = annotations.get(key)
+            return
+        if not getattr(self.options, "fingerprints", False):
+            return
+        if key not in annotations:
+            annotations[key] = OOBTree()
+        self.fingerprints = annotations[key]
+
+    def setup_dead_letter(self):
+        """
+        With --dead-letter, the rows that fail are appended to that file.
+        Nothing is written with --plan, that only reports the invalid rows.
+        """
+        path = getattr(self.options, "dead_letter", None)
+        if path and self.plan is None:
+            self.dead_letter = DeadLetter(path=path)
+
+    def close_dead_letter(self):
+        if self.dead_letter is None:
+            return
+        self.dead_letter.close()
+        if self.dead_letter.n_rows:
+            self.log_info(
+                msg=f"Dead letter: {self.dead_letter.n_rows} failed rows appended to {self.dead_letter.path}.",
+                type="warning",
+            )
+
+    def setup_plan(self):
+        """
+        With --plan, rows are only classified by plan_item.
+        """
+        if getattr(self.options, "plan", False):
+            self.plan = Plan()
+
+    def plan_item(self, row):
+        """
+        Classify the row as create, update or unchanged with the lookup index
+        and the stored fingerprints, without loading its item.
+        """
+        try:
+            key = self.get_row_key(row)
+        except Exception as e:
+            logger.exception(e)
+            key = None
+        value = self.lookup.get(key) if key is not None else None
+        if value is None:
+            self.n_created += 1
+            self.plan.add(action="create", key=key)
+            return
+        uid, path = value
+        self.sync_uids.add(uid)
+        if self.fingerprints is not None and self.is_row_unchanged(
+            row=row, fingerprint=self.get_row_fingerprint(row=row)
+        ):
+            self.n_unchanged += 1
+            self.plan.add(action="unchanged", key=key, uid=uid, path=path)
         else:
-            self.update_item(item=item, row=row)
+            # without a fingerprint, the item could be unchanged too
+            self.n_updated += 1
+            self.plan.add(action="update", key=key, uid=uid, path=path)
+
+    def plan_deletes(self):
+        """
+        Add to the plan the items that the default delete phase would delete.
+        """
+        query = self.get_delete_query()
+        if query is None:
+            self.log_info(
+                msg="Deletes can't be planned: the adapter has no delete query.",
+                type="warning",
+            )
+            return
+        orphans, total = self.find_orphans(query=query)
+        if not orphans or self.exceeds_max_delete(n_orphans=len(orphans), total=total):
+            return
+        for path, uid in sorted(orphans.items()):
+            self.plan.add(action="delete", uid=uid, path=path)
+        self.n_todelete += len(orphans)
+
+    def get_row_fingerprint(self, row):
+        """
+        Return a stable hash of the row.
+        Override to ignore volatile fields, or bump fingerprint_version when
+        the adapter changes how rows are written.
+        """
+        return row_fingerprint(row=row, salt=self.fingerprint_version)
+
+    def is_row_unchanged(self, row, fingerprint):
+        """
+        Check if the row has been already synced with the same fingerprint.
+        """
+        try:
+            key = self.get_row_key(row)
+        except Exception as e:
+            logger.exception(e)
+            return False
+        stored = self.fingerprints.get(key)
+        if not stored or stored[0] != fingerprint:
+            return False
+        # the item could have been removed after last sync
+        if self.lookup is not None:
+            value = self.lookup.items.get(key)
+            if value is None or value[0] != stored[1]:
+                return False
+        elif not self.uid_exists(stored[1]):
+            return False
+        self.sync_uids.add(stored[1])
+        return True
+
+    def uid_exists(self, uid):
+        exists = self.existing_uids.get(uid)
+        if exists is not None:
+            # checked for the whole batch by prepare_batch
+            return exists
+        catalog = api.portal.get_tool(name="portal_catalog")
+        return bool(catalog.unrestrictedSearchResults(UID=uid))
+
+    def purge_fingerprints(self, uids):
+        """
+        Remove the fingerprints of the deleted items.
+        """
+        if self.fingerprints is None or not uids:
+            return
+        uids = set(uids)
+        keys = [key for key, value in self.fingerprints.items() if value[1] in uids]
+        for key in keys:
+            del self.fingerprints[key]
+
+    def store_fingerprint(self, row, item, fingerprint):
+        if isinstance(item, list):
+            if not item:
+                return
+            item = item[0]
+        try:
+            key = self.get_row_key(row)
+        except Exception as e:
+            logger.exception(e)
+            return
+        if key is None:
+            return
+        stored = (fingerprint, item.UID())
+        if self.fingerprints.get(key) != stored:
+            self.fingerprints[key] = stored
 
     def create_item(self, row):
         """
@@ -291,50 +1140,66 @@ class RsyncAdapterBase:
         try:
             res = self.do_create_item(row=row)
         except Exception as e:
-            msg = api.portal.translate(
-                _(
-                    "create_item_error_msg",
-                    default="[ERROR] Unable to create item ${row}: ${e}",
-                    mapping={"row": row, "e": str(e)},
-                )
+            msg = _(
+                "create_item_error_msg",
+                default="[ERROR] Unable to create item ${row}: ${e}",
+                mapping={"row": row, "e": str(e)},
             )
             self.log_info(msg=msg, type="error")
+            self.mark_failed(row=row, phase="create", error=e)
             return
         if not res:
-            msg = api.portal.translate(
-                _(
-                    "create_item_skip_msg",
-                    default="[SKIP] Item ${row} not created.",
-                    mapping={"row": row},
-                )
+            msg = _(
+                "create_item_skip_msg",
+                default="[SKIP] Item ${row} not created.",
+                mapping={"row": row},
             )
             self.log_info(msg=msg)
             return
 
         # adapter could create a list of items (maybe also children or related items)
         if isinstance(res, list):
+            if res:
+                self.add_to_lookup(row=row, item=res[0])
             self.n_created += len(res)
             for item in res:
-                msg = api.portal.translate(
-                    _(
-                        "create_item_success_msg",
-                        default="[CREATED] ${path}",
-                        mapping={"path": "/".join(item.getPhysicalPath())},
-                    )
+                self.sync_uids.add(item.UID())
+                msg = _(
+                    "create_item_success_msg",
+                    default="[CREATED] ${path}",
+                    mapping={"path": "/".join(item.getPhysicalPath())},
                 )
                 self.log_info(msg=msg)
         else:
+            self.add_to_lookup(row=row, item=res)
+            self.sync_uids.add(res.UID())
             self.n_created += 1
-            msg = api.portal.translate(
-                _(
-                    "create_item_success_msg",
-                    default="[CREATED] ${path}",
-                    mapping={"path": "/".join(res.getPhysicalPath())},
-                )
+            msg = _(
+                "create_item_success_msg",
+                default="[CREATED] ${path}",
+                mapping={"path": "/".join(res.getPhysicalPath())},
             )
             self.log_info(msg=msg)
         return res
 
+    def mark_failed(self, row, phase=None, error=None):
+        """
+        Keep track of the rows that could not be synced, so they are synced
+        again by the next run with --snapshot, and append them to the
+        --dead-letter file.
+        """
+        try:
+            key = self.get_row_key(row)
+        except Exception:
+            key = None
+        if key is not None:
+            self.failed_keys.add(key)
+        if self.dead_letter is not None and phase:
+            try:
+                self.dead_letter.add(row=row, phase=phase, error=error, key=key)
+            except Exception as e:
+                logger.exception(e)
+
     def update_item(self, item, row):
         """
         Handle update of the item.
@@ -342,77 +1207,75 @@ class RsyncAdapterBase:
         try:
             res = self.do_update_item(item=item, row=row)
         except Exception as e:
-            msg = api.portal.translate(
-                _(
-                    "update_item_error_msg",
-                    default="[ERROR] Unable to update item ${path}: ${e}",
-                    mapping={"path": "/".join(item.getPhysicalPath()), "e": str(e)},
-                )
+            msg = _(
+                "update_item_error_msg",
+                default="[ERROR] Unable to update item ${path}: ${e}",
+                mapping={"path": "/".join(item.getPhysicalPath()), "e": str(e)},
             )
             self.log_info(msg=msg, type="error")
+            self.mark_failed(row=row, phase="update", error=e)
+            # the item is still in the source: it must not be deleted
+            self.sync_uids.add(item.UID())
             return
 
         if not res:
-            msg = api.portal.translate(
-                _(
-                    "update_item_skip_msg",
-                    default="[SKIP] ${path}",
-                    mapping={"path": "/".join(item.getPhysicalPath())},
-                )
+            msg = _(
+                "update_item_skip_msg",
+                default="[SKIP] ${path}",
+                mapping={"path": "/".join(item.getPhysicalPath())},
             )
             self.log_info(msg=msg)
-            return
+            self.sync_uids.add(item.UID())
+            # nothing to update, but the item is in sync
+            return item
 
         if isinstance(res, list):
             self.n_updated += len(res)
             for updated in res:
-                msg = api.portal.translate(
-                    _(
-                        "update_item_success_msg",
-                        default="[UPDATE] ${path}",
-                        mapping={"path": "/".join(updated.getPhysicalPath())},
-                    )
-                )
-                self.log_info(msg=msg)
-                self.sync_uids.add(updated.UID())
-        else:
-            self.n_updated += 1
-            msg = api.portal.translate(
-                _(
+                msg = _(
                     "update_item_success_msg",
                     default="[UPDATE] ${path}",
-                    mapping={"path": "/".join(item.getPhysicalPath())},
+                    mapping={"path": "/".join(updated.getPhysicalPath())},
                 )
-            )
-            self.log_info(msg=msg)
-            self.sync_uids.add(item.UID())
+                self.log_info(msg=msg)
+                self.sync_uids.add(updated.UID())
+            return res
+        self.n_updated += 1
+        msg = _(
+            "update_item_success_msg",
+            default="[UPDATE] ${path}",
+            mapping={"path": "/".join(item.getPhysicalPath())},
+        )
+        self.log_info(msg=msg)
+        self.sync_uids.add(item.UID())
+        # do_update_item can return any true value
+        return item
 
     def delete_items(self, data):
         """
         See if there are items to delete.
         """
-        res = self.do_delete_items(data=data)
+        if self.removed_keys is not None:
+            res = self.delete_removed_rows(keys=self.removed_keys)
+        else:
+            res = self.do_delete_items(data=data)
         if not res:
             return
         if isinstance(res, list):
             self.n_todelete += len(res)
             for item in res:
-                msg = api.portal.translate(
-                    _(
-                        "delete_item_success_msg",
-                        default="[DELETE] ${item}",
-                        mapping={"item": item},
-                    )
+                msg = _(
+                    "delete_item_success_msg",
+                    default="[DELETE] ${item}",
+                    mapping={"item": item},
                 )
                 self.log_info(msg=msg)
         else:
             self.n_todelete += 1
-            msg = api.portal.translate(
-                _(
-                    "delete_item_success_msg",
-                    default="[DELETE] ${item}",
-                    mapping={"item": res},
-                )
+            msg = _(
+                "delete_item_success_msg",
+                default="[DELETE] ${item}",
+                mapping={"item": res},
             )
             self.log_info(msg=msg)
 
@@ -428,16 +1291,25 @@ class RsyncAdapterBase:
         if getattr(self.options, "source_path", None):
             file_path = Path(self.options.source_path)
             if file_path.exists() and file_path.is_file():
-                with open(file_path, "r") as f:
-                    try:
-                        data = json.load(f)
-                    except json.JSONDecodeError:
-                        data = f.read()
+                with open(file_path, "rb") as f:
+                    data = self.read_source(fp=f, name=file_path.name, try_json=True)
             else:
                 self.log_info(
                     msg=f"Source file not found in: {file_path}", type="warning"
                 )
                 return
+        elif getattr(self.options, "source_pages", False):
+            data = list(self.get_paged_source())
+        elif getattr(self.options, "source_cache", None):
+            source = self.fetch_source_url()
+            if source is None:
+                return
+            with source.open() as f:
+                data = self.read_source(
+                    fp=f,
+                    name=urlparse(self.options.source_url).path,
+                    content_type=source.content_type,
+                )
         elif getattr(self.options, "source_url", None):
             http = self.requests_retry_session(retries=7, timeout=30.0)
             response = http.get(self.options.source_url)
@@ -447,16 +1319,155 @@ class RsyncAdapterBase:
                     type="warning",
                 )
                 return
-            if "application/json" in response.headers.get("Content-Type", ""):
-                try:
-                    data = response.json()
-                except ValueError:
-                    data = response.content
-            else:
-                data = response.content
+            self.set_source_version(response.headers)
+            data = self.read_source(
+                fp=io.BytesIO(response.content),
+                name=urlparse(self.options.source_url).path,
+                content_type=response.headers.get("Content-Type", ""),
+            )
 
+        if isinstance(data, list) and data and is_dead_letter(data[0]):
+            return list(self.read_dead_letter(records=data))
         return self.convert_source_data(data)
 
+    def get_paged_source(self):
+        """
+        Return the rows of a paged source URL (--source-pages), fetched
+        concurrently by --page-workers threads over a shared session.
+        """
+        workers = getattr(self.options, "page_workers", 4)
+        return PagedSource(
+            session=self.requests_retry_session(
+                retries=7, timeout=30.0, pool_maxsize=max(workers, 10)
+            ),
+            url=self.options.source_url,
+            workers=workers,
+            page_size=getattr(self.options, "page_size", None),
+            offset_param=getattr(self.options, "page_offset_param", "b_start"),
+            limit_param=getattr(self.options, "page_limit_param", "b_size"),
+        )
+
+    def fetch_source_url(self):
+        """
+        Download the source URL in the --source-cache directory, only if it
+        has changed since the last download.
+        Return the CachedSource, or None if it has not changed and
+        --skip-not-modified is set.
+        """
+        cache = SourceCache(
+            directory=self.options.source_cache,
+            session=self.requests_retry_session(retries=7, timeout=30.0),
+        )
+        source = cache.fetch(self.options.source_url)
+        self.source_version = source.meta.get("etag") or source.meta.get(
+            "last_modified"
+        )
+        if not source.not_modified:
+            return source
+        self.log_info(
+            msg=f"Source not modified since the last download: {source.identity}",
+            force_sys_log=True,
+        )
+        if getattr(self.options, "skip_not_modified", False):
+            self.source_not_modified = True
+            return None
+        return source
+
+    def read_source(self, fp, name="", content_type="", try_json=False):
+        """
+        Read the whole source from a binary stream.
+        Sources in a known format (explicitly set with --source-format or
+        guessed from the name/content type) are decoded into a list of rows,
+        JSON sources are loaded as they are and anything else is returned
+        as it is.
+        """
+        fp = open_source_stream(
+            fp,
+            name=name,
+            content_type=content_type,
+            compression=getattr(self.options, "source_compression", None),
+            sniff=False,
+        )
+        source_format = getattr(self.options, "source_format", None) or guess_format(
+            fp, name=name, content_type=content_type, sniff=False
+        )
+        if source_format and source_format != "json":
+            return list(iter_rows(fp, source_format=source_format))
+        raw = fp.read()
+        if source_format == "json" or try_json:
+            try:
+                return json.loads(raw)
+            except ValueError:
+                pass
+        if try_json:
+            return raw.decode("utf-8", errors="replace")
+        return raw
+
+    def do_iter_data(self):
+        """
+        Yield the source rows one at a time, without loading the whole
+        source in memory (streaming mode).
+        """
+        if getattr(self.options, "source_path", None):
+            file_path = Path(self.options.source_path)
+            if not (file_path.exists() and file_path.is_file()):
+                self.log_info(
+                    msg=f"Source file not found in: {file_path}", type="warning"
+                )
+                return
+            with open(file_path, "rb") as f:
+                yield from self.iter_source_rows(fp=f, name=file_path.name)
+        elif getattr(self.options, "source_pages", False):
+            yield from self.get_paged_source()
+        elif getattr(self.options, "source_cache", None):
+            source = self.fetch_source_url()
+            if source is None:
+                return
+            with source.open() as f:
+                yield from self.iter_source_rows(
+                    fp=f,
+                    name=urlparse(self.options.source_url).path,
+                    content_type=source.content_type,
+                )
+        elif getattr(self.options, "source_url", None):
+            http = self.requests_retry_session(retries=7, timeout=30.0)
+            with http.get(self.options.source_url, stream=True) as response:
+                if response.status_code != 200:
+                    self.log_info(
+                        msg=f"Error getting data from {self.options.source_url}: {response.status_code}",
+                        type="warning",
+                    )
+                    return
+                self.set_source_version(response.headers)
+                # transparently handle Content-Encoding (gzip, deflate)
+                response.raw.decode_content = True
+                # the decoders read until the end of the stream, closed by
+                # urllib3 when the content is consumed
+                response.raw.auto_close = False
+                yield from self.iter_source_rows(
+                    fp=response.raw,
+                    name=urlparse(self.options.source_url).path,
+                    content_type=response.headers.get("Content-Type", ""),
+                )
+
+    def iter_source_rows(self, fp, name="", content_type=""):
+        """
+        Yield the rows decoded from an open binary stream.
+        Compression and format are taken from --source-compression and
+        --source-format, or guessed from the name extension, the content
+        type and the first bytes of the stream.
+        """
+        fp = open_source_stream(
+            fp,
+            name=name,
+            content_type=content_type,
+            compression=getattr(self.options, "source_compression", None),
+        )
+        source_format = getattr(self.options, "source_format", None) or guess_format(
+            fp, name=name, content_type=content_type
+        )
+        return iter_rows(fp, source_format=source_format)
+
     def do_find_item_from_row(self, row):
         raise NotImplementedError()
 
@@ -474,11 +1485,117 @@ class RsyncAdapterBase:
         """
         raise NotImplementedError()
 
+    def get_delete_query(self):
+        """
+        Catalog query that returns all the items that this adapter keeps in
+        sync (and only them: e.g. filter by portal_type or depth, to leave
+        out their containers). The items not synced in this run are deleted.
+        If None, adapters must implement do_delete_items.
+        """
+        return None
+
+    def find_orphans(self, query):
+        """
+        Return a dict {path: uid} of the items returned by query that have
+        not been synced, and the number of items returned by query.
+        """
+        catalog = api.portal.get_tool(name="portal_catalog")
+        brains = catalog.unrestrictedSearchResults(**query)
+        context_path = "/".join(self.context.getPhysicalPath())
+        orphans = {}
+        for brain in brains:
+            path = brain.getPath()
+            if brain.UID not in self.sync_uids and path != context_path:
+                orphans[path] = brain.UID
+        return orphans, len(brains)
+
+    def exceeds_max_delete(self, n_orphans, total):
+        max_delete = getattr(self.options, "max_delete", None)
+        if not exceeds_max_delete(
+            n_orphans=n_orphans, total=total, max_delete=max_delete
+        ):
+            return False
+        msg = _(
+            "delete_items_max_msg",
+            default="[ERROR] ${n} items to delete out of ${total}, more than --max-delete ${max}: nothing has been deleted.",
+            mapping={"n": n_orphans, "total": total, "max": max_delete},
+        )
+        self.log_info(msg=msg, type="error")
+        return True
+
+    def delete_orphans(self, query):
+        """
+        Delete the items returned by query that have not been created,
+        updated or found unchanged in this run (see sync_uids), with a
+        single catalog query and a single delete call for each container.
+        Return the deleted paths.
+        """
+        orphans, total = self.find_orphans(query=query)
+        return self.delete_paths(paths=orphans, total=total)
+
+    def delete_removed_rows(self, keys):
+        """
+        Delete the items of the rows removed from the source (--snapshot),
+        found in the lookup_key_index catalog index.
+        Return the deleted paths.
+        """
+        if not keys:
+            return []
+        if not self.lookup_key_index:
+            self.log_info(
+                msg=f"{len(keys)} rows removed from the source, but they can't be deleted without a lookup_key_index.",
+                type="warning",
+            )
+            return []
+        catalog = api.portal.get_tool(name="portal_catalog")
+        query = dict(self.get_lookup_query())
+        total = len(catalog.unrestrictedSearchResults(**query))
+        paths = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 1000):
+            end = start + 1000
+            query[self.lookup_key_index] = keys[start:end]
+            for brain in catalog.unrestrictedSearchResults(**query):
+                paths[brain.getPath()] = brain.UID
+        paths.pop("/".join(self.context.getPhysicalPath()), None)
+        return self.delete_paths(paths=paths, total=total)
+
+    def delete_paths(self, paths, total):
+        """
+        Delete the items of the given {path: uid} dict (out of total items in
+        the scope of the adapter), with a single delete call for each
+        container, and their fingerprints.
+        Return the deleted paths.
+        """
+        if not paths or self.exceeds_max_delete(n_orphans=len(paths), total=total):
+            return []
+        paths = dict(paths)
+        if self.delete_check_linkintegrity:
+            for path, sources in sorted(linked_orphans(paths).items()):
+                msg = _(
+                    "delete_item_linked_msg",
+                    default="[SKIP] ${path} not deleted, it is linked from: ${sources}",
+                    mapping={"path": path, "sources": ", ".join(sorted(sources))},
+                )
+                self.log_info(msg=msg, type="warning")
+                paths.pop(path, None)
+        if not getattr(self.options, "dry_run", False):
+            for parent_path, ids in group_by_parent(paths).items():
+                parent = self.context.unrestrictedTraverse(parent_path)
+                parent.manage_delObjects(ids)
+            self.purge_fingerprints(uids=paths.values())
+        return sorted(paths)
+
     def do_delete_items(self, data):
         """
-        Delete items
+        Delete items.
+        By default, delete the items of get_delete_query that have not been
+        synced.
         """
-        raise NotImplementedError()
+        query = self.get_delete_query()
+        if query is None:
+            raise NotImplementedError()
+        return self.delete_orphans(query=query)
 
     def end_actions(self, data=None):
         """
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Download the assets (images, attachments) referenced by the rows in
+background threads, before the rows are handled.
+
+Downloaded files are stored in a content-addressed cache: every URL is
+fetched once, and files with the same content are stored once.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Asset:
+    """
+    A downloaded asset.
+    """
+
+    def __init__(self, url, path, sha256, size, content_type="", filename=""):
+        self.url = url
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        self.content_type = content_type
+        self.filename = filename
+
+    def open(self):
+        return open(self.path, "rb")
+
+
+class AssetCache:
+    """
+    Download assets with a pool of workers.
+
+    URLs are indexed in <directory>/urls, contents are stored in
+    <directory>/blobs by their sha256.
+    """
+
+    def __init__(self, directory=None, session=None, workers=8):
+        self.temporary = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="redturtle.rsync.assets.")
+        self.directory = directory
+        self.session = session
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="redturtle.rsync.assets"
+        )
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.n_downloaded = 0
+        self.n_cached = 0
+        self.downloaded_bytes = 0
+        os.makedirs(os.path.join(directory, "urls"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+
+    def url_path(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "urls", f"{key}.json")
+
+    def blob_path(self, sha256):
+        return os.path.join(self.directory, "blobs", sha256[:2], sha256)
+
+    def prefetch(self, urls):
+        """
+        Start the download of the urls that are not in the cache.
+        """
+        for url in urls:
+            if url:
+                self.submit(url)
+
+    def submit(self, url):
+        with self.lock:
+            future = self.futures.get(url)
+            if future is None:
+                future = self.futures[url] = self.executor.submit(self.fetch, url)
+            return future
+
+    def get(self, url):
+        """
+        Return the Asset of the url, waiting for its download.
+        """
+        return self.submit(url).result()
+
+    def load(self, url):
+        path = self.url_path(url)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        blob_path = self.blob_path(data["sha256"])
+        if data.get("url") != url or not os.path.exists(blob_path):
+            return None
+        return Asset(path=blob_path, **data)
+
+    def fetch(self, url):
+        asset = self.load(url)
+        if asset is not None:
+            with self.lock:
+                self.n_cached += 1
+            return asset
+        sha256 = hashlib.sha256()
+        size = 0
+        with self.session.get(url, stream=True) as response:
+            response.raise_for_status()
+            with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            content_type = response.headers.get("Content-Type", "")
+        digest = sha256.hexdigest()
+        blob_path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if os.path.exists(blob_path):
+            # same content from another url
+            os.unlink(f.name)
+        else:
+            os.replace(f.name, blob_path)
+        data = {
+            "url": url,
+            "sha256": digest,
+            "size": size,
+            "content_type": content_type,
+            "filename": os.path.basename(unquote(urlparse(url).path)),
+        }
+        with open(self.url_path(url), "w") as index:
+            json.dump(data, index)
+        with self.lock:
+            self.n_downloaded += 1
+            self.downloaded_bytes += size
+        return Asset(path=blob_path, **data)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
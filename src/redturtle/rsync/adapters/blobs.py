@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to write the blob fields only when their content changed: the
+incoming data is hashed while it is copied to a spool file, so it is never
+loaded in memory, and the spool file is consumed by the new blob.
+"""
+import hashlib
+import os
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+def spool(fp, directory=None):
+    """
+    Copy the binary file fp to a temporary file, hashing it.
+    Return the path of the copy, its sha256 and its size.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(
+        dir=directory, prefix="redturtle.rsync.blob.", delete=False
+    ) as f:
+        try:
+            while True:
+                chunk = fp.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        except Exception:
+            f.close()
+            os.unlink(f.name)
+            raise
+    return f.name, sha256.hexdigest(), size
+
+
+def bytes_digest(data):
+    return hashlib.sha256(data).hexdigest(), len(data)
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to run work concurrently with a bounded number of tasks in flight.
+"""
+import collections
+import itertools
+
+
+def ordered_map(executor, fn, iterable, window):
+    """
+    Like executor.map, but with at most window calls in flight, so the
+    iterable can be infinite. The generator can be closed at any time.
+    """
+    pending = collections.deque()
+    args = iter(iterable)
+    try:
+        for arg in itertools.islice(args, window):
+            pending.append(executor.submit(fn, arg))
+        while pending:
+            result = pending.popleft().result()
+            for arg in itertools.islice(args, 1):
+                pending.append(executor.submit(fn, arg))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
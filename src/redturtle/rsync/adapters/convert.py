@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Convert the source rows in batches, optionally in a pool of processes, so
+CPU-bound conversions (HTML sanitizing, date parsing...) use the other
+cores while the main process does the Zope/ZODB work.
+
+Workers have their own instance of the adapter class, without context and
+request: convert_rows must not access the site, and rows and results must
+be picklable. The converted rows are validated in the workers too (see
+row_schema), and the validation time is reported to the main process.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from redturtle.rsync.adapters.concurrency import ordered_map
+from redturtle.rsync.scripts.rsync import iter_batches
+
+import time
+
+# adapter of the worker process
+_adapter = None
+
+
+def init_worker(factory, options):
+    global _adapter
+    _adapter = factory(None, None)
+    _adapter.options = options
+
+
+def convert_batch(batch):
+    rows = _adapter.convert_rows(batch)
+    if _adapter.get_row_validator() is None:
+        return rows, None
+    start = time.monotonic()
+    rows = _adapter.validate_rows(rows)
+    return rows, time.monotonic() - start
+
+
+def convert_rows(adapter, rows, batch_size=100, workers=0):
+    """
+    Yield the rows converted by adapter.convert_rows, in the same order.
+    With workers, batches are converted and validated concurrently by that
+    many processes.
+    """
+    batches = iter_batches(rows, size=max(1, batch_size))
+    if not workers:
+        for batch in batches:
+            yield from adapter.convert_rows(batch)
+        return
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(type(adapter), adapter.options),
+    ) as executor:
+        results = ordered_map(executor, convert_batch, batches, window=workers * 2)
+        try:
+            for converted, seconds in results:
+                if seconds is not None:
+                    adapter.metrics.add("validate", seconds)
+                yield from converted
+        finally:
+            results.close()
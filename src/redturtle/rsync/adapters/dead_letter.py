@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Dead-letter file (--dead-letter): the rows that could not be synced are
+appended to an NDJSON file, with the phase and the error, so they can be
+synced again using the file as the source of a new run.
+"""
+from datetime import datetime
+
+import json
+import os
+import traceback
+
+# key that marks the records of a dead-letter file
+MARKER = "rsync_dead_letter"
+
+
+def is_dead_letter(row):
+    return isinstance(row, dict) and MARKER in row
+
+
+class DeadLetter:
+    """
+    Append the failed rows to path, opened only when the first row fails.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.n_rows = 0
+
+    def add(self, row, phase, error, key=None):
+        """
+        Append the row, that failed in the given phase (create, update,
+        validate) with error: an exception or a list of messages.
+        """
+        record = {
+            MARKER: 1,
+            "time": datetime.now().isoformat(),
+            "phase": phase,
+            "key": key,
+        }
+        if isinstance(error, BaseException):
+            record["exception"] = type(error).__name__
+            record["error"] = str(error)
+            record["traceback"] = "".join(
+                traceback.format_exception(type(error), error, error.__traceback__)
+            )
+        else:
+            record["error"] = "; ".join(error)
+        record["row"] = row
+        if self.file is None:
+            self.file = open(self.path, "ab")
+        line = json.dumps(record, default=str) + "\n"
+        self.file.write(line.encode("utf-8"))
+        self.file.flush()
+        self.n_rows += 1
+
+    def tell(self):
+        """
+        Return the size of the file, to truncate it when the transaction of
+        the rows is aborted and they are replayed.
+        """
+        if self.file is not None:
+            return self.file.tell()
+        if os.path.exists(self.path):
+            return os.path.getsize(self.path)
+        return 0
+
+    def truncate(self, size):
+        if self.file is None:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > size:
+                os.truncate(self.path, size)
+            return
+        self.file.truncate(size)
+        self.file.seek(size)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+Stable fingerprints of the source rows, used to skip rows that did not
+change since the last sync.
+"""
+import hashlib
+import json
+
+
+def row_fingerprint(row, salt=""):
+    """
+    Return a hash of the row that does not depend on the order of its keys.
+    Values that are not JSON serializable are hashed by their string value.
+    """
+    data = json.dumps(
+        row, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+    return hashlib.sha1(f"{salt}{data}".encode("utf-8")).hexdigest()
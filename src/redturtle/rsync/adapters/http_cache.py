@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of remote sources.
+
+The source is downloaded in a spool file next to a JSON file with its
+validators (ETag, Last-Modified): the next downloads are conditional
+requests, and interrupted downloads are resumed with a Range request.
+Bytes are stored as sent by the server (e.g. gzip encoded) and decoded when
+the cached file is opened.
+"""
+import gzip
+import hashlib
+import json
+import os
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class SourceCacheError(Exception):
+    """The source can't be downloaded."""
+
+
+class CachedSource:
+    """
+    A downloaded source.
+    """
+
+    def __init__(self, path, meta, not_modified=False):
+        self.path = path
+        self.meta = meta
+        self.not_modified = not_modified
+
+    @property
+    def content_type(self):
+        return self.meta.get("content_type", "")
+
+    @property
+    def identity(self):
+        """
+        Identify this version of the source.
+        """
+        version = self.meta.get("etag") or self.meta.get("last_modified") or ""
+        return f"{self.meta['url']}:{version}"
+
+    def open(self):
+        """
+        Return a binary stream of the decoded source.
+        """
+        if self.meta.get("content_encoding") == "gzip":
+            return gzip.open(self.path, "rb")
+        return open(self.path, "rb")
+
+
+class SourceCache:
+    """
+    Download remote sources in directory.
+    """
+
+    def __init__(self, directory, session, chunk_size=CHUNK_SIZE):
+        self.directory = directory
+        self.session = session
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+
+    def paths(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.directory, key)
+        return f"{base}.data", f"{base}.part", f"{base}.json"
+
+    def load_meta(self, url):
+        path = self.paths(url)[2]
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            meta = json.load(f)
+        if meta.get("url") != url:
+            return {}
+        return meta
+
+    def save_meta(self, url, meta):
+        path = self.paths(url)[2]
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+
+    def get_headers(self, meta, resume_from):
+        # only encodings that we can decode from the cached file
+        headers = {"Accept-Encoding": "gzip"}
+        validator = meta.get("etag") or ""
+        if validator.startswith("W/"):
+            # If-Range needs a strong validator
+            validator = ""
+        validator = validator or meta.get("last_modified")
+        if resume_from and validator:
+            headers["Range"] = f"bytes={resume_from}-"
+            headers["If-Range"] = validator
+        elif meta.get("complete"):
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def fetch(self, url):
+        """
+        Download the source, if it has changed since the last download.
+        Return a CachedSource.
+        """
+        data_path, part_path, _ = self.paths(url)
+        meta = self.load_meta(url)
+        if meta.get("complete") and not os.path.exists(data_path):
+            meta = {}
+        resume_from = 0
+        if not meta.get("complete") and os.path.exists(part_path):
+            resume_from = os.path.getsize(part_path)
+
+        headers = self.get_headers(meta=meta, resume_from=resume_from)
+        with self.session.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 304 and meta.get("complete"):
+                return CachedSource(path=data_path, meta=meta, not_modified=True)
+            if response.status_code == 206 and resume_from:
+                mode = "ab"
+            elif response.status_code == 200:
+                mode = "wb"
+                resume_from = 0
+            else:
+                raise SourceCacheError(
+                    f"Error getting data from {url}: {response.status_code}"
+                )
+            if mode == "wb":
+                # a new version of the source
+                meta = {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "content_type": response.headers.get("Content-Type", ""),
+                    "content_encoding": response.headers.get("Content-Encoding", ""),
+                    "complete": False,
+                }
+                self.save_meta(url, meta)
+            with open(part_path, mode) as f:
+                while True:
+                    # raw bytes, as they are encoded by the server
+                    chunk = response.raw.read(self.chunk_size, decode_content=False)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        os.replace(part_path, data_path)
+        meta["complete"] = True
+        meta["resumed_from"] = resume_from
+        self.save_meta(url, meta)
+        return CachedSource(path=data_path, meta=meta)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Log records of a sync.
+
+Records are stored as compact tuples (timestamp, type, message), where the
+message can be an i18n Message not yet translated: they are translated and
+rendered only when the log is written or sent.
+Records over a threshold are spilled to a temporary file, so the memory used
+by the log does not grow with the number of rows.
+"""
+from datetime import datetime
+from zope.i18n import interpolate
+from zope.i18nmessageid import Message
+
+import json
+import pickle
+import re
+import tempfile
+import time
+
+LINK_RE = re.compile(r"(https?://\S+|/\S+)")
+
+STYLES = {
+    "error": "padding:2px;background-color:red;color:#fff",
+    "warning": "padding:2px;background-color:#ff9d00;color:#fff",
+}
+ALERTS = ("error", "warning")
+
+
+def make_record(msg, type="info"):
+    """
+    The values of the mapping of i18n messages (e.g. rows and exceptions)
+    are stored as strings: records must be picklable to be spilled.
+    """
+    if isinstance(msg, Message):
+        if msg.mapping:
+            msg = Message(msg, mapping={k: str(v) for k, v in msg.mapping.items()})
+    elif not isinstance(msg, str):
+        msg = str(msg)
+    return (time.time(), type, msg)
+
+
+class LogStorage:
+    """
+    List-like storage of log records: when more than threshold records are
+    in memory, they are pickled as a chunk in a temporary file.
+    """
+
+    def __init__(self, threshold=10000):
+        self.threshold = threshold
+        self.records = []
+        self.file = None
+        # offset in the file of each spilled chunk
+        self.chunks = []
+
+    @property
+    def spilled(self):
+        return bool(self.chunks)
+
+    def __len__(self):
+        return len(self.chunks) * self.threshold + len(self.records)
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            yield from chunk
+        yield from self.records
+
+    def iter_chunks(self):
+        for offset in self.chunks:
+            self.file.seek(offset)
+            yield pickle.load(self.file)
+        if self.file is not None:
+            self.file.seek(0, 2)
+
+    def append(self, record):
+        self.records.append(record)
+        if len(self.records) >= self.threshold:
+            self.spill()
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def spill(self):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix="redturtle.rsync.log.")
+        self.file.seek(0, 2)
+        self.chunks.append(self.file.tell())
+        pickle.dump(self.records, self.file)
+        self.records = []
+
+    def truncate(self, length):
+        """
+        Remove the records after the given length.
+        """
+        index, size = divmod(length, self.threshold)
+        if index >= len(self.chunks):
+            start = length - len(self.chunks) * self.threshold
+            del self.records[start:]
+            return
+        self.file.seek(self.chunks[index])
+        records = pickle.load(self.file)[:size]
+        self.file.truncate(self.chunks[index])
+        del self.chunks[index:]
+        self.records = records
+
+    def alerts(self):
+        """
+        Iterate over errors and warnings.
+        """
+        return (record for record in self if record[1] in ALERTS)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.chunks = []
+        self.records = []
+
+
+def autolink(text):
+    """
+    Fix links in the text.
+    """
+    return LINK_RE.sub(r'<a href="\1">\1</a>', text)
+
+
+class LogRenderer:
+    """
+    Render log records to text or HTML.
+
+    Messages are translated once per message id (and default), then the
+    mapping of each record is interpolated.
+    """
+
+    def __init__(self, translate, autolink=autolink):
+        self.translate_msgid = translate
+        self.autolink = autolink
+        self.translations = {}
+
+    def translate(self, msg):
+        if not isinstance(msg, Message):
+            return str(msg)
+        key = (msg.domain, str(msg), msg.default)
+        text = self.translations.get(key)
+        if text is None:
+            # translate the message without its mapping
+            text = self.translate_msgid(
+                Message(str(msg), domain=msg.domain, default=msg.default)
+            )
+            self.translations[key] = text
+        return interpolate(text, msg.mapping)
+
+    def text(self, record):
+        timestamp, type, msg = record
+        date = datetime.fromtimestamp(timestamp).strftime("%d-%m-%Y %H:%M:%S")
+        return f"[{date}] {self.translate(msg)}"
+
+    def html(self, record):
+        timestamp, type, msg = record
+        date = datetime.fromtimestamp(timestamp).strftime("%d-%m-%Y %H:%M:%S")
+        style = STYLES.get(type, "")
+        return f'<p><span style="{style}">[{date}]</span>&nbsp;{self.autolink(self.translate(msg))}</p>'
+
+    def json(self, record):
+        timestamp, type, msg = record
+        return json.dumps(
+            {
+                "date": datetime.fromtimestamp(timestamp).isoformat(),
+                "type": type,
+                "message": self.translate(msg),
+            }
+        )
+
+    def render_html(self, records):
+        return [self.html(record) for record in records]
+
+    def render_text(self, records):
+        return [self.text(record) for record in records]
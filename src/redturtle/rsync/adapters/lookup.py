@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory index that maps the external key of the source rows to the
+synced items, to avoid a catalog query for each row.
+"""
+
+
+class LookupIndex:
+    """
+    Map row keys to (uid, path) of the existing items.
+
+    Only keys that have been loaded are known: a key that is not in the
+    index means that there is no item for it.
+    """
+
+    def __init__(self, mode="preload"):
+        self.mode = mode
+        self.items = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def add(self, key, uid, path):
+        if key is None:
+            return
+        self.items[key] = (uid, path)
+
+    def get(self, key):
+        """
+        Return (uid, path) for the given key, or None if there is no item.
+        """
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def clear(self):
+        self.items.clear()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Default delete phase: the items in the scope of the adapter that have not
+been synced are removed in bulk, grouped by parent container.
+"""
+from plone.app.linkintegrity.utils import referencedRelationship
+from zc.relation.interfaces import ICatalog
+from zope.component import queryUtility
+
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def parse_max_delete(value):
+    """
+    Parse --max-delete: a number of items ("500") or a percentage of the
+    items in the scope ("10%").
+    Return a (limit, percent) tuple.
+    """
+    value = value.strip()
+    percent = value.endswith("%")
+    if percent:
+        value = value[:-1]
+    limit = float(value) if percent else int(value)
+    if limit < 0:
+        raise ValueError(f"Invalid max delete value: {value}")
+    return limit, percent
+
+
+def exceeds_max_delete(n_orphans, total, max_delete):
+    if not max_delete:
+        return False
+    limit, percent = parse_max_delete(max_delete)
+    if percent:
+        return bool(total) and n_orphans * 100.0 / total > limit
+    return n_orphans > limit
+
+
+def deleted_ancestor(path, paths):
+    """
+    Return the path in paths that is path itself or one of its ancestors.
+    """
+    parts = path.split("/")
+    for i in range(len(parts), 1, -1):
+        candidate = "/".join(parts[:i])
+        if candidate in paths:
+            return candidate
+    return None
+
+
+def linked_orphans(paths):
+    """
+    Return a dict {path: [source paths]} of the paths that would break a
+    link from an item that is not deleted (links to their children too).
+    Links are read with a single scan of the relation catalog, instead of a
+    check for each item.
+    """
+    catalog = queryUtility(ICatalog)
+    if catalog is None:
+        return {}
+    linked = collections.defaultdict(list)
+    query = {"from_attribute": referencedRelationship}
+    for relation in catalog.findRelations(query):
+        try:
+            to_path = relation.to_path
+            from_path = relation.from_path
+        except Exception as e:
+            logger.exception(e)
+            continue
+        if not to_path or not from_path:
+            continue
+        if deleted_ancestor(from_path, paths):
+            continue
+        # the target and its deleted ancestors must be kept
+        target = deleted_ancestor(to_path, paths)
+        while target:
+            linked[target].append(from_path)
+            target = deleted_ancestor(target.rpartition("/")[0], paths)
+    return dict(linked)
+
+
+def group_by_parent(paths):
+    """
+    Return a dict {parent path: [ids]} of the paths to delete, without the
+    paths that are removed with one of their ancestors.
+    """
+    paths = set(paths)
+    groups = collections.defaultdict(list)
+    for path in sorted(paths):
+        parent, _, id = path.rpartition("/")
+        if deleted_ancestor(parent, paths):
+            continue
+        groups[parent].append(id)
+    return dict(groups)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Paged remote sources (plone.restapi-like or offset/limit APIs), with pages
+fetched concurrently over a shared session and rows yielded in order.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from redturtle.rsync.adapters.concurrency import ordered_map
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+from urllib.parse import urlunparse
+
+import itertools
+
+
+def set_query_params(url, **params):
+    """
+    Return the url with the given query parameters added or replaced.
+    """
+    parts = urlparse(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k not in params]
+    query.extend((k, str(v)) for k, v in params.items())
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+
+class PagedSource:
+    """
+    Iterate over the rows of a paged source.
+
+    The first page tells how to get the others:
+    - with the total number of items (items_total, as in plone.restapi, or
+      total/count), all the pages are fetched concurrently;
+    - with an explicit page_size, pages are fetched concurrently until one
+      has less rows than page_size;
+    - otherwise the next links (batching.next or next) are followed.
+    """
+
+    def __init__(
+        self,
+        session,
+        url,
+        workers=4,
+        page_size=None,
+        offset_param="b_start",
+        limit_param="b_size",
+        items_key="items",
+    ):
+        self.session = session
+        self.url = url
+        self.workers = max(1, workers)
+        self.page_size = page_size
+        self.offset_param = offset_param
+        self.limit_param = limit_param
+        self.items_key = items_key
+        self.n_pages = 0
+
+    def page_url(self, offset):
+        params = {self.offset_param: offset}
+        if self.page_size:
+            params[self.limit_param] = self.page_size
+        return set_query_params(self.url, **params)
+
+    def fetch(self, url):
+        response = self.session.get(url, headers={"Accept": "application/json"})
+        response.raise_for_status()
+        self.n_pages += 1
+        return response.json()
+
+    def get_rows(self, payload):
+        if isinstance(payload, list):
+            return payload
+        rows = payload.get(self.items_key)
+        if rows is None:
+            rows = payload.get("results", [])
+        return rows
+
+    def get_total(self, payload):
+        if not isinstance(payload, dict):
+            return None
+        for key in ("items_total", "total", "count"):
+            if isinstance(payload.get(key), int):
+                return payload[key]
+        return None
+
+    def get_next_url(self, payload):
+        if not isinstance(payload, dict):
+            return None
+        batching = payload.get("batching")
+        if isinstance(batching, dict) and batching.get("next"):
+            return batching["next"]
+        next_url = payload.get("next")
+        return next_url if isinstance(next_url, str) else None
+
+    def fetch_rows(self, offset):
+        return self.get_rows(self.fetch(self.page_url(offset)))
+
+    def __iter__(self):
+        first_url = self.page_url(0) if self.page_size else self.url
+        first = self.fetch(first_url)
+        rows = self.get_rows(first)
+        yield from rows
+        page_size = self.page_size or len(rows)
+        if not rows or (self.page_size and len(rows) < page_size):
+            return
+        total = self.get_total(first)
+        if total is not None:
+            offsets = range(page_size, total, page_size)
+        elif self.page_size:
+            offsets = itertools.count(page_size, page_size)
+        else:
+            yield from self.follow_next(first)
+            return
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="redturtle.rsync.pages"
+        ) as executor:
+            pages = ordered_map(
+                executor, self.fetch_rows, offsets, window=self.workers * 2
+            )
+            try:
+                for rows in pages:
+                    yield from rows
+                    if total is None and len(rows) < page_size:
+                        return
+            finally:
+                pages.close()
+
+    def follow_next(self, payload):
+        """
+        Follow the next links: pages can only be fetched one at a time.
+        """
+        next_url = self.get_next_url(payload)
+        while next_url:
+            payload = self.fetch(next_url)
+            yield from self.get_rows(payload)
+            next_url = self.get_next_url(payload)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Sync plan (--plan): the action that the sync would do for each row and for
+each item to delete, stored as NDJSON records in a temporary file.
+"""
+import gzip
+import json
+import tempfile
+
+ACTIONS = ("create", "update", "unchanged", "delete")
+
+
+class Plan:
+    """
+    Records of the planned actions, with their counts.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+        self.counts = dict.fromkeys(ACTIONS, 0)
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def add(self, action, key=None, uid=None, path=None):
+        self.counts[action] += 1
+        record = {"action": action, "key": key, "uid": uid, "path": path}
+        self.file.write(json.dumps(record, default=str) + "\n")
+
+    def __iter__(self):
+        """
+        Iterate over the records, as NDJSON lines.
+        """
+        self.file.flush()
+        self.file.seek(0)
+        try:
+            yield from self.file
+        finally:
+            self.file.seek(0, 2)
+
+    def write(self, path):
+        """
+        Write the records in path (gzipped if it ends with .gz).
+        """
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "wt", encoding="utf-8") as f:
+            for line in self:
+                f.write(line)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Queue of the items to reindex at the commit boundaries, instead of
+reindexing them each time they are touched.
+"""
+from Products.CMFCore.indexing import getQueue
+from Products.CMFCore.indexing import processQueue
+from Products.CMFCore.indexing import UNINDEX
+
+import time
+
+
+def _merge(queue, path, idxs):
+    """
+    Add the index names to the path in the queue (None means all indexes).
+    """
+    if path not in queue:
+        queue[path] = set(idxs) if idxs else None
+    elif queue[path] is None or not idxs:
+        queue[path] = None
+    else:
+        queue[path].update(idxs)
+
+
+class ReindexQueue:
+    """
+    Items to reindex, keyed by physical path, with the affected indexes.
+
+    Reindexed items are kept until the transaction is committed, to be
+    queued again if it is aborted.
+    """
+
+    def __init__(self):
+        self.queue = {}
+        self.reindexed = {}
+        self.n_reindexed = 0
+        self.time = 0.0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, item, idxs=None):
+        _merge(self.queue, item.getPhysicalPath(), idxs)
+
+    def take_catalog_queue(self):
+        """
+        Move the index operations queued in the CMFCore indexing queue (e.g.
+        by api.content.create or by event handlers) here, so they are not
+        processed by the next catalog search. Unindex operations are kept
+        there.
+        """
+        catalog_queue = getQueue()
+        if not catalog_queue.length():
+            return
+        state = []
+        for op, obj, attributes, metadata in catalog_queue.getState():
+            if op == UNINDEX:
+                state.append((op, obj, attributes, metadata))
+            else:
+                self.add(item=obj, idxs=attributes)
+        catalog_queue.setState(state)
+
+    def flush(self, context):
+        """
+        Reindex each queued item only once.
+        """
+        if not self.queue:
+            return
+        start = time.monotonic()
+        for path, idxs in self.queue.items():
+            item = context.unrestrictedTraverse(path, None)
+            if item is not None:
+                item.reindexObject(idxs=sorted(idxs) if idxs else [])
+                self.n_reindexed += 1
+            _merge(self.reindexed, path, idxs)
+        self.queue = {}
+        # reindexObject only queues the operations in the CMFCore queue
+        processQueue()
+        self.time += time.monotonic() - start
+
+    def requeue(self):
+        """
+        The transaction has been aborted: queue again the reindexed items.
+        """
+        for path, idxs in self.reindexed.items():
+            _merge(self.queue, path, idxs)
+        self.reindexed = {}
+
+    def clear(self):
+        """
+        The transaction has been committed.
+        """
+        self.reindexed = {}
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Declarative schema of the source rows, compiled once into a validator.
+
+A schema maps each field to its type, or to a dict of rules:
+
+    row_schema = {
+        "id": str,
+        "title": {"type": str, "max_length": 200},
+        "date": {"type": str, "pattern": r"\\d{4}-\\d{2}-\\d{2}$", "required": False},
+        "state": {"choices": ["private", "published"]},
+        "price": {"type": (int, float), "validator": lambda v: v >= 0},
+    }
+
+Rules: type, required (default True), nullable (default False), choices,
+pattern, min_length, max_length and validator (a callable that returns
+False or an error message for invalid values).
+"""
+import re
+
+RULES = (
+    "type",
+    "required",
+    "nullable",
+    "choices",
+    "pattern",
+    "min_length",
+    "max_length",
+    "validator",
+)
+
+
+class InvalidRow:
+    """
+    A row rejected by the validation, with its errors.
+    """
+
+    def __init__(self, row, errors):
+        self.row = row
+        self.errors = errors
+
+
+def source_row(row):
+    """
+    Return the source row, also if it has been rejected.
+    """
+    return row.row if isinstance(row, InvalidRow) else row
+
+
+def valid_rows(rows):
+    return [row for row in rows if not isinstance(row, InvalidRow)]
+
+
+def type_name(types):
+    if isinstance(types, tuple):
+        return " or ".join(t.__name__ for t in types)
+    return types.__name__
+
+
+def type_check(name, types):
+    expected = type_name(types)
+    # bool is an int, but not a valid number
+    reject_bool = bool not in (types if isinstance(types, tuple) else (types,))
+
+    def check(value):
+        if not isinstance(value, types) or (reject_bool and isinstance(value, bool)):
+            return f"{name}: expected {expected}, got {type(value).__name__}"
+
+    return check
+
+
+def choices_check(name, choices):
+    choices = frozenset(choices)
+
+    def check(value):
+        if value not in choices:
+            return f"{name}: {value!r} is not an allowed value"
+
+    return check
+
+
+def pattern_check(name, pattern):
+    regexp = re.compile(pattern)
+
+    def check(value):
+        if not isinstance(value, str) or not regexp.match(value):
+            return f"{name}: {value!r} does not match {pattern}"
+
+    return check
+
+
+def length_check(name, min_length, max_length):
+    def check(value):
+        try:
+            length = len(value)
+        except TypeError:
+            return f"{name}: {type(value).__name__} has no length"
+        if min_length is not None and length < min_length:
+            return f"{name}: shorter than {min_length}"
+        if max_length is not None and length > max_length:
+            return f"{name}: longer than {max_length}"
+
+    return check
+
+
+def validator_check(name, validator):
+    def check(value):
+        try:
+            result = validator(value)
+        except Exception as e:
+            return f"{name}: {e}"
+        if isinstance(result, str):
+            return f"{name}: {result}"
+        if result is False:
+            return f"{name}: {value!r} is not valid"
+
+    return check
+
+
+def compile_field(name, rules):
+    """
+    Return (required, nullable, checks) for the field: checks are functions
+    that return an error message for an invalid value, or None.
+    """
+    if not isinstance(rules, dict):
+        rules = {"type": rules}
+    unknown = set(rules) - set(RULES)
+    if unknown:
+        raise ValueError(
+            f"Unknown rules for field {name}: {', '.join(sorted(unknown))}"
+        )
+    checks = []
+    if rules.get("type") is not None:
+        checks.append(type_check(name, rules["type"]))
+    if rules.get("choices") is not None:
+        checks.append(choices_check(name, rules["choices"]))
+    if rules.get("pattern") is not None:
+        checks.append(pattern_check(name, rules["pattern"]))
+    min_length = rules.get("min_length")
+    max_length = rules.get("max_length")
+    if min_length is not None or max_length is not None:
+        checks.append(length_check(name, min_length, max_length))
+    if rules.get("validator") is not None:
+        checks.append(validator_check(name, rules["validator"]))
+    return rules.get("required", True), rules.get("nullable", False), checks
+
+
+def compile_schema(schema):
+    """
+    Compile the schema into a function that returns the list of errors of
+    a row (empty if the row is valid).
+    """
+    fields = [(name, *compile_field(name, rules)) for name, rules in schema.items()]
+
+    def validate(row):
+        if not isinstance(row, dict):
+            return [f"expected a mapping, got {type(row).__name__}"]
+        errors = []
+        for name, required, nullable, checks in fields:
+            if name not in row:
+                if required:
+                    errors.append(f"{name}: missing")
+                continue
+            value = row[name]
+            if value is None:
+                if not nullable:
+                    errors.append(f"{name}: null")
+                continue
+            for check in checks:
+                error = check(value)
+                if error:
+                    errors.append(error)
+                    # the next checks could fail on a wrong type
+                    break
+        return errors
+
+    return validate
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to read source data incrementally.
+
+These functions never load the whole payload in memory: they read the
+source in chunks and yield one row at a time.
+
+Decoders and compressions are kept in two registries, so add-ons can
+register their own formats with `register_decoder` and
+`register_compression`.
+"""
+import bz2
+import csv
+import gzip
+import io
+import json
+import lzma
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
+SEPARATORS = WHITESPACE + ",]"
+SNIFF_SIZE = 4096
+
+DECODERS = {}
+COMPRESSIONS = {}
+
+
+def iter_ndjson(fp):
+    """
+    Yield one row for each non-empty line of a newline delimited JSON source.
+    """
+    for lineno, line in enumerate(fp, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON at line {lineno}: {e}")
+
+
+class _Buffer:
+    """
+    A text buffer filled in chunks from a file-like object.
+    """
+
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Read another chunk, dropping what has been already consumed.
+        """
+        chunk = self.fp.read(self.chunk_size)
+        self.eof = not chunk
+        self.consume()
+        self.text += chunk
+
+    def peek(self):
+        """
+        Return the next non-whitespace character, or None at the end of input.
+        """
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if self.eof:
+                return None
+            self.fill()
+
+    def consume(self):
+        """
+        Drop the text before the current position.
+        """
+        pos = self.pos
+        self.text = self.text[pos:]
+        self.pos = 0
+
+    def excerpt(self):
+        pos = self.pos
+        return self.text[pos:][:20]
+
+
+def _decode_value(buffer, decoder):
+    """
+    Decode the value at the current position, reading more data if needed.
+    """
+    while True:
+        try:
+            value, end = decoder.raw_decode(buffer.text, buffer.pos)
+        except json.JSONDecodeError:
+            value, end = None, None
+        # a value not followed by a separator could be truncated at the
+        # buffer boundary (e.g. a number), so read more before accepting it
+        complete = end is not None and (
+            end < len(buffer.text) and buffer.text[end] in SEPARATORS
+        )
+        if complete or (end is not None and buffer.eof):
+            buffer.pos = end
+            return value
+        if buffer.eof:
+            raise ValueError(f"Invalid JSON value: {buffer.excerpt()}")
+        buffer.fill()
+
+
+def iter_json_array(fp, chunk_size=CHUNK_SIZE):
+    """
+    Yield the elements of a top-level JSON array, decoding them one by one.
+
+    If the top-level value is not an array, it is decoded as a whole: a
+    restapi-like object with an "items" list yields its items, any other
+    value is yielded as a single row.
+    """
+    decoder = json.JSONDecoder()
+    buffer = _Buffer(fp=fp, chunk_size=chunk_size)
+
+    char = buffer.peek()
+    if char is None:
+        return
+    if char != "[":
+        # not a list: fallback to a full decode
+        buffer.consume()
+        data = json.loads(buffer.text + fp.read())
+        if isinstance(data, dict) and isinstance(data.get("items"), list):
+            yield from data["items"]
+        else:
+            yield data
+        return
+
+    buffer.pos += 1
+    expect_value = True
+    after_comma = False
+    while True:
+        char = buffer.peek()
+        if char is None:
+            raise ValueError("Unexpected end of JSON array")
+        if char == "]":
+            if after_comma:
+                # rejected by json.load too
+                raise ValueError(f"Trailing ',' in JSON array: {buffer.excerpt()}")
+            buffer.pos += 1
+            # e.g. a concatenated or corrupted payload
+            if buffer.peek() is not None:
+                raise ValueError(
+                    f"Unexpected data after the JSON array: {buffer.excerpt()}"
+                )
+            return
+        if char == ",":
+            if expect_value:
+                raise ValueError(f"Unexpected ',' in JSON array: {buffer.excerpt()}")
+            expect_value = True
+            after_comma = True
+            buffer.pos += 1
+            continue
+        if not expect_value:
+            raise ValueError(f"Missing ',' in JSON array: {buffer.excerpt()}")
+        yield _decode_value(buffer=buffer, decoder=decoder)
+        expect_value = False
+        after_comma = False
+        # drop what has been already decoded
+        if buffer.pos > chunk_size:
+            buffer.consume()
+
+
+def iter_csv(fp, delimiter=","):
+    """
+    Yield a dict for each row of a CSV source, keyed by the header columns.
+    """
+    yield from csv.DictReader(fp, delimiter=delimiter)
+
+
+def iter_tsv(fp):
+    """
+    Yield a dict for each row of a tab separated source.
+    """
+    return iter_csv(fp, delimiter="\t")
+
+
+def open_zstd(fp):
+    if zstandard is None:
+        raise ValueError(
+            "zstandard is not installed: install redturtle.rsync[zstd] to read zstd sources."
+        )
+    return zstandard.ZstdDecompressor().stream_reader(fp)
+
+
+def register_decoder(name, decoder, extensions=(), content_types=()):
+    """
+    Register a decoder: a callable that accepts a text stream and yields rows.
+    """
+    DECODERS[name] = {
+        "decoder": decoder,
+        "extensions": tuple(extensions),
+        "content_types": tuple(content_types),
+    }
+
+
+def register_compression(name, opener, extensions=(), content_types=(), magic=b""):
+    """
+    Register a compression: opener accepts a binary stream and returns the
+    decompressed binary stream.
+    """
+    COMPRESSIONS[name] = {
+        "opener": opener,
+        "extensions": tuple(extensions),
+        "content_types": tuple(content_types),
+        "magic": magic,
+    }
+
+
+register_decoder(
+    "json",
+    iter_json_array,
+    extensions=(".json",),
+    content_types=("application/json",),
+)
+register_decoder(
+    "ndjson",
+    iter_ndjson,
+    extensions=(".ndjson", ".jsonl"),
+    content_types=("application/x-ndjson", "application/ndjson", "application/jsonl"),
+)
+register_decoder(
+    "csv",
+    iter_csv,
+    extensions=(".csv",),
+    content_types=("text/csv",),
+)
+register_decoder(
+    "tsv",
+    iter_tsv,
+    extensions=(".tsv", ".tab"),
+    content_types=("text/tab-separated-values",),
+)
+register_compression(
+    "gzip",
+    lambda fp: gzip.GzipFile(fileobj=fp, mode="rb"),
+    extensions=(".gz",),
+    content_types=("application/gzip", "application/x-gzip"),
+    magic=b"\x1f\x8b",
+)
+register_compression(
+    "bz2",
+    lambda fp: bz2.BZ2File(fp, mode="rb"),
+    extensions=(".bz2",),
+    content_types=("application/x-bzip2",),
+    magic=b"BZh",
+)
+register_compression(
+    "xz",
+    lambda fp: lzma.LZMAFile(fp, mode="rb"),
+    extensions=(".xz",),
+    content_types=("application/x-xz",),
+    magic=b"\xfd7zXZ\x00",
+)
+register_compression(
+    "zstd",
+    open_zstd,
+    extensions=(".zst", ".zstd"),
+    content_types=("application/zstd",),
+    magic=b"\x28\xb5\x2f\xfd",
+)
+
+
+def _match(registry, name="", content_type=""):
+    """
+    Return the first registry entry matching the name extension or the
+    content type.
+    """
+    name = (name or "").lower()
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    for key, entry in registry.items():
+        if name and name.endswith(entry["extensions"]):
+            return key
+        if content_type and content_type in entry["content_types"]:
+            return key
+    return None
+
+
+def _peekable(fp):
+    if not hasattr(fp, "peek"):
+        fp = io.BufferedReader(fp)
+    return fp
+
+
+def strip_compression_extension(name):
+    """
+    Return the name without the compression extension (data.ndjson.gz -> data.ndjson)
+    """
+    lower = (name or "").lower()
+    for entry in COMPRESSIONS.values():
+        for extension in entry["extensions"]:
+            if lower.endswith(extension):
+                return name[: -len(extension)]
+    return name
+
+
+def open_source_stream(fp, name="", content_type="", compression=None, sniff=True):
+    """
+    Return a decompressed (peekable) binary stream for the given binary
+    stream.
+
+    The compression is taken from the `compression` argument or guessed
+    from the name extension, the content type and, if sniff is True, from
+    the first bytes of the stream.
+    """
+    fp = _peekable(fp)
+    if not compression:
+        compression = _match(COMPRESSIONS, name=name, content_type=content_type)
+    if not compression and sniff:
+        head = fp.peek(SNIFF_SIZE)
+        for key, entry in COMPRESSIONS.items():
+            if entry["magic"] and head.startswith(entry["magic"]):
+                compression = key
+                break
+    if not compression or compression == "none":
+        return fp
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown source compression: {compression}")
+    return _peekable(COMPRESSIONS[compression]["opener"](fp))
+
+
+def sniff_format(head):
+    """
+    Guess the format from the first characters of a (decompressed) source.
+    """
+    text = head.lstrip("\ufeff" + WHITESPACE)
+    if text.startswith("["):
+        return "json"
+    if text.startswith("{"):
+        lines = text.split("\n", 1)
+        if len(lines) == 2 and lines[1].strip():
+            try:
+                json.loads(lines[0])
+                return "ndjson"
+            except ValueError:
+                pass
+        return "json"
+    first_line = text.split("\n", 1)[0]
+    if first_line.count("\t") > first_line.count(","):
+        return "tsv"
+    return "csv"
+
+
+def guess_format(fp, name="", content_type="", sniff=True):
+    """
+    Guess the source format from the name extension, the content type and,
+    if sniff is True, from the first bytes of the (peekable) stream.
+    Return None if the format is unknown.
+    """
+    source_format = _match(
+        DECODERS, name=strip_compression_extension(name), content_type=content_type
+    )
+    if source_format or not sniff:
+        return source_format
+    head = fp.peek(SNIFF_SIZE)[:SNIFF_SIZE]
+    return sniff_format(head.decode("utf-8", errors="ignore"))
+
+
+def iter_rows(fp, source_format, encoding="utf-8-sig"):
+    """
+    Decode the rows of a binary stream with the decoder registered for
+    source_format.
+    """
+    if source_format not in DECODERS:
+        raise ValueError(f"Unknown source format: {source_format}")
+    text = io.TextIOWrapper(fp, encoding=encoding, newline="")
+    return DECODERS[source_format]["decoder"](text)
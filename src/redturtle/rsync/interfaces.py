@@ -64,7 +64,7 @@ class IRedturtleRsyncAdapter(Interface):
         """
         params:
         - data: the data to be used for the rsync command
-        - sync_uids: the uids of the items thata has been updated
+        - sync_uids: the uids of the items thata has been created or updated
 
         Delete items if needed.
         This method should be implemented by subclasses to delete the specific type of content item.
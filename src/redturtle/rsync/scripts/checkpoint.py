@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent checkpoints of a sync run, stored in the portal annotations and
+saved in the same transaction of each intermediate commit.
+"""
+from BTrees.OOBTree import OOTreeSet
+from persistent.mapping import PersistentMapping
+from zope.annotation.interfaces import IAnnotations
+
+import transaction
+
+CHECKPOINT_KEY = "redturtle.rsync.checkpoint"
+COUNTERS = (
+    "n_created",
+    "n_updated",
+    "n_unchanged",
+    "n_blobs_written",
+    "n_blobs_skipped",
+    "blob_bytes_written",
+    "blob_bytes_skipped",
+    "n_invalid",
+)
+
+
+class SyncUids(set):
+    """
+    Set of the synced uids that remembers the order they have been added,
+    so each checkpoint writes only the new ones.
+    """
+
+    def __init__(self, *iterables):
+        super().__init__()
+        self.added = []
+        self.update(*iterables)
+
+    def add(self, uid):
+        if uid not in self:
+            super().add(uid)
+            self.added.append(uid)
+
+    def update(self, *iterables):
+        for iterable in iterables:
+            for uid in iterable:
+                self.add(uid)
+
+
+class Checkpoint:
+    """
+    Read and write the checkpoint of the runs on the given source.
+    A source without identity (None) can't be resumed.
+    """
+
+    def __init__(self, portal, source, key=CHECKPOINT_KEY):
+        self.annotations = IAnnotations(portal)
+        self.source = source
+        self.key = key
+        # uids of adapter.sync_uids.added already committed in the checkpoint
+        self.n_saved = 0
+
+    def load(self):
+        """
+        Return the stored checkpoint if it refers to the same source.
+        """
+        if self.source is None:
+            return None
+        data = self.annotations.get(self.key)
+        if data is None or data.get("source") != self.source:
+            return None
+        return data
+
+    def save(self, offset, adapter):
+        """
+        Store the number of rows already handled, the counters and the
+        synced uids of the adapter.
+        """
+        if self.source is None:
+            return
+        data = self.annotations.get(self.key)
+        added = getattr(adapter.sync_uids, "added", None)
+        if data is None or data.get("source") != self.source:
+            data = PersistentMapping()
+            data["source"] = self.source
+            data["sync_uids"] = OOTreeSet()
+            self.annotations[self.key] = data
+            self.n_saved = 0
+        data["offset"] = offset
+        data["counters"] = {name: getattr(adapter, name) for name in COUNTERS}
+        if added is None:
+            data["sync_uids"].update(adapter.sync_uids)
+            return
+        # only the uids added since the last committed checkpoint
+        start = self.n_saved
+        data["sync_uids"].update(added[start:])
+        transaction.get().addAfterCommitHook(self.saved, args=(len(added),))
+
+    def saved(self, success, n_saved):
+        if success:
+            self.n_saved = max(self.n_saved, n_saved)
+
+    def restore(self, adapter):
+        """
+        Restore counters and synced uids on the adapter.
+        Return the number of rows already handled.
+        """
+        data = self.load()
+        if data is None:
+            return 0
+        for name, value in data["counters"].items():
+            setattr(adapter, name, value)
+        adapter.sync_uids.update(data["sync_uids"])
+        # already stored
+        self.n_saved = len(getattr(adapter.sync_uids, "added", ()))
+        return data["offset"]
+
+    def clear(self):
+        if self.key in self.annotations:
+            del self.annotations[self.key]
+        self.n_saved = 0
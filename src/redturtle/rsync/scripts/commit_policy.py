@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Decide when to do an intermediate commit: every x rows, after some time,
+when too many objects are modified or when the process uses too much memory.
+"""
+import resource
+import sys
+import time
+
+# check the memory usage every x rows
+RSS_CHECK_ROWS = 50
+
+
+def get_rss():
+    """
+    Return the resident memory of the process in MB.
+    On systems without /proc, the peak memory usage is returned.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, KB on Linux
+        if sys.platform == "darwin":
+            return rss / 1024 / 1024
+        return rss / 1024
+
+
+class CommitPolicy:
+    """
+    Check the thresholds that trigger an intermediate commit.
+    """
+
+    def __init__(
+        self, every=0, interval=None, max_objects=None, max_rss=None, connection=None
+    ):
+        self.every = every
+        self.interval = interval
+        self.max_objects = max_objects
+        self.max_rss = max_rss
+        self.connection = connection
+        self.reset()
+
+    @property
+    def enabled(self):
+        return bool(self.every or self.interval or self.max_objects or self.max_rss)
+
+    def reset(self):
+        self.last_commit = time.monotonic()
+
+    def modified_objects(self):
+        """
+        Number of persistent objects modified in the current transaction.
+        """
+        if self.connection is None:
+            return 0
+        return len(getattr(self.connection, "_registered_objects", ())) + len(
+            getattr(self.connection, "_added", ())
+        )
+
+    def should_commit(self, i, pending):
+        """
+        Return the reason of the commit before handling row i, or None.
+        pending is the number of rows handled since the last commit.
+        """
+        if self.every and i % self.every == 0:
+            return f"every {self.every} items"
+        if not pending:
+            return None
+        if self.interval and time.monotonic() - self.last_commit >= self.interval:
+            return f"after {self.interval} seconds"
+        if self.max_objects and self.modified_objects() >= self.max_objects:
+            return f"{self.max_objects} modified objects"
+        if self.max_rss and pending % RSS_CHECK_ROWS == 0:
+            if get_rss() >= self.max_rss:
+                return f"memory over {self.max_rss} MB"
+        return None
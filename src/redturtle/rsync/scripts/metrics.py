@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Timings of the phases and operations of a sync, exported as JSON or in the
+Prometheus textfile collector format.
+"""
+import json
+import os
+import random
+import tempfile
+import time
+
+# samples kept for each operation to compute the percentiles
+MAX_SAMPLES = 10000
+QUANTILES = (0.5, 0.95)
+PROMETHEUS_PREFIX = "redturtle_rsync"
+
+
+class Timing:
+    """
+    Count, total and max time of an operation, with a bounded reservoir of
+    samples for the percentiles.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            index = random.randrange(self.count)
+            if index < MAX_SAMPLES:
+                self.samples[index] = seconds
+
+    def percentile(self, q):
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": self.max,
+        }
+
+
+class _Timer:
+    def __init__(self, timing):
+        self.timing = timing
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.timing.add(time.monotonic() - self.start)
+
+
+class Metrics:
+    """
+    Collect the timings of a run:
+
+        with metrics.timer("create_item"):
+            ...
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.gauges = {}
+        self.start = time.time()
+
+    def get_timing(self, name):
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = Timing()
+        return timing
+
+    def timer(self, name):
+        return _Timer(self.get_timing(name))
+
+    def add(self, name, seconds):
+        """
+        Add a time measured elsewhere (e.g. in a worker process).
+        """
+        self.get_timing(name).add(seconds)
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def to_dict(self):
+        duration = time.time() - self.start
+        rows = self.timings.get("rows")
+        rows_time = rows.total if rows else 0.0
+        n_items = self.gauges.get("n_items", 0)
+        return {
+            "start": self.start,
+            "duration": duration,
+            "rows_per_second": n_items / rows_time if rows_time else 0.0,
+            "gauges": dict(self.gauges),
+            "operations": {
+                name: timing.to_dict() for name, timing in sorted(self.timings.items())
+            },
+        }
+
+    def to_prometheus(self):
+        data = self.to_dict()
+        lines = []
+
+        def metric(name, help, type, samples):
+            name = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            for suffix, labels, value in samples:
+                labels = ",".join(f'{k}="{v}"' for k, v in labels)
+                labels = f"{{{labels}}}" if labels else ""
+                lines.append(f"{name}{suffix}{labels} {value}")
+
+        metric(
+            "last_run_timestamp_seconds",
+            "Start time of the last sync.",
+            "gauge",
+            [("", (), data["start"])],
+        )
+        metric(
+            "duration_seconds",
+            "Duration of the last sync.",
+            "gauge",
+            [("", (), data["duration"])],
+        )
+        metric(
+            "rows_per_second",
+            "Rows handled per second.",
+            "gauge",
+            [("", (), data["rows_per_second"])],
+        )
+        metric(
+            "items",
+            "Counters of the last sync.",
+            "gauge",
+            [("", (("counter", k),), v) for k, v in sorted(data["gauges"].items())],
+        )
+        samples = []
+        for name, timing in sorted(self.timings.items()):
+            for q in QUANTILES:
+                labels = (("operation", name), ("quantile", q))
+                samples.append(("", labels, timing.percentile(q)))
+            samples.append(("_sum", (("operation", name),), timing.total))
+            samples.append(("_count", (("operation", name),), timing.count))
+        metric(
+            "operation_seconds",
+            "Time spent in each phase and operation.",
+            "summary",
+            samples,
+        )
+        metric(
+            "operation_max_seconds",
+            "Max time of each phase and operation.",
+            "gauge",
+            [
+                ("", (("operation", name),), timing.max)
+                for name, timing in sorted(self.timings.items())
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, text):
+        """
+        Write the file atomically, as expected by the textfile collector.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, suffix=".tmp", delete=False
+        ) as f:
+            f.write(text)
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+
+    def write_json(self, path):
+        self.write(path, json.dumps(self.to_dict(), indent=2))
+
+    def write_prometheus(self, path):
+        self.write(path, self.to_prometheus())
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Read (and convert) the source rows in a background thread, while the main
+thread only does the Zope/ZODB work.
+"""
+import queue
+import threading
+import time
+
+_done = object()
+
+
+class _ProducerError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class Pipeline:
+    """
+    Iterate over data in a background thread, feeding a bounded queue.
+
+    The time spent by the consumer waiting for new rows (starved) and
+    handling them (busy) is measured.
+    The producer must not access the ZODB, nor log: rows are only read and
+    converted there, and its errors are raised by the consumer.
+    """
+
+    def __init__(self, data, queue_size=1000):
+        self.data = data
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.thread = None
+        self.starved = 0.0
+        self.busy = 0.0
+
+    def produce(self):
+        try:
+            for row in self.data:
+                if not self.put(row):
+                    return
+        except Exception as e:
+            self.put(_ProducerError(e))
+            return
+        self.put(_done)
+
+    def put(self, item):
+        """
+        Put an item in the queue, giving up if the consumer has been closed.
+        """
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        self.thread = threading.Thread(
+            target=self.produce, name="redturtle.rsync.pipeline", daemon=True
+        )
+        self.thread.start()
+        try:
+            while True:
+                start = time.monotonic()
+                item = self.queue.get()
+                self.starved += time.monotonic() - start
+                if item is _done:
+                    return
+                if isinstance(item, _ProducerError):
+                    raise item.exception
+                start = time.monotonic()
+                yield item
+                self.busy += time.monotonic() - start
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            # the producer gives up within the put timeout
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Profile a sync: cProfile stats for each phase (or for a sample of the rows)
+and periodic tracemalloc snapshots.
+"""
+from contextlib import contextmanager
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+# allocation sites recorded in each tracemalloc snapshot
+TOP_ALLOCATIONS = 20
+# functions written in the text summary of each profile
+TOP_FUNCTIONS = 40
+
+
+class Profiler:
+    """
+    Files are written in directory.
+    With profile, every phase is profiled and its stats are dumped in
+    <phase>.prof (for pstats/snakeviz) and <phase>.txt.
+    With sample > 1, only one row every sample rows is profiled, instead of
+    the whole rows phase.
+    With tracemalloc_every, a snapshot of the top allocation sites and of the
+    ZODB cache size is appended to tracemalloc.ndjson every x rows.
+    """
+
+    def __init__(
+        self,
+        directory=".",
+        profile=False,
+        sample=1,
+        tracemalloc_every=0,
+        connection=None,
+    ):
+        self.directory = directory
+        self.profile = profile
+        self.sample = sample or 1
+        self.tracemalloc_every = tracemalloc_every
+        self.connection = connection
+        self.rows_profile = None
+        if profile or tracemalloc_every:
+            os.makedirs(directory, exist_ok=True)
+        if profile and self.sample > 1:
+            self.rows_profile = cProfile.Profile()
+        if tracemalloc_every and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.profile or (name == "rows" and self.rows_profile is not None):
+            yield
+            return
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.dump(name=name, profile=profile)
+
+    def row(self, i, handle):
+        """
+        Call handle for the row i, profiling it if it is in the sample.
+        """
+        if self.tracemalloc_every and i % self.tracemalloc_every == 0:
+            self.snapshot(i)
+        if self.rows_profile is not None and i % self.sample == 0:
+            self.rows_profile.runcall(handle)
+        else:
+            handle()
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def dump(self, name, profile):
+        profile.dump_stats(self.path(f"{name}.prof"))
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        with open(self.path(f"{name}.txt"), "w") as f:
+            f.write(out.getvalue())
+
+    def cache_size(self):
+        cache = getattr(self.connection, "_cache", None)
+        if cache is None:
+            return {}
+        return {
+            "objects": len(cache),
+            "non_ghost": getattr(cache, "cache_non_ghost_count", None),
+            "target_size": getattr(cache, "cache_size", None),
+        }
+
+    def snapshot(self, i):
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        top = snapshot.statistics("lineno")[:TOP_ALLOCATIONS]
+        record = {
+            "row": i,
+            "time": time.time(),
+            "traced": current,
+            "peak": peak,
+            "zodb_cache": self.cache_size(),
+            "top": [
+                {"where": str(stat.traceback), "size": stat.size, "count": stat.count}
+                for stat in top
+            ],
+        }
+        with open(self.path("tracemalloc.ndjson"), "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def close(self):
+        if self.rows_profile is not None:
+            self.dump(name="rows", profile=self.rows_profile)
+            self.rows_profile = None
+        if self.tracemalloc_every and tracemalloc.is_tracing():
+            tracemalloc.stop()
@@ -1,18 +1,67 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
 from plone import api
+from redturtle.rsync.adapters.orphans import parse_max_delete
+from redturtle.rsync.adapters.schema import InvalidRow
+from redturtle.rsync.adapters.schema import source_row
+from redturtle.rsync.adapters.schema import valid_rows
+from redturtle.rsync.adapters.sources import COMPRESSIONS
+from redturtle.rsync.adapters.sources import DECODERS
 from redturtle.rsync.interfaces import IRedturtleRsyncAdapter
+from redturtle.rsync.scripts.checkpoint import Checkpoint
+from redturtle.rsync.scripts.checkpoint import CHECKPOINT_KEY
+from redturtle.rsync.scripts.commit_policy import CommitPolicy
+from redturtle.rsync.scripts.pipeline import Pipeline
+from redturtle.rsync.scripts.profiling import Profiler
+from redturtle.rsync.scripts.shards import shard_of
+from redturtle.rsync.scripts.shards import ShardResults
+from redturtle.rsync.scripts.shards import SHARDS_KEY
+from redturtle.rsync.scripts.snapshot import Snapshot
+from ZODB.POSException import ConflictError
 from zope.component import getMultiAdapter
 
 import argparse
+import contextlib
+import functools
+import itertools
 import logging
+import os
+import random
 import sys
+import time
 import transaction
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+def iter_batches(data, size):
+    """
+    Split data in lists of at most size rows.
+    """
+    iterator = iter(data)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_ahead(batches, callback):
+    """
+    Yield the batches, calling callback with each batch before the previous
+    one is yielded.
+    """
+    previous = None
+    for batch in batches:
+        callback(batch)
+        if previous is not None:
+            yield previous
+        previous = batch
+    if previous is not None:
+        yield previous
+
+
 class ScriptRunner:
     """
     Run the script.
@@ -24,6 +73,8 @@ class ScriptRunner:
 
         self.options = self.get_args(args=args)
         self.adapter.options = self.options
+        self.n_conflicts = 0
+        self.n_replays = 0
 
     def get_args(self, args):
         """
@@ -37,6 +88,19 @@ class ScriptRunner:
             "--dry-run", action="store_true", default=False, help="Dry-run mode"
         )
 
+        # plan mode
+        parser.add_argument(
+            "--plan",
+            action="store_true",
+            default=False,
+            help="Only report what the sync would create, update and delete, without loading or changing the items",
+        )
+        parser.add_argument(
+            "--plan-file",
+            default=None,
+            help="With --plan, write the planned action of each row in this NDJSON file (gzipped if it ends with .gz)",
+        )
+
         # verbose mode
         parser.add_argument(
             "--verbose", action="store_true", default=False, help="Verbose mode"
@@ -62,18 +126,604 @@ class ScriptRunner:
             default=None,
             help="Do an intermediate commit every x items",
         )
+        parser.add_argument(
+            "--commit-interval",
+            default=None,
+            type=float,
+            help="Do an intermediate commit every x seconds",
+        )
+        parser.add_argument(
+            "--commit-max-objects",
+            default=None,
+            type=int,
+            help="Do an intermediate commit when x persistent objects are modified",
+        )
+        parser.add_argument(
+            "--commit-max-rss",
+            default=None,
+            type=int,
+            help="Do an intermediate commit when the process memory is over x MB",
+        )
+        parser.add_argument(
+            "--cache-gc",
+            choices=["gc", "minimize"],
+            default=None,
+            help="Reduce the ZODB cache after intermediate commits: gc (to the configured cache size) or minimize (ghostify all objects)",
+        )
+        parser.add_argument(
+            "--deferred-reindex",
+            choices=["commit", "end"],
+            default=None,
+            help="Queue the catalog reindex of synced items and do it once per item: before each commit or at the end of the sync",
+        )
+        # read the source lazily
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            default=False,
+            help="Streaming mode: read source rows lazily instead of loading them all in memory",
+        )
+        # source decoding
+        parser.add_argument(
+            "--source-format",
+            choices=sorted(DECODERS),
+            default=None,
+            help="Source format (default: guessed from extension, Content-Type or content)",
+        )
+        parser.add_argument(
+            "--source-compression",
+            choices=["none"] + sorted(COMPRESSIONS),
+            default=None,
+            help="Source compression (default: guessed from extension, Content-Type or content)",
+        )
+        # lookup index
+        parser.add_argument(
+            "--lookup-index",
+            choices=["preload", "window"],
+            default=None,
+            help="Find items with a lookup index (needs adapter support): preload all keys at start or load them for each batch of rows",
+        )
+        parser.add_argument(
+            "--batch-size",
+            default=100,
+            type=int,
+            help="Number of rows prepared together (e.g. keys loaded in the lookup window)",
+        )
+        # fingerprints
+        parser.add_argument(
+            "--fingerprints",
+            action="store_true",
+            default=False,
+            help="Skip rows not changed since last sync, comparing their fingerprints (needs adapter support)",
+        )
+        # resumable runs
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            default=False,
+            help="Resume the sync from the last checkpoint (saved at each intermediate commit)",
+        )
+        parser.add_argument(
+            "--max-duration",
+            default=None,
+            type=int,
+            help="Stop the sync after x seconds, saving a checkpoint to resume it",
+        )
+        # pipeline
+        parser.add_argument(
+            "--pipeline",
+            action="store_true",
+            default=False,
+            help="Read and convert source rows in a background thread",
+        )
+        parser.add_argument(
+            "--queue-size",
+            default=1000,
+            type=int,
+            help="Max number of rows read in advance in pipeline mode",
+        )
+        parser.add_argument(
+            "--convert-workers",
+            default=0,
+            type=int,
+            help="In streaming mode, convert batches of --batch-size rows in x worker processes",
+        )
+        # sharding
+        parser.add_argument(
+            "--shards",
+            default=None,
+            type=int,
+            help="Split the sync in x shards, run by different processes (needs adapter support)",
+        )
+        parser.add_argument(
+            "--shard-index",
+            default=None,
+            type=int,
+            help="Index of the shard handled by this process (from 0 to shards - 1)",
+        )
+        parser.add_argument(
+            "--merge-shards",
+            action="store_true",
+            default=False,
+            help="Merge the results of all the shards, run the delete phase and write the log",
+        )
+        # conflict errors
+        parser.add_argument(
+            "--conflict-retries",
+            default=3,
+            type=int,
+            help="Number of retries of a commit that raises a ConflictError",
+        )
+        parser.add_argument(
+            "--conflict-backoff",
+            default=1.0,
+            type=float,
+            help="Seconds to wait before the first retry of a commit (doubled at each retry)",
+        )
+        # metrics
+        parser.add_argument(
+            "--metrics-file",
+            default=None,
+            help="Write the timings of phases and operations of the sync in this JSON file",
+        )
+        parser.add_argument(
+            "--metrics-prometheus",
+            default=None,
+            help="Write the metrics of the sync in this file, in the Prometheus textfile collector format",
+        )
+        # profiling
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            default=False,
+            help="Profile each phase with cProfile and dump the stats in --profile-dir",
+        )
+        parser.add_argument(
+            "--profile-sample",
+            default=1,
+            type=int,
+            help="Profile only one row every x rows, instead of the whole rows phase",
+        )
+        parser.add_argument(
+            "--tracemalloc",
+            default=0,
+            type=int,
+            help="Record the top allocation sites and the ZODB cache size every x rows",
+        )
+        parser.add_argument(
+            "--profile-dir",
+            default=None,
+            help="Directory of the profiling output (default: the directory of --metrics-file, or the current one)",
+        )
         # set data source
         group = parser.add_mutually_exclusive_group(required=True)
         group.add_argument("--source-path", help="Local source path")
         group.add_argument("--source-url", help="Remote source URL")
+        parser.add_argument(
+            "--source-pages",
+            action="store_true",
+            default=False,
+            help="The source URL is a paged JSON API (plone.restapi-like batching, next links or offset/limit parameters)",
+        )
+        parser.add_argument(
+            "--page-size",
+            default=None,
+            type=int,
+            help="With --source-pages, number of rows requested for each page (default: the size of the first page)",
+        )
+        parser.add_argument(
+            "--page-workers",
+            default=4,
+            type=int,
+            help="With --source-pages, number of pages fetched concurrently",
+        )
+        parser.add_argument(
+            "--page-offset-param",
+            default="b_start",
+            help="With --source-pages, query parameter of the page offset",
+        )
+        parser.add_argument(
+            "--page-limit-param",
+            default="b_size",
+            help="With --source-pages, query parameter of the page size",
+        )
+        parser.add_argument(
+            "--snapshot",
+            default=None,
+            help="Keep a snapshot of the source rows in this file, and sync only the rows added, changed or removed since the last run",
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            default=False,
+            help="With --snapshot, sync all the rows (and update the snapshot)",
+        )
+        parser.add_argument(
+            "--max-delete",
+            default=None,
+            help="Don't delete anything if the items to delete are more than x (or x%% of the items returned by the adapter delete query)",
+        )
+        parser.add_argument(
+            "--no-delete",
+            action="store_true",
+            default=False,
+            help="Skip the delete phase",
+        )
+        parser.add_argument(
+            "--dead-letter",
+            default=None,
+            help="Append the rows that can't be synced to this NDJSON file, that can be used as the source of a new run",
+        )
+        parser.add_argument(
+            "--asset-cache",
+            default=None,
+            help="Directory of the cache of the assets downloaded by the adapter (default: a temporary directory)",
+        )
+        parser.add_argument(
+            "--asset-workers",
+            default=8,
+            type=int,
+            help="Number of assets downloaded concurrently",
+        )
+        parser.add_argument(
+            "--source-cache",
+            default=None,
+            help="Download the source URL in this directory, with conditional requests and resume of interrupted downloads",
+        )
+        parser.add_argument(
+            "--skip-not-modified",
+            action="store_true",
+            default=False,
+            help="With --source-cache, skip the sync if the source has not been modified since the last download",
+        )
 
         # then get from the adapter
         self.adapter.set_args(parser)
 
         # Parsing degli argomenti
         options = parser.parse_args(args)
+
+        self.check_options(parser, options)
         return options
 
+    def check_options(self, parser, options):
+        """
+        Check the combinations of options, exiting with an error if they
+        are invalid.
+        """
+        if options.max_delete:
+            try:
+                parse_max_delete(options.max_delete)
+            except ValueError:
+                parser.error("--max-delete must be a number or a percentage")
+        if options.snapshot and (options.shards or options.plan):
+            parser.error("--snapshot can't be used with --shards or --plan")
+        if options.dead_letter and options.dead_letter == options.source_path:
+            parser.error("--dead-letter can't be the same file of --source-path")
+        if options.convert_workers and not options.stream:
+            parser.error("--convert-workers needs --stream")
+        if options.full and not options.snapshot:
+            parser.error("--full needs --snapshot")
+        if options.plan:
+            if options.shards or options.resume:
+                parser.error("--plan can't be used with --shards or --resume")
+            if not self.adapter.lookup_key_index or not self.adapter.has_row_key():
+                parser.error(
+                    "--plan needs an adapter with lookup_key_index and get_row_key"
+                )
+            if not options.lookup_index:
+                # rows are classified without loading their items
+                options.lookup_index = "preload"
+        elif options.plan_file:
+            parser.error("--plan-file needs --plan")
+        if options.source_pages and not options.source_url:
+            parser.error("--source-pages needs --source-url")
+        if options.skip_not_modified and not options.source_cache:
+            parser.error("--skip-not-modified needs --source-cache")
+        if options.deferred_reindex == "end" and (
+            options.intermediate_commit
+            or options.commit_interval
+            or options.commit_max_objects
+            or options.commit_max_rss
+        ):
+            # committed items would not be cataloged until the end of the sync
+            parser.error(
+                "--deferred-reindex end can't be used with intermediate commits: use commit"
+            )
+        self.check_shard_options(parser, options)
+        self.check_adapter_options(parser, options)
+
+    def check_adapter_options(self, parser, options):
+        """
+        Check that the adapter implements what the options need.
+        """
+        if not self.adapter.has_row_key():
+            # rows are identified by get_row_key
+            for name in ("snapshot", "shards", "lookup_index", "fingerprints"):
+                if getattr(options, name):
+                    parser.error(
+                        f"--{name.replace('_', '-')} needs an adapter with get_row_key"
+                    )
+
+    def check_shard_options(self, parser, options):
+        if options.shards:
+            if options.merge_shards:
+                if options.shard_index is not None:
+                    parser.error("--shard-index can't be used with --merge-shards")
+            elif options.shard_index is None or not (
+                0 <= options.shard_index < options.shards
+            ):
+                parser.error(
+                    f"--shard-index must be between 0 and {options.shards - 1}"
+                )
+        elif options.shard_index is not None or options.merge_shards:
+            parser.error("--shard-index and --merge-shards need --shards")
+
+    def iterate_data(self, data):
+        """
+        Create or update the items for each row of data.
+        """
+        policy = self.get_commit_policy()
+        plan = self.adapter.plan is not None
+        # intermediate commits are disabled in dry-run and plan mode
+        commits = (
+            policy.enabled and not getattr(self.options, "dry_run", False) and not plan
+        )
+        batch_size = int(getattr(self.options, "batch_size", 0) or 100)
+        max_duration = getattr(self.options, "max_duration", None)
+        deadline = max_duration and time.monotonic() + max_duration
+
+        n_items = self.adapter.get_data_total(data)
+        if self.is_shard_worker():
+            data = self.filter_shard(data)
+            # only a part of the rows will be handled
+            n_items = None
+        if n_items is None:
+            logger.info("START - ITERATE DATA")
+        else:
+            logger.info(f"START - ITERATE DATA ({n_items} items)")
+
+        offset = 0
+        if not plan:
+            data, offset = self.resume(data)
+        handle = self.adapter.plan_item if plan else self.adapter.create_or_update_item
+
+        pipeline = None
+        if getattr(self.options, "pipeline", False):
+            pipeline = Pipeline(data=data, queue_size=self.options.queue_size)
+            # errors of the producer thread are raised here, and logged
+            data = self.adapter.guard_source(pipeline)
+
+        # rows handled since the last commit, replayed on conflict errors
+        pending = []
+        state = self.adapter.get_state()
+        # last_commit = 0
+        i = offset
+        try:
+            batches = (
+                self.adapter.validate_batch(batch)
+                for batch in iter_batches(data, size=batch_size)
+            )
+            if not plan:
+                batches = iter_ahead(
+                    batches,
+                    callback=lambda batch: self.adapter.prefetch_assets(
+                        valid_rows(batch)
+                    ),
+                )
+            for batch in batches:
+                self.adapter.prepare_batch(rows=[source_row(row) for row in batch])
+                for j, row in enumerate(batch):
+                    if deadline and time.monotonic() > deadline:
+                        # stop here: the final commit will store the checkpoint
+                        self.checkpoint.save(offset=i, adapter=self.adapter)
+                        self.interrupted = True
+                        logger.info(f"MAX DURATION REACHED, STOP AT ROW {i}")
+                        break
+                    # the row is counted only if it is handled
+                    i += 1
+                    if i % 100 == 0:
+                        if n_items is None:
+                            logger.info(f"Progress: {i}")
+                        else:
+                            logger.info(f"Progress: {i}/{n_items}")
+                    reason = commits and policy.should_commit(i, pending=len(pending))
+                    if reason:
+                        # rows before this one are committed with the checkpoint
+                        self.intermediate_commit(
+                            reason=reason,
+                            offset=i - 1,
+                            replay=functools.partial(
+                                self.replay_rows,
+                                state=state,
+                                rows=pending,
+                                upcoming=batch[j:],
+                            ),
+                        )
+                        policy.reset()
+                        pending = []
+                        state = self.adapter.get_state()
+                    self.handle_row(i, row=row, handle=handle)
+                    if commits:
+                        pending.append(row)
+                if self.interrupted:
+                    break
+            if commits and pending:
+                # commit the last rows, so the final commit only has to
+                # replay the last phases
+                self.intermediate_commit(
+                    reason="end of rows",
+                    offset=i,
+                    replay=functools.partial(
+                        self.replay_rows, state=state, rows=pending, upcoming=[]
+                    ),
+                )
+                self.rows_committed = True
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+        if not self.adapter.n_items:
+            self.adapter.n_items = i
+        if pipeline is not None:
+            self.adapter.log_info(
+                msg=f"Pipeline: writer busy for {pipeline.busy:.1f}s, starved for {pipeline.starved:.1f}s.",
+                force_sys_log=True,
+            )
+
+    def handle_row(self, i, row, handle):
+        """
+        Handle the row, or reject it if it's invalid (see row_schema).
+        """
+        if isinstance(row, InvalidRow):
+            self.adapter.reject_row(row)
+        else:
+            self.profiler.row(i, functools.partial(handle, row=row))
+
+    def apply_snapshot(self):
+        """
+        With --snapshot, report the diff and pass the removed rows to the
+        delete phase.
+        """
+        snapshot = self.snapshot
+        if snapshot is None or self.interrupted:
+            return
+        full = getattr(self.options, "full", False)
+        self.adapter.n_items = snapshot.n_rows
+        if not full:
+            self.adapter.n_unchanged += snapshot.n_unchanged
+            # a truncated source must not delete anything
+            self.adapter.removed_keys = (
+                [] if self.adapter.source_error else snapshot.removed_keys
+            )
+        self.adapter.log_info(
+            msg=f"Snapshot: {snapshot.n_added} added, {snapshot.n_changed} changed, {snapshot.n_unchanged} unchanged, {len(snapshot.removed_keys)} removed rows.",
+            force_sys_log=True,
+        )
+
+    def save_snapshot(self):
+        """
+        Replace the snapshot after the final commit of a complete run.
+        Failed rows are left out, to be synced again by the next run.
+        """
+        if self.snapshot is None:
+            return
+        if (
+            self.interrupted
+            or self.adapter.source_error
+            or getattr(self.options, "dry_run", False)
+        ):
+            self.snapshot.discard()
+            return
+        self.snapshot.save(exclude=self.adapter.failed_keys)
+
+    def get_profiler(self):
+        metrics_file = getattr(self.options, "metrics_file", None)
+        directory = getattr(self.options, "profile_dir", None)
+        if not directory:
+            directory = os.path.dirname(os.path.abspath(metrics_file or "rsync"))
+        return Profiler(
+            directory=directory,
+            profile=getattr(self.options, "profile", False),
+            sample=getattr(self.options, "profile_sample", 1),
+            tracemalloc_every=getattr(self.options, "tracemalloc", 0),
+            connection=api.portal.get()._p_jar,
+        )
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time (and profile) a phase of the sync.
+        """
+        with self.adapter.metrics.timer(name), self.profiler.phase(name):
+            yield
+
+    def get_commit_policy(self):
+        intermediate_commit = getattr(self.options, "intermediate_commit", 0) or 0
+        return CommitPolicy(
+            every=int(intermediate_commit),
+            interval=getattr(self.options, "commit_interval", None),
+            max_objects=getattr(self.options, "commit_max_objects", None),
+            max_rss=getattr(self.options, "commit_max_rss", None),
+            connection=api.portal.get()._p_jar,
+        )
+
+    def intermediate_commit(self, reason, offset, replay):
+        msg = f"RSYNC INTERMEDIATE COMMIT ({reason})."
+        self.commit(note=msg, offset=offset, replay=replay)
+        logger.info(msg)
+        # keep the pickle cache bounded
+        cache = getattr(self.options, "cache_gc", None)
+        connection = api.portal.get()._p_jar
+        if cache == "gc":
+            connection.cacheGC()
+        elif cache == "minimize":
+            connection.cacheMinimize()
+
+    def resume(self, data):
+        """
+        With --resume, skip the rows already committed in the last checkpoint.
+        Return the rows to handle and the number of skipped rows.
+        """
+        if not getattr(self.options, "resume", False):
+            self.checkpoint.clear()
+            return data, 0
+        if self.checkpoint.source is None:
+            self.checkpoint.clear()
+            self.adapter.log_info(
+                msg="The source URL has no ETag or Last-Modified header: it can't be resumed, the sync starts from the first row.",
+                type="warning",
+            )
+            return data, 0
+        offset = self.checkpoint.restore(adapter=self.adapter)
+        if not offset:
+            logger.info("NO CHECKPOINT FOUND FOR THIS SOURCE, START FROM FIRST ROW")
+            return data, 0
+        logger.info(f"RESUME FROM ROW {offset}")
+        return itertools.islice(data, offset, None), offset
+
+    def is_shard_worker(self):
+        return bool(getattr(self.options, "shards", None)) and not getattr(
+            self.options, "merge_shards", False
+        )
+
+    def filter_shard(self, data):
+        """
+        Yield only the rows of this shard, partitioned by row key.
+        """
+        shards = self.options.shards
+        index = self.options.shard_index
+        for row in data:
+            try:
+                key = self.adapter.get_row_key(source_row(row))
+            except Exception as e:
+                logger.exception(e)
+                key = None
+            # rows without a key are handled by the first shard
+            shard = 0 if key is None else shard_of(key, shards)
+            if shard == index:
+                yield row
+
+    def merge_shards(self):
+        """
+        Merge the results of all the shards into the adapter.
+        Return False if some shard has not completed yet.
+        """
+        missing = self.shard_results.missing()
+        if missing:
+            self.adapter.log_info(
+                msg=f"Missing results for shards {', '.join(str(i + 1) for i in missing)}: skip merge.",
+                type="error",
+            )
+            return False
+        if len(self.shard_results.versions()) > 1:
+            self.adapter.log_info(
+                msg="The shards have read different versions of the source: skip merge.",
+                type="error",
+            )
+            return False
+        self.shard_results.merge(adapter=self.adapter)
+        return True
+
     def rsync(self):
         """
         Do the rsync.
@@ -83,42 +733,56 @@ class ScriptRunner:
 
         # setup environment
         self.adapter.setup_environment()
+        self.adapter.setup_lookup()
+        self.adapter.setup_plan()
+        self.adapter.setup_dead_letter()
+        self.adapter.setup_fingerprints()
+        # to redo the whole sync if the final commit is aborted
+        self.start_state = self.adapter.get_state()
+        portal = api.portal.get()
+        shards = getattr(self.options, "shards", None)
+        self.shard_results = None
+        if shards:
+            # the merge does not read the source: the version of a source URL
+            # is checked by merge_shards
+            source = self.options.source_url or self.adapter.get_source_identity()
+            self.shard_results = ShardResults(
+                portal=portal,
+                source=source,
+                shards=shards,
+                key=self.adapter.get_annotation_key(SHARDS_KEY),
+            )
+        self.interrupted = False
+        self.rows_committed = False
+        self.snapshot = None
 
-        # get data
-        data = self.adapter.get_data()
-
-        intermediate_commit = getattr(self.options, "intermediate_commit", 0) or 0
-
-        intermediate_commit = int(intermediate_commit)
-
-        # iterate data
-        if data:
-            n_items = len(data)
-            logger.info(f"START - ITERATE DATA ({n_items} items)")
-
-            # last_commit = 0
-            i = 0
-            for row in data:
-                i += 1
-                if i % 100 == 0:
-                    logger.info(f"Progress: {i}/{n_items}")
-                if intermediate_commit and not getattr(self.options, "dry_run", False):
-                    if i % intermediate_commit == 0:
-                        msg = f"RSYNC INTERMEDIATE COMMIT EVERY {intermediate_commit} items."
-                        transaction.get().note(msg)
-                        transaction.commit()
-                        logger.info(msg)
-                self.adapter.create_or_update_item(row=row)
+        self.profiler = self.get_profiler()
 
-        self.adapter.delete_items(data)
+        self.merged = True
+        data = None
+        if getattr(self.options, "merge_shards", False):
+            # rows have been already handled by the shards: the source is
+            # not read again
+            self.checkpoint = self.get_checkpoint()
+            self.merged = self.merge_shards()
+        else:
+            data = self.read_data()
+            if data:
+                # iterate data
+                with self.phase("rows"):
+                    self.iterate_data(data)
+                self.apply_snapshot()
 
-        # do something at the end
-        self.adapter.end_actions(data)
+        self.data = data
+        self.adapter.close_assets()
+        self.adapter.close_dead_letter()
+        self.finish_state = self.adapter.get_state()
+        if self.adapter.plan is not None:
+            self.finish_plan()
+        else:
+            self.finish(data)
+        self.profiler.close()
 
-        # finish, write log
-        self.adapter.write_log()
-        # send log by email
-        self.adapter.send_log()
         end = datetime.now()
         delta = end - start
         total_seconds = int(delta.total_seconds())
@@ -131,17 +795,286 @@ class ScriptRunner:
             f"[{end}] - END RSYNC (duration {hours:02d}:{minutes:02d}:{seconds:02d})"
         )
 
+    def get_checkpoint(self):
+        # each adapter (and shard) has its own checkpoint
+        checkpoint_key = self.adapter.get_annotation_key(CHECKPOINT_KEY)
+        if self.is_shard_worker():
+            checkpoint_key = f"{checkpoint_key}.{self.options.shard_index}"
+        return Checkpoint(
+            portal=api.portal.get(),
+            source=self.adapter.get_source_identity(),
+            key=checkpoint_key,
+        )
+
+    def read_data(self):
+        """
+        Get the source data, filtered by --snapshot.
+        """
+        with self.phase("get_data"):
+            data = self.adapter.get_data()
+
+        # the identity of a source URL is known when it has been read
+        self.checkpoint = self.get_checkpoint()
+
+        if (
+            getattr(self.options, "snapshot", None)
+            and data
+            and not self.adapter.dead_letter_source
+        ):
+            self.snapshot = Snapshot(path=self.options.snapshot)
+            data = self.snapshot.diff(
+                data,
+                get_key=lambda row: self.adapter.get_row_key(source_row(row)),
+                get_fingerprint=lambda row: self.adapter.get_row_fingerprint(
+                    source_row(row)
+                ),
+                full=getattr(self.options, "full", False),
+            )
+        return data
+
+    def finish(self, data):
+        """
+        Last phases of the sync: delete items, end actions and log.
+        """
+        shards = getattr(self.options, "shards", None)
+        shard_worker = self.is_shard_worker()
+        if self.adapter.fingerprints is not None:
+            self.adapter.log_info(
+                msg=f"Unchanged rows skipped: {self.adapter.n_unchanged}.",
+                force_sys_log=True,
+            )
+        if self.adapter.lookup is not None:
+            self.adapter.log_info(
+                msg=f"Lookup index: {self.adapter.lookup.hits} hits, {self.adapter.lookup.misses} misses.",
+                force_sys_log=True,
+            )
+        if self.adapter.get_row_validator() is not None:
+            timing = self.adapter.metrics.timings.get("validate")
+            self.adapter.log_info(
+                msg=f"Validation: {self.adapter.n_invalid} rows rejected in {timing.total if timing else 0.0:.1f} seconds.",
+                force_sys_log=True,
+            )
+        if self.adapter.n_blobs_written or self.adapter.n_blobs_skipped:
+            self.adapter.log_info(
+                msg=f"Blobs: {self.adapter.n_blobs_written} written ({self.adapter.blob_bytes_written} bytes), {self.adapter.n_blobs_skipped} unchanged ({self.adapter.blob_bytes_skipped} bytes skipped).",
+                force_sys_log=True,
+            )
+
+        # queued items of --deferred-reindex (even in dry-run), before the
+        # delete phase
+        self.adapter.flush_reindex()
+        if getattr(self.options, "deferred_reindex", None):
+            reindex = self.adapter.reindex_queue
+            self.adapter.log_info(
+                msg=f"Deferred reindex: {reindex.n_reindexed} items in {reindex.time:.1f} seconds.",
+                force_sys_log=True,
+            )
+
+        if self.adapter.source_not_modified:
+            self.adapter.log_info(
+                msg="Source not modified: sync skipped.", force_sys_log=True
+            )
+        elif self.interrupted:
+            self.adapter.log_info(
+                msg=f"Sync stopped after {self.options.max_duration} seconds: run it again with --resume to continue.",
+                type="warning",
+            )
+        elif shard_worker:
+            # delete phase and log are done when merging the shards
+            self.checkpoint.clear()
+            self.shard_results.save(
+                index=self.options.shard_index, adapter=self.adapter
+            )
+            logger.info(
+                f"SHARD {self.options.shard_index + 1}/{shards} COMPLETED: run with --merge-shards when all shards are completed."
+            )
+        elif self.merged:
+            if self.delete_enabled():
+                with self.phase("delete_items"):
+                    self.adapter.delete_items(data)
+
+            # do something at the end
+            with self.phase("end_actions"):
+                self.adapter.end_actions(data)
+            self.checkpoint.clear()
+            if self.shard_results is not None:
+                self.shard_results.clear()
+
+        if self.n_conflicts:
+            self.adapter.log_info(
+                msg=f"Conflict errors on commit: {self.n_conflicts}, replayed rows: {self.n_replays}.",
+                type="warning",
+            )
+
+        if not shard_worker:
+            # finish, write log
+            with self.phase("write_log"):
+                self.adapter.write_log()
+            # send log by email
+            with self.phase("send_log"):
+                self.adapter.send_log()
+
+    def delete_enabled(self):
+        """
+        The delete phase is skipped with --no-delete, and when the source is
+        a dead-letter file (it has only the rows that failed).
+        It is never run if the source has not been read completely: the
+        items of the missing rows would be deleted.
+        """
+        if getattr(self.options, "no_delete", False) or self.adapter.dead_letter_source:
+            return False
+        if self.adapter.source_error:
+            msg = "The source has not been read completely: delete phase skipped."
+        elif not self.adapter.n_items:
+            msg = "No rows read from the source: delete phase skipped."
+        else:
+            return True
+        self.adapter.log_info(msg=msg, type="error")
+        return False
+
+    def finish_plan(self):
+        """
+        Last phases of --plan: the deletes are planned too, then everything
+        is discarded but the report.
+        """
+        plan = self.adapter.plan
+        if (
+            not self.interrupted
+            and not self.adapter.source_not_modified
+            and self.delete_enabled()
+        ):
+            with self.phase("delete_items"):
+                self.adapter.plan_deletes()
+        transaction.abort()
+        counts = ", ".join(f"{n} {action}" for action, n in plan.counts.items())
+        self.adapter.log_info(msg=f"Sync plan: {counts}.", force_sys_log=True)
+        plan_file = getattr(self.options, "plan_file", None)
+        if plan_file:
+            plan.write(plan_file)
+        with self.phase("write_log"):
+            self.adapter.write_log()
+        with self.phase("send_log"):
+            self.adapter.send_log()
+        plan.close()
+
+    def replay_finish(self):
+        """
+        Redo the last phases after an aborted final commit.
+        """
+        self.adapter.restore_state(self.finish_state)
+        self.finish(self.data)
+
+    def replay_sync(self):
+        """
+        Redo the whole sync after an aborted final commit, when its rows
+        have not been committed yet (e.g. without intermediate commits).
+        """
+        # e.g. remove the rows appended to the dead-letter file
+        self.adapter.restore_state(self.start_state)
+        self.adapter.reset()
+        self.rsync()
+        self.n_replays += self.adapter.n_items
+
+    def final_commit(self):
+        """
+        Commit the sync. On conflict errors only the last phases are redone
+        if the rows have been already committed, otherwise the whole sync.
+        """
+        logger.info("FINAL COMMIT")
+        self.commit(
+            note=self.adapter.log_item_title(start=self.adapter.start),
+            replay=self.replay_finish if self.rows_committed else self.replay_sync,
+        )
+
+    def commit(self, note, replay=None, offset=None):
+        """
+        Commit the transaction, retrying on ConflictError: the transaction
+        is aborted and replay is called to redo its changes before retrying
+        (without replay the error is raised, as the changes are lost).
+        If offset is given, a checkpoint is saved in the same transaction.
+        """
+        retries = getattr(self.options, "conflict_retries", 3)
+        backoff = getattr(self.options, "conflict_backoff", 1.0)
+        attempt = 0
+        while True:
+            if getattr(self.options, "deferred_reindex", None) == "commit":
+                self.adapter.flush_reindex()
+            if offset is not None:
+                self.checkpoint.save(offset=offset, adapter=self.adapter)
+            transaction.get().note(note)
+            try:
+                with self.adapter.metrics.timer("commit"):
+                    transaction.commit()
+                self.adapter.reindex_queue.clear()
+                return
+            except ConflictError as e:
+                transaction.abort()
+                # reindexed items must be reindexed again
+                self.adapter.reindex_queue.requeue()
+                self.n_conflicts += 1
+                attempt += 1
+                if replay is None or attempt > retries:
+                    logger.error(f"CONFLICT ERROR ON COMMIT, GIVE UP: {e}")
+                    raise
+                wait = backoff * 2 ** (attempt - 1) * random.uniform(1, 1.5)
+                logger.warning(
+                    f"CONFLICT ERROR ON COMMIT, RETRY {attempt}/{retries} IN {wait:.1f}s: {e}"
+                )
+                time.sleep(wait)
+                replay()
+
+    def write_metrics(self):
+        """
+        Write the metrics files, if requested.
+        """
+        json_path = getattr(self.options, "metrics_file", None)
+        prometheus_path = getattr(self.options, "metrics_prometheus", None)
+        if not json_path and not prometheus_path:
+            return
+        metrics = self.adapter.metrics
+        for name in (
+            "n_items",
+            "n_created",
+            "n_updated",
+            "n_unchanged",
+            "n_todelete",
+            "n_invalid",
+            "n_blobs_written",
+            "n_blobs_skipped",
+            "blob_bytes_written",
+            "blob_bytes_skipped",
+        ):
+            metrics.set(name, getattr(self.adapter, name))
+        metrics.set("conflicts", self.n_conflicts)
+        if json_path:
+            metrics.write_json(json_path)
+        if prometheus_path:
+            metrics.write_prometheus(prometheus_path)
+
+    def replay_rows(self, state, rows, upcoming):
+        """
+        Redo the rows of an aborted transaction, starting from the adapter
+        state of the last commit.
+        """
+        self.adapter.restore_state(state)
+        # e.g. reload the lookup window for all the rows that will be handled
+        self.adapter.prepare_batch(rows=[source_row(row) for row in rows + upcoming])
+        for row in rows:
+            if isinstance(row, InvalidRow):
+                self.adapter.reject_row(row)
+            else:
+                self.adapter.create_or_update_item(row=row)
+        self.n_replays += len(rows)
+
 
 def _main(args):
     with api.env.adopt_user(username="admin"):
         runner = ScriptRunner(args=args)
         runner.rsync()
         if not getattr(runner.options, "dry_run", False):
-            logger.info("FINAL COMMIT")
-            transaction.get().note(
-                runner.adapter.log_item_title(start=runner.adapter.start)
-            )
-            transaction.commit()
+            runner.final_commit()
+        runner.save_snapshot()
+        runner.write_metrics()
 
 
 def main():
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Split a sync in shards run by different processes (e.g. different ZEO
+clients), and merge their results.
+
+Every shard stores its results in its own annotation, to avoid write
+conflicts between shards.
+"""
+from BTrees.OOBTree import OOTreeSet
+from persistent.list import PersistentList
+from persistent.mapping import PersistentMapping
+from zope.annotation.interfaces import IAnnotations
+
+import zlib
+
+SHARDS_KEY = "redturtle.rsync.shards"
+COUNTERS = (
+    "n_items",
+    "n_created",
+    "n_updated",
+    "n_unchanged",
+    "n_blobs_written",
+    "n_blobs_skipped",
+    "blob_bytes_written",
+    "blob_bytes_skipped",
+    "n_invalid",
+)
+
+
+def shard_of(key, shards):
+    """
+    Return the shard index of the given row key. The hash is stable
+    between processes (unlike the builtin hash of strings).
+    """
+    return zlib.crc32(str(key).encode("utf-8")) % shards
+
+
+class ShardResults:
+    """
+    Store and merge the results of the shards of a sync.
+    """
+
+    def __init__(self, portal, source, shards, key=SHARDS_KEY):
+        self.annotations = IAnnotations(portal)
+        self.source = source
+        self.shards = shards
+        self.base_key = key
+
+    def key(self, index):
+        return f"{self.base_key}.{index}"
+
+    def save(self, index, adapter):
+        data = PersistentMapping()
+        data["source"] = self.source
+        data["shards"] = self.shards
+        data["counters"] = {name: getattr(adapter, name) for name in COUNTERS}
+        data["sync_uids"] = OOTreeSet(adapter.sync_uids)
+        data["source_version"] = adapter.source_version
+        data["source_error"] = adapter.source_error
+        # only errors and warnings: the whole log could be huge
+        data["alerts"] = PersistentList(adapter.logdata.alerts())
+        self.annotations[self.key(index)] = data
+
+    def missing(self):
+        """
+        Return the indexes of the shards without results for this source.
+        """
+        missing = []
+        for index in range(self.shards):
+            data = self.annotations.get(self.key(index))
+            if (
+                data is None
+                or data["source"] != self.source
+                or data["shards"] != self.shards
+            ):
+                missing.append(index)
+        return missing
+
+    def versions(self):
+        """
+        Return the versions of the source read by the shards (e.g. the ETag
+        of a source URL).
+        """
+        return {
+            self.annotations[self.key(index)]["source_version"]
+            for index in range(self.shards)
+        }
+
+    def merge(self, adapter):
+        """
+        Sum the counters and merge synced uids, source errors and alerts of
+        all the shards into the adapter.
+        """
+        for index in range(self.shards):
+            data = self.annotations[self.key(index)]
+            for name, value in data["counters"].items():
+                setattr(adapter, name, getattr(adapter, name) + value)
+            adapter.sync_uids.update(data["sync_uids"])
+            if data["source_error"]:
+                adapter.source_error = True
+            adapter.log_info(msg=f"Shard {index + 1}/{self.shards}")
+            adapter.logdata.extend(data["alerts"])
+
+    def clear(self):
+        for index in range(self.shards):
+            key = self.key(index)
+            if key in self.annotations:
+                del self.annotations[key]
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshot of the source rows synced by the last run, to handle only the
+rows added or changed since then.
+
+The snapshot is a gzipped NDJSON file of [key, fingerprint] pairs sorted by
+key. The new rows are spooled to a temporary file while their keys are
+sorted (in chunks, merged from disk if they are many), then the two sorted
+streams are merged: the offsets of added and changed rows are collected,
+removed keys are collected and the new snapshot is written next to the old
+one, to replace it when the sync is committed. The selected rows are then
+read again from the spool in source order.
+"""
+import array
+import contextlib
+import gzip
+import heapq
+import itertools
+import json
+import logging
+import os
+import pickle
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 100000
+
+
+def read_entries(fp):
+    for line in fp:
+        yield tuple(json.loads(line))
+
+
+class Snapshot:
+    """
+    Diff the source rows against the snapshot stored in path.
+    Keys are stored and compared by their JSON, to sort keys of any type.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.new_path = f"{path}.new"
+        self.chunk_size = chunk_size
+        self.removed_keys = []
+        self.n_rows = 0
+        self.n_added = 0
+        self.n_changed = 0
+        self.n_unchanged = 0
+        self.n_without_key = 0
+
+    def read(self):
+        """
+        Iterate over the (key, fingerprint) pairs of the last snapshot.
+        """
+        if not os.path.exists(self.path):
+            return
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            yield from read_entries(f)
+
+    def sort_entries(self, entries, directory):
+        """
+        Sort the (key, fingerprint, offset) entries by key: chunks of
+        chunk_size entries are sorted in memory, written in directory and
+        merged.
+        """
+        paths = []
+        chunk = []
+        for entry in entries:
+            chunk.append(entry)
+            if len(chunk) >= self.chunk_size:
+                chunk.sort()
+                path = os.path.join(directory, f"chunk-{len(paths)}.ndjson")
+                with open(path, "w", encoding="utf-8") as f:
+                    for item in chunk:
+                        f.write(json.dumps(item) + "\n")
+                paths.append(path)
+                chunk = []
+        chunk.sort()
+        with contextlib.ExitStack() as stack:
+            files = [
+                stack.enter_context(open(path, encoding="utf-8")) for path in paths
+            ]
+            yield from heapq.merge(*[read_entries(f) for f in files], chunk)
+
+    def diff(self, rows, get_key, get_fingerprint, full=False):
+        """
+        Yield the rows added or changed since the last snapshot (all the
+        rows with full), and the rows without a key, in source order.
+        The removed keys are available when the iteration is completed.
+        """
+        with tempfile.TemporaryDirectory(prefix="redturtle.rsync.snapshot.") as tmp:
+            with open(os.path.join(tmp, "rows.pickle"), "w+b") as spool:
+                without_key = []
+
+                def spool_rows():
+                    for row in rows:
+                        self.n_rows += 1
+                        try:
+                            key = get_key(row)
+                        except Exception as e:
+                            logger.exception(e)
+                            key = None
+                        offset = spool.tell()
+                        pickle.dump(row, spool, protocol=pickle.HIGHEST_PROTOCOL)
+                        if key is None:
+                            # can't be tracked: always synced
+                            without_key.append(offset)
+                        else:
+                            yield (json.dumps(key), get_fingerprint(row), offset)
+
+                entries = self.sort_entries(spool_rows(), directory=tmp)
+                # the first entry is available when all the rows are spooled
+                first = next(entries, None)
+                self.n_without_key = len(without_key)
+                if first is not None:
+                    entries = itertools.chain([first], entries)
+                offsets = array.array("q", without_key)
+                offsets.extend(self.merge(entries, full=full))
+                for offset in sorted(offsets):
+                    yield self.load_row(spool, offset)
+
+    def load_row(self, spool, offset):
+        spool.seek(offset)
+        return pickle.load(spool)
+
+    def merge(self, entries, full=False):
+        """
+        Merge the sorted entries of the new rows with the last snapshot,
+        writing the new one, and yield the spool offsets of the rows to sync.
+        """
+        old = self.read()
+        current = next(old, None)
+        previous = None
+        with contextlib.closing(old), gzip.open(
+            self.new_path, "wt", encoding="utf-8"
+        ) as out:
+            for key, fingerprint, offset in entries:
+                if key == previous:
+                    # duplicated key in the source: synced as it is
+                    self.n_changed += 1
+                    yield offset
+                    continue
+                old_fingerprint = None
+                while current is not None and current[0] <= key:
+                    if current[0] == key:
+                        old_fingerprint = current[1]
+                    else:
+                        self.removed_keys.append(json.loads(current[0]))
+                    current = next(old, None)
+                out.write(json.dumps([key, fingerprint]) + "\n")
+                previous = key
+                if old_fingerprint is None:
+                    self.n_added += 1
+                elif old_fingerprint != fingerprint:
+                    self.n_changed += 1
+                else:
+                    self.n_unchanged += 1
+                    if not full:
+                        continue
+                yield offset
+            while current is not None:
+                self.removed_keys.append(json.loads(current[0]))
+                current = next(old, None)
+
+    def save(self, exclude=()):
+        """
+        Replace the snapshot with the new one, without the excluded keys
+        (e.g. of the rows that failed, so they will be synced again).
+        """
+        if not os.path.exists(self.new_path):
+            return
+        if exclude:
+            exclude = {json.dumps(key) for key in exclude}
+            tmp_path = f"{self.new_path}.tmp"
+            with gzip.open(self.new_path, "rt", encoding="utf-8") as f:
+                with gzip.open(tmp_path, "wt", encoding="utf-8") as out:
+                    for line in f:
+                        if json.loads(line)[0] not in exclude:
+                            out.write(line)
+            os.replace(tmp_path, self.new_path)
+        os.replace(self.new_path, self.path)
+
+    def discard(self):
+        if os.path.exists(self.new_path):
+            os.unlink(self.new_path)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic datasets and a reference adapter for the benchmarks.
+"""
+from plone import api
+from plone.app.textfield.value import RichTextValue
+from redturtle.rsync.adapters.adapter import RsyncAdapterBase
+from redturtle.rsync.scripts.commit_policy import get_rss
+from redturtle.rsync.scripts.rsync import ScriptRunner
+
+import base64
+import json
+import random
+import string
+import time
+import tracemalloc
+import transaction
+
+CONTAINER_ID = "benchmark"
+
+
+def random_text(rnd, size):
+    return "".join(rnd.choice(string.ascii_letters + " ") for _ in range(size))
+
+
+def generate_rows(n, text_size=1000, attachment_size=0, seed=0):
+    """
+    Generate n rows with a text of text_size chars and, if attachment_size
+    is set, a base64 attachment of attachment_size bytes.
+    """
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        row = {
+            "id": f"item-{i}",
+            "title": f"Item {i}",
+            "text": random_text(rnd, text_size),
+        }
+        if attachment_size:
+            data = rnd.getrandbits(8 * attachment_size).to_bytes(attachment_size, "big")
+            row["attachment"] = base64.b64encode(data).decode("ascii")
+        rows.append(row)
+    return rows
+
+
+def mutate_rows(rows, update_ratio=0.0, delete_ratio=0.0, seed=0):
+    """
+    Return a new version of the rows: update_ratio of them have a new title
+    and delete_ratio of them are removed, the others are unchanged.
+    """
+    rnd = random.Random(seed)
+    result = []
+    for row in rows:
+        value = rnd.random()
+        if value < delete_ratio:
+            continue
+        if value < delete_ratio + update_ratio:
+            row = dict(row, title=f"{row['title']} (updated)")
+        result.append(row)
+    return result
+
+
+def write_source(path, rows):
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+
+
+class BenchmarkAdapter(RsyncAdapterBase):
+    """
+    Reference adapter: a Document (or a File, for rows with an attachment)
+    for each row, in the benchmark folder.
+    """
+
+    lookup_key_index = "getId"
+
+    def get_container(self):
+        container = self.context.get(CONTAINER_ID)
+        if container is None:
+            container = api.content.create(
+                container=self.context, type="Folder", id=CONTAINER_ID
+            )
+        return container
+
+    def convert_source_data(self, data):
+        return data
+
+    def get_row_key(self, row):
+        return row["id"]
+
+    def get_lookup_query(self):
+        container = self.get_container()
+        return {"path": "/".join(container.getPhysicalPath())}
+
+    def do_find_item_from_row(self, row):
+        return self.get_container().get(row["id"])
+
+    def do_create_item(self, row):
+        if row.get("attachment"):
+            item = api.content.create(
+                container=self.get_container(),
+                type="File",
+                id=row["id"],
+                title=row["title"],
+            )
+            self.set_attachment(item, row)
+            return item
+        return api.content.create(
+            container=self.get_container(),
+            type="Document",
+            id=row["id"],
+            title=row["title"],
+            text=RichTextValue(row["text"], "text/plain", "text/html"),
+        )
+
+    def set_attachment(self, item, row):
+        return self.set_blob_field(
+            item,
+            "file",
+            base64.b64decode(row["attachment"]),
+            filename=f"{row['id']}.bin",
+        )
+
+    def do_update_item(self, item, row):
+        changed = row.get("attachment") and self.set_attachment(item, row)
+        if item.title == row["title"] and not changed:
+            return
+        item.title = row["title"]
+        self.reindex_item(item, idxs=["Title", "SearchableText"])
+        return item
+
+    def get_delete_query(self):
+        container = self.get_container()
+        return {"path": {"query": "/".join(container.getPhysicalPath()), "depth": 1}}
+
+
+def run_sync(source_path, args):
+    runner = ScriptRunner(args=["--source-path", source_path] + list(args))
+    runner.rsync()
+    return runner
+
+
+def run_benchmark(name, source_path, args=()):
+    """
+    Run a sync and return its rows/sec and peak memory.
+    tracemalloc slows down the sync, so the peak memory is measured by a
+    separate run, rolled back before the timed one.
+    """
+    savepoint = transaction.savepoint()
+    tracemalloc.start()
+    run_sync(source_path, args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    savepoint.rollback()
+
+    start = time.monotonic()
+    runner = run_sync(source_path, args)
+    duration = time.monotonic() - start
+    adapter = runner.adapter
+    return {
+        "name": name,
+        "args": list(args),
+        "rows": adapter.n_items,
+        "created": adapter.n_created,
+        "updated": adapter.n_updated,
+        "unchanged": adapter.n_unchanged,
+        "deleted": adapter.n_todelete,
+        "blob_bytes_written": adapter.blob_bytes_written,
+        "blob_bytes_skipped": adapter.blob_bytes_skipped,
+        "duration": duration,
+        "rows_per_second": adapter.n_items / duration if duration else 0.0,
+        "peak_traced_mb": peak / 1024 / 1024,
+        "rss_mb": get_rss(),
+        "operations": adapter.metrics.to_dict()["operations"],
+    }
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+from argparse import Namespace
+from plone import api
+from plone.app.linkintegrity.handlers import updateReferences
+from plone.app.linkintegrity.utils import ensure_intid
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+from plone.namedfile.file import NamedBlobFile
+from Products.CMFCore.indexing import processQueue
+from redturtle.rsync import _
+from redturtle.rsync.adapters.adapter import RsyncAdapterBase
+from redturtle.rsync.adapters.assets import Asset
+from redturtle.rsync.adapters.log import LogRenderer
+from redturtle.rsync.adapters.log import LogStorage
+from redturtle.rsync.adapters.log import make_record
+from redturtle.rsync.testing import REDTURTLE_RSYNC_INTEGRATION_TESTING
+from unittest import mock
+from z3c.relationfield import RelationValue
+
+import gzip
+import hashlib
+import io
+import json
+import unittest
+
+
+class DocumentAdapter(RsyncAdapterBase):
+    """Sync Documents keyed by their id."""
+
+    lookup_key_index = "getId"
+
+    def __init__(self, context, request):
+        super().__init__(context, request)
+        self.find_calls = 0
+
+    def convert_source_data(self, data):
+        return data
+
+    def get_row_key(self, row):
+        return row["id"]
+
+    def get_lookup_query(self):
+        return {"portal_type": "Document"}
+
+    def do_find_item_from_row(self, row):
+        self.find_calls += 1
+        return self.context.get(row["id"])
+
+    def do_create_item(self, row):
+        return api.content.create(
+            container=self.context, type="Document", id=row["id"], title=row["title"]
+        )
+
+    def do_update_item(self, item, row):
+        if item.title == row["title"]:
+            return
+        item.title = row["title"]
+        self.reindex_item(item, idxs=["Title"])
+        return item
+
+
+class TypeAdapter(DocumentAdapter):
+    """Use the default lookup query, restricted by portal_type."""
+
+    portal_type = "Document"
+    get_lookup_query = RsyncAdapterBase.get_lookup_query
+
+
+def get_options(**kwargs):
+    options = {"verbose": False, "dry_run": False}
+    options.update(kwargs)
+    return Namespace(**options)
+
+
+class TestLookupIndex(unittest.TestCase):
+    layer = REDTURTLE_RSYNC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        api.content.create(
+            container=self.portal, type="Document", id="doc-1", title="Doc 1"
+        )
+
+    def get_adapter(self, **options):
+        adapter = DocumentAdapter(self.portal, self.request)
+        adapter.options = get_options(**options)
+        adapter.setup_lookup()
+        return adapter
+
+    def test_lookup_disabled_by_default(self):
+        adapter = self.get_adapter()
+        self.assertIsNone(adapter.lookup)
+        adapter.find_item_from_row({"id": "doc-1"})
+        self.assertEqual(adapter.find_calls, 1)
+
+    def test_preload(self):
+        adapter = self.get_adapter(lookup_index="preload")
+        self.assertEqual(len(adapter.lookup), 1)
+        self.assertEqual(
+            adapter.find_item_from_row({"id": "doc-1"}), self.portal["doc-1"]
+        )
+        self.assertIsNone(adapter.find_item_from_row({"id": "doc-2"}))
+        self.assertEqual(adapter.find_calls, 0)
+        self.assertEqual(adapter.lookup.hits, 1)
+        self.assertEqual(adapter.lookup.misses, 1)
+
+    def test_default_lookup_query(self):
+        api.content.create(
+            container=self.portal, type="Folder", id="folder-1", title="Folder 1"
+        )
+        adapter = TypeAdapter(self.portal, self.request)
+        adapter.options = get_options(lookup_index="preload")
+        # the lookup is restricted to the items of the adapter
+        adapter.setup_lookup()
+        self.assertEqual(set(adapter.lookup.items), {"doc-1"})
+
+        adapter.get_delete_query = lambda: {"portal_type": "Folder"}
+        adapter.setup_lookup()
+        self.assertEqual(set(adapter.lookup.items), {"folder-1"})
+
+    def test_created_items_are_added(self):
+        adapter = self.get_adapter(lookup_index="preload")
+        adapter.create_or_update_item({"id": "doc-2", "title": "Doc 2"})
+        self.assertIn("doc-2", adapter.lookup)
+        adapter.create_or_update_item({"id": "doc-2", "title": "Doc 2 bis"})
+        self.assertEqual(self.portal["doc-2"].title, "Doc 2 bis")
+        self.assertEqual(adapter.n_created, 1)
+        self.assertEqual(adapter.n_updated, 1)
+        self.assertEqual(adapter.find_calls, 0)
+
+    def test_window(self):
+        adapter = self.get_adapter(lookup_index="window")
+        self.assertEqual(len(adapter.lookup), 0)
+        adapter.prepare_batch(rows=[{"id": "doc-1"}, {"id": "doc-3"}])
+        self.assertEqual(len(adapter.lookup), 1)
+        self.assertEqual(
+            adapter.find_item_from_row({"id": "doc-1"}), self.portal["doc-1"]
+        )
+        self.assertIsNone(adapter.find_item_from_row({"id": "doc-3"}))
+        self.assertEqual(adapter.find_calls, 0)
+
+
+class TestFingerprints(unittest.TestCase):
+    layer = REDTURTLE_RSYNC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+
+    def get_adapter(self, **options):
+        adapter = DocumentAdapter(self.portal, self.request)
+        adapter.options = get_options(**options)
+        adapter.setup_lookup()
+        adapter.setup_fingerprints()
+        return adapter
+
+    def test_unchanged_rows_are_skipped(self):
+        row = {"id": "doc-1", "title": "Doc 1"}
+        adapter = self.get_adapter(fingerprints=True)
+        adapter.create_or_update_item(row)
+        self.assertEqual(adapter.n_created, 1)
+
+        adapter = self.get_adapter(fingerprints=True)
+        adapter.create_or_update_item(dict(row))
+        self.assertEqual(adapter.n_unchanged, 1)
+        self.assertEqual(adapter.find_calls, 0)
+        self.assertIn(self.portal["doc-1"].UID(), adapter.sync_uids)
+
+        adapter.create_or_update_item({"id": "doc-1", "title": "Doc 1 bis"})
+        self.assertEqual(adapter.n_updated, 1)
+        self.assertEqual(self.portal["doc-1"].title, "Doc 1 bis")
+
+    def test_fingerprints_by_adapter(self):
+        adapter = self.get_adapter(fingerprints=True)
+        adapter.create_or_update_item({"id": "doc-1", "title": "Doc 1"})
+        # another adapter of the same site has its own fingerprints
+        other = TypeAdapter(self.portal, self.request)
+        other.options = get_options(fingerprints=True)
+        other.setup_fingerprints()
+        self.assertEqual(len(other.fingerprints), 0)
+        self.assertEqual(len(self.get_adapter(fingerprints=True).fingerprints), 1)
+
+    def test_removed_items_are_synced_again(self):
+        row = {"id": "doc-1", "title": "Doc 1"}
+        adapter = self.get_adapter(fingerprints=True)
+        adapter.create_or_update_item(row)
+        api.content.delete(obj=self.portal["doc-1"])
+
+        adapter = self.get_adapter(fingerprints=True, lookup_index="preload")
+        adapter.create_or_update_item(row)
+        self.assertEqual(adapter.n_unchanged, 0)
+        self.assertEqual(adapter.n_created, 1)
+
+        # also without the lookup index
+        api.content.delete(obj=self.portal["doc-1"])
+        adapter = self.get_adapter(fingerprints=True)
+        adapter.create_or_update_item(row)
+        self.assertEqual(adapter.n_unchanged, 0)
+        self.assertEqual(adapter.n_created, 1)
+
+    def test_uids_are_checked_once_per_batch(self):
+        rows = [{"id": f"doc-{i}", "title": f"Doc {i}"} for i in range(3)]
+        adapter = self.get_adapter(fingerprints=True)
+        for row in rows:
+            adapter.create_or_update_item(row)
+        api.content.delete(obj=self.portal["doc-2"])
+
+        adapter = self.get_adapter(fingerprints=True)
+        catalog = api.portal.get_tool(name="portal_catalog")
+        with mock.patch.object(
+            catalog,
+            "unrestrictedSearchResults",
+            wraps=catalog.unrestrictedSearchResults,
+        ) as search:
+            adapter.prepare_batch(rows=rows)
+            self.assertEqual(search.call_count, 1)
+            adapter.create_or_update_item(rows[0])
+            adapter.create_or_update_item(rows[1])
+            self.assertEqual(search.call_count, 1)
+        self.assertEqual(adapter.n_unchanged, 2)
+        # the removed item is synced again
+        adapter.create_or_update_item(rows[2])
+        self.assertEqual(adapter.n_created, 1)
+
+    def test_update_can_return_any_true_value(self):
+        adapter = self.get_adapter(fingerprints=True)
+        adapter.create_or_update_item({"id": "doc-1", "title": "Doc 1"})
+        adapter.do_update_item = lambda item, row: True
+        adapter.create_or_update_item({"id": "doc-1", "title": "Doc 1 bis"})
+        self.assertEqual(adapter.n_updated, 1)
+        uid = self.portal["doc-1"].UID()
+        self.assertEqual(adapter.fingerprints["doc-1"][1], uid)
+
+    def test_fingerprints_disabled_by_default(self):
+        adapter = self.get_adapter()
+        self.assertIsNone(adapter.fingerprints)
+        adapter.create_or_update_item({"id": "doc-1", "title": "Doc 1"})
+        adapter.create_or_update_item({"id": "doc-1", "title": "Doc 1"})
+        self.assertEqual(adapter.n_unchanged, 0)
+        self.assertEqual(adapter.find_calls, 2)
+
+
+class TestDeferredReindex(unittest.TestCase):
+    layer = REDTURTLE_RSYNC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        api.content.create(
+            container=self.portal, type="Document", id="doc-1", title="Doc 1"
+        )
+        # index the created item now
+        processQueue()
+
+    def search(self, title):
+        return [b.getId for b in api.content.find(Title=title)]
+
+    def test_items_are_reindexed_once(self):
+        adapter = DocumentAdapter(self.portal, self.request)
+        adapter.options = get_options(deferred_reindex="commit")
+        adapter.create_or_update_item({"id": "doc-1", "title": "Doc 1 bis"})
+        adapter.reindex_item(self.portal["doc-1"], idxs=["Description"])
+        adapter.create_or_update_item({"id": "doc-1", "title": "Doc 1 ter"})
+        self.assertEqual(len(adapter.reindex_queue), 1)
+        self.assertEqual(
+            list(adapter.reindex_queue.queue.values()), [{"Title", "Description"}]
+        )
+        self.assertEqual(self.search("ter"), [])
+
+        adapter.flush_reindex()
+        self.assertEqual(self.search("ter"), ["doc-1"])
+        self.assertEqual(adapter.reindex_queue.n_reindexed, 1)
+        self.assertEqual(len(adapter.reindex_queue), 0)
+
+        # the transaction is aborted
+        adapter.reindex_queue.requeue()
+        self.assertEqual(len(adapter.reindex_queue), 1)
+
+    def test_created_items_are_deferred(self):
+        adapter = DocumentAdapter(self.portal, self.request)
+        adapter.options = get_options(deferred_reindex="end")
+        # do_create_item uses api.content.create
+        adapter.create_or_update_item({"id": "doc-2", "title": "Doc 2"})
+        self.assertIn("doc-2", self.portal)
+        self.assertEqual(len(api.content.find(getId="doc-2")), 0)
+        self.assertIn(
+            self.portal["doc-2"].getPhysicalPath(), adapter.reindex_queue.queue
+        )
+
+        adapter.flush_reindex()
+        self.assertEqual(len(api.content.find(getId="doc-2")), 1)
+
+    def test_reindex_all_indexes(self):
+        adapter = DocumentAdapter(self.portal, self.request)
+        adapter.options = get_options(deferred_reindex="end")
+        item = self.portal["doc-1"]
+        adapter.reindex_item(item, idxs=["Title"])
+        adapter.reindex_item(item)
+        adapter.reindex_item(item, idxs=["Description"])
+        self.assertEqual(list(adapter.reindex_queue.queue.values()), [None])
+
+
+class TestBlobFields(unittest.TestCase):
+    layer = REDTURTLE_RSYNC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        self.item = api.content.create(
+            container=self.portal, type="File", id="file-1", title="File 1"
+        )
+        self.adapter = DocumentAdapter(self.portal, self.request)
+
+    def test_unchanged_blob_is_not_written(self):
+        adapter = self.adapter
+        self.assertTrue(adapter.set_blob_field(self.item, "file", b"abc", "a.txt"))
+        blob = self.item.file
+        self.assertFalse(adapter.set_blob_field(self.item, "file", b"abc", "a.txt"))
+        self.assertIs(self.item.file, blob)
+        self.assertTrue(adapter.set_blob_field(self.item, "file", b"abcd", "a.txt"))
+        self.assertIsNot(self.item.file, blob)
+        self.assertEqual(self.item.file.data, b"abcd")
+        self.assertEqual(adapter.n_blobs_written, 2)
+        self.assertEqual(adapter.blob_bytes_written, 7)
+        self.assertEqual(adapter.n_blobs_skipped, 1)
+        self.assertEqual(adapter.blob_bytes_skipped, 3)
+
+    def test_streams_and_assets(self):
+        adapter = self.adapter
+        data = b"x" * 200000
+        self.assertTrue(
+            adapter.set_blob_field(self.item, "file", io.BytesIO(data), "x.bin")
+        )
+        self.assertEqual(self.item.file.data, data)
+        self.assertEqual(self.item.file.filename, "x.bin")
+        # the asset content is not read when its digest is unchanged
+        asset = Asset(
+            url="http://example.com/y.bin",
+            path="/nonexistent",
+            sha256=hashlib.sha256(data).hexdigest(),
+            size=len(data),
+            filename="y.bin",
+        )
+        self.assertFalse(adapter.set_blob_field(self.item, "file", asset))
+        self.assertEqual(self.item.file.filename, "y.bin")
+
+    def test_replaced_blob_is_written(self):
+        adapter = self.adapter
+        adapter.set_blob_field(self.item, "file", b"abc", "a.txt")
+        # the file has been changed by an editor
+        self.item.file = NamedBlobFile(data=b"edited", filename="a.txt")
+        self.assertTrue(adapter.set_blob_field(self.item, "file", b"abc", "a.txt"))
+        self.assertEqual(self.item.file.data, b"abc")
+
+
+class OrphansAdapter(DocumentAdapter):
+    """Delete the Documents that are not in the source."""
+
+    def get_delete_query(self):
+        return {"portal_type": "Document"}
+
+
+class TestDeleteOrphans(unittest.TestCase):
+    layer = REDTURTLE_RSYNC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        for i in range(1, 4):
+            api.content.create(
+                container=self.portal, type="Document", id=f"doc-{i}", title="Doc"
+            )
+        folder = api.content.create(container=self.portal, type="Folder", id="f")
+        for i in range(4, 6):
+            api.content.create(
+                container=folder, type="Document", id=f"doc-{i}", title="Doc"
+            )
+        self.rows = [{"id": "doc-1", "title": "Doc 1"}, {"id": "doc-6", "title": "6"}]
+
+    def sync(self, **options):
+        adapter = OrphansAdapter(self.portal, self.request)
+        adapter.options = get_options(**options)
+        for row in self.rows:
+            adapter.create_or_update_item(row)
+        adapter.delete_items(data=self.rows)
+        return adapter
+
+    def link(self, source, target):
+        updateReferences(source, [RelationValue(ensure_intid(target))])
+
+    def test_orphans_are_deleted(self):
+        adapter = self.sync()
+        self.assertEqual(sorted(self.portal.contentIds()), ["doc-1", "doc-6", "f"])
+        self.assertEqual(self.portal["f"].contentIds(), [])
+        self.assertEqual(adapter.n_todelete, 4)
+        self.assertEqual(len(adapter.sync_uids), 2)
+
+    def test_dry_run_and_max_delete(self):
+        adapter = self.sync(dry_run=True)
+        self.assertEqual(adapter.n_todelete, 4)
+        self.assertIn("doc-2", self.portal)
+
+        adapter = self.sync(max_delete="50%")
+        self.assertEqual(adapter.n_todelete, 0)
+        self.assertIn("doc-2", self.portal)
+        self.assertEqual(next(adapter.logdata.alerts())[1], "error")
+
+    def test_fingerprints_of_deleted_items_are_removed(self):
+        adapter = OrphansAdapter(self.portal, self.request)
+        adapter.options = get_options(fingerprints=True)
+        adapter.setup_fingerprints()
+        adapter.fingerprints["doc-2"] = ("x", self.portal["doc-2"].UID())
+        adapter.fingerprints["doc-1"] = ("x", self.portal["doc-1"].UID())
+        adapter.sync_uids.add(self.portal["doc-1"].UID())
+        adapter.delete_items(data=self.rows)
+        self.assertNotIn("doc-2", self.portal)
+        self.assertEqual(list(adapter.fingerprints), ["doc-1"])
+
+    def test_linked_orphans_are_kept(self):
+        self.link(self.portal["doc-1"], self.portal["doc-2"])
+        # links between deleted items do not matter
+        self.link(self.portal["doc-3"], self.portal["f"]["doc-4"])
+        adapter = self.sync()
+        self.assertIn("doc-2", self.portal)
+        self.assertNotIn("doc-3", self.portal)
+        self.assertEqual(self.portal["f"].contentIds(), [])
+        self.assertEqual(adapter.n_todelete, 3)
+
+
+class TestLog(unittest.TestCase):
+    layer = REDTURTLE_RSYNC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+
+    def test_messages_are_rendered_lazily(self):
+        adapter = DocumentAdapter(self.portal, self.request)
+        adapter.options = get_options()
+        translate = mock.Mock(side_effect=lambda msg: msg.default)
+        adapter.log_renderer = LogRenderer(translate=translate)
+        for i in range(3):
+            adapter.log_info(
+                msg=_("msg", default="[UPDATE] ${path}", mapping={"path": f"/doc-{i}"})
+            )
+        adapter.log_info(msg="Done", type="warning")
+        self.assertEqual(translate.call_count, 0)
+
+        html = adapter.render_log()
+        self.assertEqual(translate.call_count, 1)
+        self.assertEqual(len(html), 4)
+        self.assertIn('[UPDATE] <a href="/doc-2">/doc-2</a></p>', html[2])
+        self.assertIn("background-color:#ff9d00", html[3])
+
+    def test_spill_to_disk(self):
+        storage = LogStorage(threshold=3)
+        storage.extend(make_record(msg=f"msg {i}") for i in range(8))
+        self.assertEqual(len(storage.records), 2)
+        self.assertEqual(len(storage), 8)
+        self.assertEqual([r[2] for r in storage], [f"msg {i}" for i in range(8)])
+
+        storage.truncate(7)
+        self.assertEqual([r[2] for r in storage][-1], "msg 6")
+        storage.truncate(4)
+        self.assertEqual(len(storage.chunks), 1)
+        self.assertEqual([r[2] for r in storage], [f"msg {i}" for i in range(4)])
+        storage.append(make_record(msg="error", type="error"))
+        self.assertEqual([r[2] for r in storage.alerts()], ["error"])
+        storage.close()
+
+    def test_spill_unpicklable_mapping(self):
+        storage = LogStorage(threshold=1)
+        row = {"id": "doc-1", "file": io.BytesIO(b"data")}
+        msg = _("msg", default="[ERROR] ${row}: ${e}", mapping={"row": row, "e": 1})
+        storage.append(make_record(msg=msg, type="error"))
+        self.assertTrue(storage.spilled)
+        renderer = LogRenderer(translate=lambda msg: msg.default)
+        (record,) = list(storage)
+        self.assertEqual(renderer.translate(record[2]), f"[ERROR] {row}: 1")
+        storage.close()
+
+    def test_write_long_log(self):
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        api.content.create(container=self.portal, type="Folder", id="logs")
+        adapter = DocumentAdapter(self.portal, self.request)
+        adapter.options = get_options(logpath="/logs")
+        adapter.logdata = LogStorage(threshold=2)
+        for i in range(5):
+            adapter.log_info(msg=f"/doc-{i}")
+        adapter.log_info(msg="Unable to sync", type="error")
+        adapter.write_log()
+
+        details, report = self.portal.logs.objectValues()
+        with gzip.open(io.BytesIO(details.file.data)) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 6)
+        self.assertEqual(records[0]["message"], "/doc-0")
+        html = list(report.blocks.values())[0]["html"]
+        self.assertIn("Unable to sync", html)
+        self.assertNotIn("/doc-0", html)
+        self.assertIn(details.absolute_url(), html)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the sync, run only with the testrunner option `--all` (or
+`-a 2`). The size of the dataset can be set with the environment variables
+RSYNC_BENCHMARK_ROWS, RSYNC_BENCHMARK_TEXT_SIZE and
+RSYNC_BENCHMARK_ATTACHMENT_SIZE; results are written in the JSON file
+RSYNC_BENCHMARK_OUTPUT (or logged).
+"""
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+from redturtle.rsync.interfaces import IRedturtleRsyncAdapter
+from redturtle.rsync.testing import REDTURTLE_RSYNC_FUNCTIONAL_TESTING
+from redturtle.rsync.tests.benchmark import BenchmarkAdapter
+from redturtle.rsync.tests.benchmark import CONTAINER_ID
+from redturtle.rsync.tests.benchmark import generate_rows
+from redturtle.rsync.tests.benchmark import mutate_rows
+from redturtle.rsync.tests.benchmark import run_benchmark
+from redturtle.rsync.tests.benchmark import write_source
+from zope.component import getGlobalSiteManager
+from zope.interface import alsoProvides
+from zope.interface import Interface
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+logger = logging.getLogger(__name__)
+
+
+class IBenchmarkLayer(Interface):
+    """Request marker used to register the benchmark adapter."""
+
+
+class TestBenchmark(unittest.TestCase):
+    layer = REDTURTLE_RSYNC_FUNCTIONAL_TESTING
+    level = 2
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        alsoProvides(self.request, IBenchmarkLayer)
+        getGlobalSiteManager().registerAdapter(
+            BenchmarkAdapter, (Interface, IBenchmarkLayer), IRedturtleRsyncAdapter
+        )
+        self.tmpdir = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.tmpdir, "source.ndjson")
+        self.rows = generate_rows(
+            n=int(os.environ.get("RSYNC_BENCHMARK_ROWS", 200)),
+            text_size=int(os.environ.get("RSYNC_BENCHMARK_TEXT_SIZE", 1000)),
+            attachment_size=int(os.environ.get("RSYNC_BENCHMARK_ATTACHMENT_SIZE", 0)),
+        )
+
+    def tearDown(self):
+        getGlobalSiteManager().unregisterAdapter(
+            BenchmarkAdapter, (Interface, IBenchmarkLayer), IRedturtleRsyncAdapter
+        )
+        shutil.rmtree(self.tmpdir)
+
+    def run_scenario(self, name, rows, *args):
+        write_source(self.source_path, rows)
+        return run_benchmark(name=name, source_path=self.source_path, args=args)
+
+    def test_benchmark(self):
+        args = ("--lookup-index", "preload", "--fingerprints")
+        results = [self.run_scenario("cold import", self.rows, *args)]
+        results.append(self.run_scenario("no-op re-sync", self.rows, *args))
+        updated = mutate_rows(self.rows, update_ratio=0.1)
+        results.append(self.run_scenario("partial update", updated, *args))
+        remaining = mutate_rows(updated, delete_ratio=0.5)
+        results.append(self.run_scenario("mass delete", remaining, *args))
+
+        n = len(self.rows)
+        self.assertEqual(results[0]["created"], n)
+        self.assertEqual(results[1]["unchanged"], n)
+        self.assertEqual(results[2]["updated"] + results[2]["unchanged"], len(updated))
+        self.assertEqual(results[3]["deleted"], n - len(remaining))
+        self.assertEqual(len(self.portal[CONTAINER_ID]), len(remaining))
+
+        output = os.environ.get("RSYNC_BENCHMARK_OUTPUT")
+        if output:
+            with open(output, "w") as f:
+                json.dump(results, f, indent=2)
+        else:
+            for result in results:
+                logger.info(
+                    f"{result['name']}: {result['rows']} rows, "
+                    f"{result['rows_per_second']:.1f} rows/s, "
+                    f"peak {result['peak_traced_mb']:.1f} MB"
+                )
@@ -0,0 +1,756 @@
+# -*- coding: utf-8 -*-
+from http.server import HTTPServer
+from plone import api
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+from redturtle.rsync.interfaces import IRedturtleRsyncAdapter
+from redturtle.rsync.scripts.checkpoint import Checkpoint
+from redturtle.rsync.scripts.rsync import ScriptRunner
+from redturtle.rsync.scripts.snapshot import Snapshot
+from redturtle.rsync.testing import REDTURTLE_RSYNC_FUNCTIONAL_TESTING
+from redturtle.rsync.tests.test_adapter import DocumentAdapter
+from redturtle.rsync.tests.test_sources import SourceHandler
+from unittest import mock
+from ZODB.POSException import ConflictError
+from zope.component import getGlobalSiteManager
+from zope.interface import alsoProvides
+from zope.interface import Interface
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import transaction
+import unittest
+
+
+class IDocumentSyncLayer(Interface):
+    """Request marker used to register the test adapter."""
+
+
+class ConvertAdapter(DocumentAdapter):
+    """Convert the rows in batches, remembering where."""
+
+    def convert_rows(self, batch):
+        return [
+            dict(row, title=row["title"].upper(), pid=os.getpid(), size=len(batch))
+            for row in batch
+        ]
+
+
+class SchemaAdapter(DocumentAdapter):
+    """Reject the rows without a valid id and title."""
+
+    row_schema = {
+        "id": {"type": str, "pattern": r"doc-\d+$"},
+        "title": {"type": str, "min_length": 1},
+    }
+
+
+class TestRunner(unittest.TestCase):
+    layer = REDTURTLE_RSYNC_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.portal = self.layer["portal"]
+        self.request = self.layer["request"]
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        alsoProvides(self.request, IDocumentSyncLayer)
+        getGlobalSiteManager().registerAdapter(
+            DocumentAdapter, (Interface, IDocumentSyncLayer), IRedturtleRsyncAdapter
+        )
+        self.tmpdir = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.tmpdir, "source.ndjson")
+        with open(self.source_path, "w") as f:
+            for i in range(1, 6):
+                f.write(json.dumps({"id": f"doc-{i}", "title": f"Doc {i}"}) + "\n")
+
+    def tearDown(self):
+        getGlobalSiteManager().unregisterAdapter(
+            DocumentAdapter, (Interface, IDocumentSyncLayer), IRedturtleRsyncAdapter
+        )
+        shutil.rmtree(self.tmpdir)
+
+    def run_sync(self, *args):
+        runner = ScriptRunner(args=["--source-path", self.source_path] + list(args))
+        runner.adapter.do_delete_items = lambda data: None
+        runner.rsync()
+        return runner
+
+    def test_stream(self):
+        runner = self.run_sync("--stream")
+        self.assertEqual(runner.adapter.n_created, 5)
+        self.assertEqual(runner.adapter.n_items, 5)
+        self.assertIn("doc-5", self.portal)
+
+    def test_max_duration_and_resume(self):
+        # time is over after the second row
+        with mock.patch(
+            "redturtle.rsync.scripts.rsync.time.monotonic",
+            side_effect=lambda: 5 if "doc-2" in self.portal else 0,
+        ):
+            runner = self.run_sync("--stream", "--max-duration", "1")
+        self.assertTrue(runner.interrupted)
+        self.assertEqual(runner.adapter.n_created, 2)
+        # the row that hit the deadline is not counted
+        self.assertEqual(runner.adapter.n_items, 2)
+        self.assertNotIn("doc-3", self.portal)
+        self.assertEqual(runner.get_checkpoint().load()["offset"], 2)
+        # the checkpoint belongs to the adapter
+        source = runner.adapter.get_source_identity()
+        self.assertIsNone(Checkpoint(self.portal, source).load())
+
+        runner = self.run_sync("--stream", "--resume")
+        self.assertFalse(runner.interrupted)
+        self.assertEqual(runner.adapter.n_created, 5)
+        # created items of both runs
+        self.assertEqual(len(runner.adapter.sync_uids), 5)
+        self.assertIn("doc-5", self.portal)
+        self.assertIsNone(runner.get_checkpoint().load())
+
+    def test_checkpoint_writes_new_uids(self):
+        adapter = DocumentAdapter(self.portal, self.request)
+        checkpoint = Checkpoint(self.portal, "source")
+        adapter.sync_uids.update(["a", "b"])
+        checkpoint.save(offset=2, adapter=adapter)
+        transaction.commit()
+        self.assertEqual(checkpoint.n_saved, 2)
+
+        adapter.sync_uids.add("c")
+        checkpoint.save(offset=3, adapter=adapter)
+        transaction.abort()
+        # the uids of the aborted transaction are written again
+        self.assertEqual(checkpoint.n_saved, 2)
+        checkpoint.save(offset=3, adapter=adapter)
+        transaction.commit()
+        self.assertEqual(checkpoint.n_saved, 3)
+        self.assertEqual(set(checkpoint.load()["sync_uids"]), {"a", "b", "c"})
+
+    def test_resume_source_url(self):
+        server = HTTPServer(("127.0.0.1", 0), SourceHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(setattr, SourceHandler, "etag", SourceHandler.etag)
+        url = f"http://127.0.0.1:{server.server_port}/source.ndjson"
+
+        def run_sync(*args):
+            runner = ScriptRunner(args=["--source-url", url, "--stream"] + list(args))
+            runner.adapter.do_delete_items = lambda data: None
+            runner.adapter.convert_source_row = lambda row: {
+                "id": f"doc-{row['id']}",
+                "title": "Doc",
+            }
+            runner.rsync()
+            return runner
+
+        with mock.patch(
+            "redturtle.rsync.scripts.rsync.time.monotonic",
+            side_effect=lambda: 5 if "doc-1" in self.portal else 0,
+        ):
+            runner = run_sync("--max-duration", "1")
+        self.assertEqual(runner.adapter.n_created, 2)
+        self.assertEqual(runner.checkpoint.source, f'{url}:"v1"')
+
+        # the source changed: the checkpoint is not used
+        SourceHandler.etag = '"v2"'
+        runner = run_sync("--resume")
+        self.assertEqual(runner.adapter.n_created, 98)
+
+        # without a version, the source can't be resumed
+        SourceHandler.etag = None
+        runner = run_sync("--resume")
+        self.assertIsNone(runner.checkpoint.source)
+
+    def test_checkpoint_at_intermediate_commit(self):
+        runner = self.run_sync("--intermediate-commit", "2")
+        # completed runs remove the checkpoint
+        self.assertIsNone(runner.get_checkpoint().load())
+        self.assertEqual(api.content.get("/doc-5").title, "Doc 5")
+
+    def test_pipeline(self):
+        runner = self.run_sync("--stream", "--pipeline", "--queue-size", "2")
+        self.assertEqual(runner.adapter.n_created, 5)
+        self.assertIn("doc-5", self.portal)
+
+    def test_pipeline_source_error(self):
+        with open(self.source_path, "a") as f:
+            f.write("{broken\n")
+        runner = self.run_sync(
+            "--stream", "--pipeline", "--queue-size", "2", "--batch-size", "2"
+        )
+        # the error of the producer thread is logged by the main thread
+        self.assertTrue(runner.adapter.source_error)
+        self.assertFalse(runner.delete_enabled())
+        errors = [
+            str(msg) for _, type, msg in runner.adapter.logdata if type == "error"
+        ]
+        self.assertTrue(errors[0].startswith("Error in data generation"))
+        # the producer thread has been joined
+        self.assertNotIn(
+            "redturtle.rsync.pipeline", [t.name for t in threading.enumerate()]
+        )
+
+    def test_shards(self):
+        workers = [
+            self.run_sync("--stream", "--shards", "2", "--shard-index", str(index))
+            for index in range(2)
+        ]
+        self.assertEqual(sum(runner.adapter.n_created for runner in workers), 5)
+        self.assertTrue(all(runner.adapter.n_created for runner in workers))
+
+        # the merge does not read the source again
+        with mock.patch.object(DocumentAdapter, "get_data", side_effect=AssertionError):
+            runner = self.run_sync("--stream", "--shards", "2", "--merge-shards")
+        self.assertEqual(runner.adapter.n_created, 5)
+        self.assertEqual(runner.adapter.n_items, 5)
+        # results are removed after the merge
+        self.assertEqual(runner.shard_results.missing(), [0, 1])
+
+    def test_shard_results(self):
+        api.content.create(
+            container=self.portal, type="Document", id="doc-9", title="Doc 9"
+        )
+        for index in range(2):
+            runner = ScriptRunner(
+                args=[
+                    "--source-path",
+                    self.source_path,
+                    "--shards",
+                    "2",
+                    "--shard-index",
+                    str(index),
+                ]
+            )
+            runner.adapter.do_create_item = mock.Mock(side_effect=ValueError("error"))
+            if index == 1:
+                runner.adapter.source_error = True
+            runner.rsync()
+            # only the alerts of the shard log are stored
+            key = runner.shard_results.key(index)
+            self.assertIn("DocumentAdapter", key)
+            data = runner.shard_results.annotations[key]
+            self.assertNotIn("logdata", data)
+            self.assertTrue(data["alerts"])
+            self.assertTrue(all(record[1] == "error" for record in data["alerts"]))
+
+        runner = ScriptRunner(
+            args=["--source-path", self.source_path, "--shards", "2", "--merge-shards"]
+        )
+        runner.adapter.get_delete_query = lambda: {"portal_type": "Document"}
+        runner.rsync()
+        self.assertTrue(runner.adapter.source_error)
+        # a shard has not read the whole source: nothing is deleted
+        self.assertIn("doc-9", self.portal)
+
+    def test_merge_missing_shards(self):
+        self.run_sync("--stream", "--shards", "2", "--shard-index", "0")
+        runner = self.run_sync("--stream", "--shards", "2", "--merge-shards")
+        self.assertEqual(runner.shard_results.missing(), [1])
+        self.assertEqual(runner.adapter.n_created, 0)
+
+    def test_conflict_error_replay(self):
+        commit = transaction.commit
+        calls = []
+
+        def conflict_once():
+            calls.append(1)
+            if len(calls) == 2:
+                raise ConflictError("test conflict")
+            commit()
+
+        with mock.patch("transaction.commit", side_effect=conflict_once):
+            runner = self.run_sync(
+                "--intermediate-commit", "2", "--conflict-backoff", "0"
+            )
+        self.assertEqual(runner.n_conflicts, 1)
+        self.assertEqual(runner.n_replays, 2)
+        self.assertEqual(runner.adapter.n_created, 5)
+        self.assertEqual(
+            [i for i in self.portal.objectIds() if i.startswith("doc-")],
+            [f"doc-{i}" for i in range(1, 6)],
+        )
+
+    def test_conflict_error_on_final_commit(self):
+        dead_letter = os.path.join(self.tmpdir, "failed.ndjson")
+        runner = ScriptRunner(
+            args=[
+                "--source-path",
+                self.source_path,
+                "--conflict-backoff",
+                "0",
+                "--dead-letter",
+                dead_letter,
+            ]
+        )
+        runner.adapter.do_delete_items = lambda data: None
+        runner.adapter.do_create_item = mock.Mock(side_effect=ValueError("error"))
+        runner.rsync()
+        commit = transaction.commit
+        calls = []
+
+        def conflict_once():
+            calls.append(1)
+            if len(calls) == 1:
+                raise ConflictError("test conflict")
+            commit()
+
+        with mock.patch("transaction.commit", side_effect=conflict_once):
+            # rows are not committed yet: the whole sync is redone
+            runner.final_commit()
+        self.assertEqual(runner.n_conflicts, 1)
+        self.assertEqual(runner.n_replays, 5)
+        self.assertEqual(runner.adapter.do_create_item.call_count, 10)
+        with open(dead_letter) as f:
+            self.assertEqual(len(f.readlines()), 5)
+        messages = [str(msg) for _, type, msg in runner.adapter.logdata]
+        self.assertIn(
+            f"Dead letter: 5 failed rows appended to {dead_letter}.", messages
+        )
+
+        # rows already committed: only the last phases are redone
+        runner = ScriptRunner(
+            args=[
+                "--source-path",
+                self.source_path,
+                "--conflict-backoff",
+                "0",
+                "--intermediate-commit",
+                "2",
+                "--dead-letter",
+                dead_letter,
+            ]
+        )
+        runner.adapter.do_delete_items = lambda data: None
+        runner.adapter.do_create_item = mock.Mock(side_effect=ValueError("error"))
+        runner.rsync()
+        self.assertTrue(runner.rows_committed)
+        calls.clear()
+        with mock.patch("transaction.commit", side_effect=conflict_once):
+            runner.final_commit()
+        self.assertEqual(runner.n_conflicts, 1)
+        self.assertEqual(runner.adapter.do_create_item.call_count, 5)
+        # the log lines of the closed dead-letter file are kept
+        messages = [str(msg) for _, type, msg in runner.adapter.logdata]
+        self.assertIn(
+            f"Dead letter: 5 failed rows appended to {dead_letter}.", messages
+        )
+
+    def test_deferred_reindex(self):
+        self.run_sync()
+        transaction.commit()
+        with open(self.source_path, "w") as f:
+            for i in range(1, 6):
+                f.write(json.dumps({"id": f"doc-{i}", "title": f"New {i}"}) + "\n")
+        runner = self.run_sync("--deferred-reindex", "end")
+        self.assertEqual(runner.adapter.n_updated, 5)
+        self.assertEqual(runner.adapter.reindex_queue.n_reindexed, 5)
+        self.assertEqual(len(api.content.find(Title="New")), 5)
+
+    def test_deferred_reindex_end_without_intermediate_commits(self):
+        # committed items would stay uncataloged until the end of the sync
+        with mock.patch("sys.stderr"):
+            with self.assertRaises(SystemExit):
+                self.run_sync("--deferred-reindex", "end", "--intermediate-commit", "2")
+
+    def test_plan_needs_lookup_key_index(self):
+        with mock.patch.object(DocumentAdapter, "lookup_key_index", None):
+            with mock.patch("sys.stderr"):
+                with self.assertRaises(SystemExit):
+                    ScriptRunner(args=["--source-path", self.source_path, "--plan"])
+
+    def test_plan(self):
+        self.run_sync("--fingerprints")
+        # the plan aborts the transaction
+        transaction.commit()
+        rows = [{"id": "doc-1", "title": "New 1"}]
+        rows += [{"id": f"doc-{i}", "title": f"Doc {i}"} for i in range(2, 5)]
+        rows.append({"id": "doc-6", "title": "Doc 6"})
+        with open(self.source_path, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+        plan_file = os.path.join(self.tmpdir, "plan.ndjson.gz")
+        runner = ScriptRunner(
+            args=["--source-path", self.source_path, "--plan", "--plan-file", plan_file]
+        )
+        runner.adapter.get_delete_query = lambda: {"portal_type": "Document"}
+        # items are never loaded
+        runner.adapter.do_find_item_from_row = mock.Mock(side_effect=AssertionError)
+        runner.rsync()
+
+        self.assertEqual(
+            runner.adapter.plan.counts,
+            {"create": 1, "update": 1, "unchanged": 3, "delete": 1},
+        )
+        self.assertNotIn("doc-6", self.portal)
+        self.assertIn("doc-5", self.portal)
+        self.assertEqual(self.portal["doc-1"].title, "Doc 1")
+        with gzip.open(plan_file, "rt") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[0]["action"], "update")
+        self.assertEqual(records[0]["path"], "/plone/doc-1")
+        self.assertEqual(
+            records[4], {"action": "create", "key": "doc-6", "uid": None, "path": None}
+        )
+        self.assertEqual(records[5]["path"], "/plone/doc-5")
+
+    def test_options_need_row_key(self):
+        snapshot = os.path.join(self.tmpdir, "snapshot.ndjson.gz")
+        for args in (
+            ["--snapshot", snapshot],
+            ["--lookup-index", "preload"],
+            ["--fingerprints"],
+            ["--plan"],
+        ):
+            with mock.patch.object(DocumentAdapter, "has_row_key", return_value=False):
+                with mock.patch("sys.stderr"):
+                    with self.assertRaises(SystemExit):
+                        ScriptRunner(args=["--source-path", self.source_path] + args)
+
+    def test_snapshot(self):
+        snapshot = os.path.join(self.tmpdir, "snapshot.ndjson.gz")
+        runner = self.run_sync("--snapshot", snapshot)
+        self.assertEqual(runner.adapter.n_created, 5)
+        runner.save_snapshot()
+        rows = [{"id": "doc-1", "title": "New 1"}]
+        rows += [{"id": f"doc-{i}", "title": f"Doc {i}"} for i in range(2, 5)]
+        rows.append({"id": "doc-6", "title": "Doc 6"})
+        with open(self.source_path, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+        runner = self.run_sync("--snapshot", snapshot)
+        adapter = runner.adapter
+        self.assertEqual(adapter.n_items, 5)
+        self.assertEqual(adapter.n_created, 1)
+        self.assertEqual(adapter.n_updated, 1)
+        self.assertEqual(adapter.n_unchanged, 3)
+        self.assertEqual(adapter.find_calls, 2)
+        # only the removed row is deleted
+        self.assertEqual(adapter.n_todelete, 1)
+        self.assertNotIn("doc-5", self.portal)
+        self.assertIn("doc-2", self.portal)
+        runner.save_snapshot()
+
+        runner = self.run_sync("--snapshot", snapshot, "--full")
+        self.assertEqual(runner.adapter.find_calls, 5)
+        self.assertIsNone(runner.adapter.removed_keys)
+
+    def test_convert_workers(self):
+        runner = ScriptRunner(
+            args=[
+                "--source-path",
+                self.source_path,
+                "--stream",
+                "--convert-workers",
+                "2",
+                "--batch-size",
+                "2",
+            ]
+        )
+        adapter = ConvertAdapter(self.portal, self.request)
+        adapter.options = runner.options
+        adapter.do_delete_items = lambda data: None
+        converted = []
+        adapter.create_or_update_item = lambda row: converted.append(row)
+        runner.adapter = adapter
+        runner.rsync()
+        self.assertEqual(
+            [row["title"] for row in converted], [f"DOC {i}" for i in range(1, 6)]
+        )
+        self.assertEqual([row["size"] for row in converted], [2, 2, 2, 2, 1])
+        self.assertNotIn(os.getpid(), {row["pid"] for row in converted})
+
+    def run_schema_sync(self, *args):
+        with open(self.source_path, "a") as f:
+            f.write(json.dumps({"id": "doc-6", "title": ""}) + "\n")
+            f.write(json.dumps({"id": "other", "title": "Other"}) + "\n")
+        runner = ScriptRunner(args=["--source-path", self.source_path] + list(args))
+        adapter = SchemaAdapter(self.portal, self.request)
+        adapter.options = runner.options
+        adapter.get_delete_query = lambda: {"portal_type": "Document"}
+        runner.adapter = adapter
+        runner.rsync()
+        return runner
+
+    def test_row_schema(self):
+        api.content.create(
+            container=self.portal, type="Document", id="doc-6", title="Doc 6"
+        )
+        runner = self.run_schema_sync()
+        adapter = runner.adapter
+        self.assertEqual(adapter.n_invalid, 2)
+        self.assertEqual(adapter.n_created, 5)
+        # invalid rows are never looked up
+        self.assertEqual(adapter.find_calls, 5)
+        self.assertEqual(adapter.failed_keys, {"doc-6", "other"})
+        # the item of the invalid row is still in the source
+        self.assertEqual(adapter.n_todelete, 0)
+        self.assertEqual(self.portal["doc-6"].title, "Doc 6")
+        errors = [
+            adapter.log_renderer.translate(msg)
+            for _, type, msg in adapter.logdata
+            if type == "error"
+        ]
+        self.assertEqual(len(errors), 2)
+        self.assertIn("title: shorter than 1", errors[0])
+        self.assertIn("id: 'other' does not match", errors[1])
+        self.assertEqual(adapter.metrics.timings["validate"].count, 1)
+
+    def test_row_schema_in_workers(self):
+        runner = self.run_schema_sync(
+            "--stream", "--convert-workers", "2", "--batch-size", "2"
+        )
+        self.assertEqual(runner.adapter.n_invalid, 2)
+        self.assertEqual(runner.adapter.n_created, 5)
+        self.assertNotIn("doc-6", self.portal)
+        # validation time of each batch, measured by the workers
+        self.assertEqual(runner.adapter.metrics.timings["validate"].count, 4)
+
+    def test_row_schema_plan(self):
+        dead_letter = os.path.join(self.tmpdir, "failed.ndjson")
+        runner = self.run_schema_sync("--plan", "--dead-letter", dead_letter)
+        self.assertEqual(runner.adapter.n_invalid, 2)
+        # the plan does not write the dead-letter file
+        self.assertIsNone(runner.adapter.dead_letter)
+        self.assertFalse(os.path.exists(dead_letter))
+
+    def test_dead_letter(self):
+        dead_letter = os.path.join(self.tmpdir, "failed.ndjson")
+        runner = ScriptRunner(
+            args=["--source-path", self.source_path, "--dead-letter", dead_letter]
+        )
+        create = runner.adapter.do_create_item
+
+        def do_create_item(row):
+            if row["id"] == "doc-3":
+                raise ValueError("Invalid title")
+            return create(row)
+
+        runner.adapter.do_create_item = do_create_item
+        runner.adapter.get_delete_query = lambda: {"portal_type": "Document"}
+        runner.rsync()
+        self.assertNotIn("doc-3", self.portal)
+        self.assertEqual(runner.adapter.dead_letter.n_rows, 1)
+        with open(dead_letter) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["phase"], "create")
+        self.assertEqual(records[0]["key"], "doc-3")
+        self.assertEqual(records[0]["row"], {"id": "doc-3", "title": "Doc 3"})
+        self.assertEqual(records[0]["error"], "Invalid title")
+        self.assertIn("ValueError: Invalid title", records[0]["traceback"])
+
+        # the dead-letter file is the source of the recovery run
+        runner = ScriptRunner(args=["--source-path", dead_letter, "--stream"])
+        runner.adapter.get_delete_query = lambda: {"portal_type": "Document"}
+        runner.rsync()
+        self.assertTrue(runner.adapter.dead_letter_source)
+        self.assertEqual(runner.adapter.n_created, 1)
+        self.assertEqual(self.portal["doc-3"].title, "Doc 3")
+        # the delete phase is skipped
+        self.assertIn("doc-1", self.portal)
+
+    def test_no_delete_after_source_error(self):
+        api.content.create(
+            container=self.portal, type="Document", id="doc-9", title="Doc 9"
+        )
+        missing = os.path.join(self.tmpdir, "missing.json")
+        runner = ScriptRunner(args=["--source-path", missing])
+        runner.adapter.get_delete_query = lambda: {"portal_type": "Document"}
+        runner.rsync()
+        self.assertIn("doc-9", self.portal)
+        self.assertEqual(runner.adapter.n_todelete, 0)
+
+        # the stream breaks after the first rows
+        with open(self.source_path, "a") as f:
+            f.write("{broken\n")
+        runner = ScriptRunner(
+            args=["--source-path", self.source_path, "--stream", "--batch-size", "2"]
+        )
+        runner.adapter.get_delete_query = lambda: {"portal_type": "Document"}
+        runner.rsync()
+        self.assertTrue(runner.adapter.source_error)
+        self.assertTrue(runner.adapter.n_created)
+        self.assertIn("doc-9", self.portal)
+        self.assertEqual(runner.adapter.n_todelete, 0)
+
+    def test_metrics(self):
+        json_path = os.path.join(self.tmpdir, "metrics.json")
+        prometheus_path = os.path.join(self.tmpdir, "rsync.prom")
+        runner = self.run_sync(
+            "--intermediate-commit",
+            "2",
+            "--metrics-file",
+            json_path,
+            "--metrics-prometheus",
+            prometheus_path,
+        )
+        runner.write_metrics()
+        with open(json_path) as f:
+            metrics = json.load(f)
+        operations = metrics["operations"]
+        self.assertEqual(operations["lookup"]["count"], 5)
+        self.assertEqual(operations["create_item"]["count"], 5)
+        # two intermediate commits and one at the end of rows
+        self.assertEqual(operations["commit"]["count"], 3)
+        self.assertEqual(operations["get_data"]["count"], 1)
+        self.assertEqual(metrics["gauges"]["n_created"], 5)
+        self.assertGreater(metrics["rows_per_second"], 0)
+        with open(prometheus_path) as f:
+            prometheus = f.read()
+        self.assertIn(
+            'redturtle_rsync_operation_seconds_count{operation="create_item"} 5',
+            prometheus,
+        )
+        self.assertIn('redturtle_rsync_items{counter="n_created"} 5', prometheus)
+
+    def test_profile(self):
+        profile_dir = os.path.join(self.tmpdir, "profile")
+        self.run_sync(
+            "--profile",
+            "--profile-sample",
+            "2",
+            "--tracemalloc",
+            "2",
+            "--profile-dir",
+            profile_dir,
+        )
+        files = os.listdir(profile_dir)
+        for phase in ("get_data", "rows", "write_log"):
+            self.assertIn(f"{phase}.prof", files)
+        with open(os.path.join(profile_dir, "rows.txt")) as f:
+            self.assertIn("create_or_update_item", f.read())
+        with open(os.path.join(profile_dir, "tracemalloc.ndjson")) as f:
+            snapshots = [json.loads(line) for line in f]
+        self.assertEqual([s["row"] for s in snapshots], [2, 4])
+        self.assertTrue(snapshots[0]["top"])
+        self.assertIn("objects", snapshots[0]["zodb_cache"])
+
+    def test_stream_source_url(self):
+        server = HTTPServer(("127.0.0.1", 0), SourceHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_port}/source.ndjson"
+        runner = ScriptRunner(args=["--source-url", url, "--stream"])
+        runner.adapter.do_delete_items = lambda data: None
+        runner.adapter.convert_source_row = lambda row: {
+            "id": f"doc-{row['id']}",
+            "title": "Doc",
+        }
+        runner.rsync()
+        self.assertFalse(runner.adapter.source_error)
+        self.assertEqual(runner.adapter.n_created, 100)
+
+    def test_skip_not_modified(self):
+        server = HTTPServer(("127.0.0.1", 0), SourceHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_port}/source.ndjson"
+        args = [
+            "--source-url",
+            url,
+            "--source-cache",
+            os.path.join(self.tmpdir, "cache"),
+            "--skip-not-modified",
+            "--stream",
+        ]
+        runner = ScriptRunner(args=args)
+        runner.adapter.do_delete_items = lambda data: None
+        runner.adapter.convert_source_row = lambda row: {
+            "id": f"doc-{row['id']}",
+            "title": "Doc",
+        }
+        runner.rsync()
+        self.assertEqual(runner.adapter.n_created, 100)
+
+        runner = ScriptRunner(args=args)
+        runner.adapter.do_delete_items = mock.Mock()
+        runner.rsync()
+        self.assertTrue(runner.adapter.source_not_modified)
+        self.assertEqual(runner.adapter.n_items, 0)
+        runner.adapter.do_delete_items.assert_not_called()
+
+    def test_adaptive_commit(self):
+        with mock.patch("transaction.commit", wraps=transaction.commit) as commit:
+            runner = self.run_sync("--commit-max-objects", "1", "--cache-gc", "gc")
+        self.assertTrue(runner.rows_committed)
+        # a commit before each row after the first and one for the last row
+        self.assertEqual(commit.call_count, 5)
+        self.assertEqual(runner.adapter.n_created, 5)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "snapshot.ndjson.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def diff(self, rows, full=False):
+        # small chunks, to merge them from disk
+        snapshot = Snapshot(path=self.path, chunk_size=2)
+        result = list(
+            snapshot.diff(
+                rows,
+                get_key=lambda row: row.get("id"),
+                get_fingerprint=lambda row: row["title"],
+                full=full,
+            )
+        )
+        return snapshot, result
+
+    def test_diff(self):
+        rows = [{"id": i, "title": f"Row {i}"} for i in (3, 1, 2, 11)]
+        snapshot, result = self.diff(rows)
+        # in source order
+        self.assertEqual([row["id"] for row in result], [3, 1, 2, 11])
+        self.assertEqual(snapshot.n_added, 4)
+        snapshot.save()
+
+        rows = [
+            {"id": 1, "title": "Row 1"},
+            {"title": "No key"},
+            {"id": 3, "title": "New 3"},
+            {"id": 4, "title": "Row 4"},
+            {"id": 11, "title": "Row 11"},
+        ]
+        snapshot, result = self.diff(rows)
+        self.assertEqual([row["title"] for row in result], ["No key", "New 3", "Row 4"])
+        self.assertEqual(snapshot.removed_keys, [2])
+        self.assertEqual(
+            (snapshot.n_added, snapshot.n_changed, snapshot.n_unchanged), (1, 1, 2)
+        )
+        self.assertEqual(snapshot.n_without_key, 1)
+
+        snapshot, result = self.diff(rows, full=True)
+        self.assertEqual(len(result), 5)
+
+    def test_source_order(self):
+        # e.g. parents before their children
+        keys = ["parent", "parent/child", "b", "a"]
+        snapshot, result = self.diff([{"id": key, "title": key} for key in keys])
+        self.assertEqual([row["id"] for row in result], keys)
+        snapshot.save()
+
+        rows = [{"id": key, "title": f"New {key}"} for key in keys]
+        rows.insert(2, {"title": "No key"})
+        snapshot, result = self.diff(rows)
+        self.assertEqual(result, rows)
+
+    def test_failed_rows_are_synced_again(self):
+        rows = [{"id": i, "title": f"Row {i}"} for i in range(3)]
+        snapshot, result = self.diff(rows)
+        snapshot.save(exclude={1})
+        snapshot, result = self.diff(rows)
+        self.assertEqual(result, [{"id": 1, "title": "Row 1"}])
+
+    def test_discard(self):
+        snapshot, result = self.diff([{"id": 1, "title": "Row 1"}])
+        snapshot.discard()
+        snapshot, result = self.diff([{"id": 1, "title": "Row 1"}])
+        self.assertEqual(len(result), 1)
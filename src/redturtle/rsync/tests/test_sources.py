@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from http.server import ThreadingHTTPServer
+from redturtle.rsync.adapters.assets import AssetCache
+from redturtle.rsync.adapters.http_cache import SourceCache
+from redturtle.rsync.adapters.paged import PagedSource
+from redturtle.rsync.adapters.paged import set_query_params
+from redturtle.rsync.adapters.sources import guess_format
+from redturtle.rsync.adapters.sources import iter_json_array
+from redturtle.rsync.adapters.sources import iter_ndjson
+from redturtle.rsync.adapters.sources import iter_rows
+from redturtle.rsync.adapters.sources import open_source_stream
+from redturtle.rsync.scripts.rsync import iter_ahead
+from urllib.parse import parse_qsl
+from urllib.parse import urlparse
+
+import bz2
+import gzip
+import io
+import json
+import lzma
+import os
+import requests
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+
+class TestIterJsonArray(unittest.TestCase):
+    """Test incremental decoding of JSON arrays."""
+
+    def test_decode_rows_across_chunks(self):
+        data = [{"id": i, "title": f"Item {i}", "value": -1.5e3} for i in range(50)]
+        data.extend([123456, "a string", True, None, []])
+        payload = json.dumps(data, indent=2)
+        for chunk_size in (1, 3, 16, 4096):
+            rows = list(iter_json_array(io.StringIO(payload), chunk_size=chunk_size))
+            self.assertEqual(rows, data)
+
+    def test_empty_source(self):
+        self.assertEqual(list(iter_json_array(io.StringIO(""))), [])
+        self.assertEqual(list(iter_json_array(io.StringIO(" [ ] "))), [])
+
+    def test_restapi_like_object(self):
+        payload = json.dumps({"items": [{"id": 1}, {"id": 2}], "items_total": 2})
+        self.assertEqual(
+            list(iter_json_array(io.StringIO(payload))), [{"id": 1}, {"id": 2}]
+        )
+
+    def test_trailing_whitespace(self):
+        payload = "[1, 2] \n\n"
+        self.assertEqual(
+            list(iter_json_array(io.StringIO(payload), chunk_size=2)), [1, 2]
+        )
+
+    def test_trailing_comma(self):
+        # rejected as by json.load
+        for payload in ("[1,]", "[1, 2 , ]"):
+            with self.assertRaises(ValueError):
+                json.loads(payload)
+            with self.assertRaises(ValueError):
+                list(iter_json_array(io.StringIO(payload), chunk_size=2))
+
+    def test_invalid_array(self):
+        for payload in ("[1,", "[1 2]", "[,1]", "[tru]", "[1] [2]", "[1]x"):
+            with self.assertRaises(ValueError):
+                list(iter_json_array(io.StringIO(payload), chunk_size=2))
+
+
+class TestIterNdjson(unittest.TestCase):
+    """Test line by line decoding of NDJSON sources."""
+
+    def test_decode_lines(self):
+        payload = '{"id": 1}\n\n{"id": 2}\n'
+        self.assertEqual(
+            list(iter_ndjson(io.StringIO(payload))), [{"id": 1}, {"id": 2}]
+        )
+
+    def test_invalid_line(self):
+        with self.assertRaises(ValueError):
+            list(iter_ndjson(io.StringIO('{"id": 1}\n{"id": \n')))
+
+
+class TestSourceDecoders(unittest.TestCase):
+    """Test format and compression detection."""
+
+    rows = [{"id": "1", "title": "First"}, {"id": "2", "title": "Second, again"}]
+
+    def decode(self, payload, name="", content_type="", source_format=None):
+        fp = open_source_stream(
+            io.BytesIO(payload), name=name, content_type=content_type
+        )
+        if not source_format:
+            source_format = guess_format(fp, name=name, content_type=content_type)
+        return source_format, list(iter_rows(fp, source_format=source_format))
+
+    def test_gzipped_ndjson_by_extension(self):
+        payload = gzip.compress(
+            "\n".join(json.dumps(row) for row in self.rows).encode()
+        )
+        self.assertEqual(
+            self.decode(payload, name="export.ndjson.gz"), ("ndjson", self.rows)
+        )
+
+    def test_sniff_compression_and_format(self):
+        ndjson = "\n".join(json.dumps(row) for row in self.rows).encode()
+        for compress in (gzip.compress, bz2.compress, lzma.compress):
+            self.assertEqual(self.decode(compress(ndjson)), ("ndjson", self.rows))
+        self.assertEqual(
+            self.decode(json.dumps(self.rows).encode()), ("json", self.rows)
+        )
+
+    def test_csv_and_tsv(self):
+        csv_payload = b'\xef\xbb\xbfid,title\n1,First\n2,"Second, again"\n'
+        self.assertEqual(self.decode(csv_payload), ("csv", self.rows))
+        tsv_payload = b"id\ttitle\n1\tFirst\n2\tSecond, again\n"
+        self.assertEqual(
+            self.decode(tsv_payload, content_type="text/tab-separated-values"),
+            ("tsv", self.rows),
+        )
+
+    def test_unknown_format(self):
+        fp = open_source_stream(io.BytesIO(b"<xml/>"), name="data.xml")
+        self.assertIsNone(guess_format(fp, name="data.xml", sniff=False))
+        with self.assertRaises(ValueError):
+            iter_rows(fp, source_format="xml")
+
+
+PAYLOAD = b"".join(json.dumps({"id": i}).encode("utf-8") + b"\n" for i in range(100))
+
+
+class SourceHandler(BaseHTTPRequestHandler):
+    """Serve PAYLOAD with ETag, conditional and Range requests."""
+
+    etag = '"v1"'
+    gzip = False
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        body = gzip.compress(PAYLOAD) if self.gzip else PAYLOAD
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get("Range") and self.headers.get("If-Range") == self.etag:
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/*")
+        else:
+            self.send_response(200)
+        if self.etag:
+            self.send_header("ETag", self.etag)
+        self.send_header("Content-Type", "application/x-ndjson")
+        if self.gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+
+class TestSourceCache(unittest.TestCase):
+    def setUp(self):
+        SourceHandler.requests = []
+        SourceHandler.gzip = False
+        self.server = HTTPServer(("127.0.0.1", 0), SourceHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/source.ndjson"
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = SourceCache(self.tmpdir, session=requests.Session())
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, source):
+        with source.open() as f:
+            return f.read()
+
+    def test_conditional_request(self):
+        source = self.cache.fetch(self.url)
+        self.assertFalse(source.not_modified)
+        self.assertEqual(self.read(source), PAYLOAD)
+        self.assertEqual(source.identity, f'{self.url}:"v1"')
+
+        source = self.cache.fetch(self.url)
+        self.assertTrue(source.not_modified)
+        self.assertEqual(SourceHandler.requests[-1]["If-None-Match"], '"v1"')
+        self.assertEqual(self.read(source), PAYLOAD)
+
+    def test_resume_download(self):
+        self.cache.fetch(self.url)
+        data_path, part_path, _ = self.cache.paths(self.url)
+        # an interrupted download
+        meta = self.cache.load_meta(self.url)
+        meta["complete"] = False
+        self.cache.save_meta(self.url, meta)
+        os.replace(data_path, part_path)
+        with open(part_path, "r+b") as f:
+            f.truncate(100)
+
+        source = self.cache.fetch(self.url)
+        self.assertEqual(SourceHandler.requests[-1]["Range"], "bytes=100-")
+        self.assertEqual(source.meta["resumed_from"], 100)
+        self.assertEqual(self.read(source), PAYLOAD)
+
+    def test_gzip_encoding(self):
+        SourceHandler.gzip = True
+        source = self.cache.fetch(self.url)
+        self.assertEqual(source.meta["content_encoding"], "gzip")
+        self.assertEqual(self.read(source), PAYLOAD)
+
+
+class PagesHandler(BaseHTTPRequestHandler):
+    """Serve 95 rows in pages, as plone.restapi (mode = "restapi"), with
+    only next links (mode = "next") or with only b_start/b_size."""
+
+    mode = "restapi"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parts = urlparse(self.path)
+        query = dict(parse_qsl(parts.query))
+        start = int(query.get("b_start", 0))
+        size = int(query.get("b_size", 10))
+        items = [{"id": i} for i in range(start, min(start + size, 95))]
+        if self.mode == "offset":
+            payload = items
+        else:
+            payload = {"items": items}
+            next_url = None
+            if start + size < 95:
+                next_url = f"http://{self.headers['Host']}/items?b_start={start + size}"
+            if self.mode == "restapi":
+                payload["items_total"] = 95
+                payload["batching"] = {"next": next_url}
+            else:
+                payload["next"] = next_url
+        body = json.dumps(payload).encode("utf-8")
+        # later pages are faster, to check the order of the rows
+        time.sleep(0.05 if start < 50 else 0)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestPagedSource(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), PagesHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/items"
+
+    def tearDown(self):
+        PagesHandler.mode = "restapi"
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_ids(self, **kwargs):
+        source = PagedSource(session=requests.Session(), url=self.url, **kwargs)
+        ids = [row["id"] for row in source]
+        return ids, source.n_pages
+
+    def test_pages_from_total(self):
+        self.assertEqual(self.get_ids(workers=4), (list(range(95)), 10))
+
+    def test_pages_from_offset(self):
+        PagesHandler.mode = "offset"
+        ids, n_pages = self.get_ids(workers=3, page_size=20)
+        self.assertEqual(ids, list(range(95)))
+        # the last page has less rows than page_size
+        self.assertGreaterEqual(n_pages, 5)
+
+    def test_next_links(self):
+        PagesHandler.mode = "next"
+        self.assertEqual(self.get_ids(), (list(range(95)), 10))
+
+    def test_set_query_params(self):
+        self.assertEqual(
+            set_query_params("http://x/y?a=1&b_start=5", b_start=10, b_size=5),
+            "http://x/y?a=1&b_start=10&b_size=5",
+        )
+
+
+class AssetsHandler(BaseHTTPRequestHandler):
+    """Serve /logo.png and /copy-of-logo.png with the same content."""
+
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        body = b"\x89PNG" + b"0" * 1000
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestAssetCache(unittest.TestCase):
+    def setUp(self):
+        AssetsHandler.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), AssetsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_dedup(self):
+        logo = f"{self.base_url}/logo.png"
+        copy = f"{self.base_url}/copy-of-logo.png"
+        cache = AssetCache(self.tmpdir, session=requests.Session(), workers=2)
+        cache.prefetch([logo] * 40 + [copy])
+        asset = cache.get(logo)
+        self.assertEqual(asset.filename, "logo.png")
+        self.assertEqual(asset.content_type, "image/png")
+        with asset.open() as f:
+            self.assertTrue(f.read().startswith(b"\x89PNG"))
+        self.assertEqual(cache.get(copy).path, asset.path)
+        cache.close()
+        self.assertEqual(
+            sorted(AssetsHandler.requests), sorted(["/logo.png", "/copy-of-logo.png"])
+        )
+        self.assertEqual(cache.n_downloaded, 2)
+
+        # another run uses the cache
+        cache = AssetCache(self.tmpdir, session=requests.Session())
+        self.assertEqual(cache.get(logo).sha256, asset.sha256)
+        cache.close()
+        self.assertEqual(cache.n_cached, 1)
+        self.assertEqual(len(AssetsHandler.requests), 2)
+
+    def test_temporary_directory(self):
+        cache = AssetCache(session=requests.Session())
+        path = cache.get(f"{self.base_url}/logo.png").path
+        self.assertTrue(os.path.exists(path))
+        cache.close()
+        self.assertFalse(os.path.exists(cache.directory))
+
+    def test_iter_ahead(self):
+        calls = []
+        batches = iter_ahead(iter([[1], [2], [3]]), callback=calls.append)
+        self.assertEqual(next(batches), [1])
+        # assets of the next batch are already requested
+        self.assertEqual(calls, [[1], [2]])
+        self.assertEqual(list(batches), [[2], [3]])